@@ -0,0 +1,304 @@
+import torch
+from transformers import (LogitsProcessorList, RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper,
+                          TopKLogitsWarper, TopPLogitsWarper)
+from transformers.cache_utils import DynamicCache
+from transformers.generation.beam_search import BeamHypotheses
+
+
+class _BeamTreeKV:
+    """
+    KV cache of `BeamSearchDecoder`: the prompt once, then the tokens fed to the beams at every step, appended to
+    one (1, heads, capacity, head_dim) buffer per layer. The beams are the query positions of a single row, and
+    `visible` (beams, capacity) tells which cached tokens each beam attends to: the prompt and its ancestors.
+    Reordering the beams only reorders the rows of `visible`, the keys/values never move.
+    """
+
+    def __init__(self, past, prompt_mask, num_beams, capacity, max_capacity):
+        self.length = prompt_mask.shape[-1]
+        self.max_capacity = max_capacity
+        self.key_cache = [self._alloc(key, capacity) for key, _ in past]
+        self.value_cache = [self._alloc(value, capacity) for _, value in past]
+        self.visible = torch.zeros(num_beams, capacity, dtype=torch.bool, device=prompt_mask.device)
+        self.visible[:, :self.length] = prompt_mask.bool()
+        self._end = self.length
+
+    @staticmethod
+    def _alloc(tensor, capacity):
+        buffer = tensor.new_empty(1, tensor.shape[1], capacity, tensor.shape[-1])
+        buffer[:, :, :tensor.shape[-2]] = tensor
+        return buffer
+
+    @property
+    def capacity(self):
+        return self.visible.shape[-1]
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.key_cache + self.value_cache)
+
+    def _grow(self, num_tokens):
+        capacity = min(max(num_tokens, 2 * self.capacity), self.max_capacity)
+        if num_tokens > capacity:
+            raise ValueError(f"beam search KV cache overflow: {num_tokens} tokens > {self.max_capacity}")
+        self.key_cache = [self._alloc(key[:, :, :self.length], capacity) for key in self.key_cache]
+        self.value_cache = [self._alloc(value[:, :, :self.length], capacity) for value in self.value_cache]
+        visible = self.visible.new_zeros(self.visible.shape[0], capacity)
+        visible[:, :self.length] = self.visible[:, :self.length]
+        self.visible = visible
+
+    def append(self, num_beams):
+        """
+        Make room for the next token of the first `num_beams` beams, each one seeing its own token.
+        Returns:
+            cache_position: (num_beams,) slots of the tokens
+            attention_mask: (1, 1, num_beams, length) additive mask of the step
+        """
+        start, end = self.length, self.length + num_beams
+        if end > self.capacity:
+            self._grow(end)
+        self.visible[:num_beams, start:end] = torch.eye(num_beams, dtype=torch.bool, device=self.visible.device)
+        self._end = self.length = end
+        dtype = self.key_cache[0].dtype
+        mask = torch.zeros(1, 1, num_beams, end, dtype=dtype, device=self.visible.device)
+        mask.masked_fill_(~self.visible[:num_beams, :end], torch.finfo(dtype).min)
+        return torch.arange(start, end, device=self.visible.device), mask
+
+    def reorder(self, beam_idx):
+        """
+        Beam i continues beam `beam_idx[i]` and sees its tokens.
+        """
+        self.visible[:beam_idx.shape[0], :self.length] = self.visible[beam_idx, :self.length]
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        cache_position = cache_kwargs["cache_position"]
+        k_out, v_out = self.key_cache[layer_idx], self.value_cache[layer_idx]
+        k_out.index_copy_(2, cache_position, key_states.to(k_out.dtype))
+        v_out.index_copy_(2, cache_position, value_states.to(v_out.dtype))
+        return k_out[:, :, :self._end], v_out[:, :, :self._end]
+
+
+class BeamSearchDecoder:
+    """
+    Beam search over the mel codes of one segment, specialized for `UnifiedVoice`; returns the codes of
+    `generate(num_beams=...)` with the same processors and `BeamSearchScorer` rules (greedy or sampled beams).
+
+    `generate()` prefills the prompt once per beam, and reorders its KV cache with an `index_select` of every layer
+    at every step. Here the prompt is prefilled once and its keys/values are shared by the beams: the beams are the
+    query positions of a single row, attending to the prompt and to their own ancestors through the attention mask
+    (`_BeamTreeKV`), so a reorder only permutes the rows of a (beams, tokens) boolean mask.
+
+    With `prune`, the search stops as soon as no running beam can beat the `num_return_sequences` best finished
+    hypotheses (`generate()` waits for `num_beams` of them), and the running beams that can't beat them are dropped
+    from the batch instead of being decoded until the end. The returned codes can then differ from `generate()`
+    when a dropped beam would have taken the slot of another one.
+    """
+
+    def __init__(self, gpt, num_beams=3, do_sample=False, top_p=1.0, top_k=50, temperature=1.0,
+                 repetition_penalty=1.0, length_penalty=1.0, num_return_sequences=1, prune=True,
+                 return_latent=False):
+        """
+        Args:
+            gpt: `UnifiedVoice` after `post_init_gpt2_config()`.
+            prune: stop early and drop the beams that can't win, see above.
+            return_latent: feed the codes at the mel positions of the teacher-forced `UnifiedVoice.forward()` and
+                return their latents, see `UnifiedVoice.inference_speech(return_latent=True)`.
+        """
+        if num_return_sequences > num_beams:
+            raise ValueError(f"`num_return_sequences` ({num_return_sequences}) has to be <= `num_beams` "
+                             f"({num_beams})")
+        self.gpt = gpt
+        self.num_beams = num_beams
+        self.do_sample = do_sample
+        self.length_penalty = length_penalty
+        self.num_return_sequences = num_return_sequences
+        self.prune = prune
+        self.return_latent = return_latent
+        # the processors of `generate()` for beam search, in the same order
+        self.processors = LogitsProcessorList()
+        if repetition_penalty is not None and repetition_penalty != 1.0:
+            self.processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        if do_sample:
+            if temperature is not None and temperature != 1.0:
+                self.processors.append(TemperatureLogitsWarper(temperature))
+            if top_k:
+                self.processors.append(TopKLogitsWarper(top_k, min_tokens_to_keep=2))
+            if top_p is not None and top_p < 1.0:
+                self.processors.append(TopPLogitsWarper(top_p, min_tokens_to_keep=2))
+        self.cache = None
+        self.stats = {"steps": 0, "pruned": 0, "cache_tokens": 0, "cache_bytes": 0}
+
+    def _forward(self, tokens, position):
+        gpt = self.gpt
+        transformer = gpt.gpt
+        cache_position, attention_mask = self.cache.append(tokens.shape[0])
+        hidden = gpt.mel_embedding(tokens.unsqueeze(0)) + gpt.mel_pos_embedding.emb(
+            torch.tensor([position], device=tokens.device)).unsqueeze(0)
+        hidden = transformer.drop(hidden)
+        for block in transformer.h:
+            hidden = block(hidden, past_key_value=self.cache, cache_position=cache_position,
+                           attention_mask=attention_mask, use_cache=True)[0]
+        latents = gpt.final_norm(transformer.ln_f(hidden[0]))
+        return gpt.mel_head(latents).float(), latents
+
+    def _prefill(self, conds_latent, text_inputs, max_new_tokens, prefix_key=None):
+        gpt = self.gpt
+        fake_inputs, inputs_embeds, attention_mask = gpt.prepare_gpt_inputs(conds_latent, text_inputs)
+        device = inputs_embeds.device
+        start_emb = gpt.mel_embedding(fake_inputs[:, -1:]) + gpt.mel_pos_embedding.emb(
+            torch.zeros(1, dtype=torch.long, device=device))
+        emb = torch.cat([inputs_embeds, start_emb.to(inputs_embeds.dtype)], dim=1)
+        cache = DynamicCache()
+        if gpt.prefix_cache is not None and prefix_key is not None and bool(attention_mask.all()):
+            prefix = gpt.get_conditioning_prefix(conds_latent, prefix_key)
+            cache = DynamicCache.from_legacy_cache(tuple(prefix.expand(1)))
+            emb = emb[:, prefix.length:]
+        outputs = gpt.gpt(inputs_embeds=emb, attention_mask=attention_mask, past_key_values=cache, use_cache=True,
+                          return_dict=True)
+        cache = outputs.past_key_values
+        prompt_len = attention_mask.shape[-1]
+        max_capacity = prompt_len + self.num_beams * max_new_tokens
+        self.cache = _BeamTreeKV(list(zip(cache.key_cache, cache.value_cache)), attention_mask[0], self.num_beams,
+                                 min(prompt_len + self.num_beams * 64, max_capacity), max_capacity)
+        latents = gpt.final_norm(outputs.last_hidden_state[:, -1])
+        return fake_inputs, gpt.mel_head(latents).float(), latents
+
+    def _attainable(self, score, length):
+        # best score a beam of `score` can reach, as estimated by `BeamHypotheses.is_done(early_stopping=False)`
+        return score / length ** self.length_penalty
+
+    @torch.no_grad()
+    def generate(self, conds_latent, text_inputs, max_new_tokens, stopping_criteria=None, prefix_key=None):
+        """
+        Args:
+            conds_latent: (1, 34, dim) output of `UnifiedVoice.get_conds_latent()`
+            text_inputs: (1, L) text tokens
+            max_new_tokens: maximum number of generated codes
+            stopping_criteria: `StoppingCriteriaList`, the search stops when all the running beams are stopped
+            prefix_key: key of the conditioning in `gpt.prefix_cache`, see `UnifiedVoice.get_conditioning_prefix()`
+        Returns:
+            codes: (num_return_sequences, n) the best hypotheses, ending with `stop_mel_token` (and padded with it)
+                unless the length limit was hit, as returned by `generate()`
+            latent: (num_return_sequences, n, dim) latents of the codes with `return_latent`, else None
+        """
+        gpt = self.gpt
+        stop_token = gpt.stop_mel_token
+        k = self.num_beams
+        fake_inputs, logits, latents = self._prefill(conds_latent, text_inputs, max_new_tokens, prefix_key)
+        device = logits.device
+        input_ids = fake_inputs  # (beams, prompt + generated) ids seen by the repetition penalty
+        prompt_len = input_ids.shape[-1]
+        # only the first beam is live at the first step, as in `generate()`
+        beam_scores = torch.full((k,), -1e9, dtype=torch.float, device=device)
+        beam_scores[0] = 0.0
+        # latents of each step, concatenated, and the row of each code of the beams in them
+        latent_steps = [latents.expand(k, -1)] if self.return_latent else None
+        step_offsets = [0]
+        beam_rows = torch.zeros(1, 0, dtype=torch.long, device=device)
+        hyps = BeamHypotheses(num_beams=k, length_penalty=self.length_penalty, early_stopping=False)
+        # the first generated code is fed at mel position 2, as in `GPT2InferenceModel.forward()`
+        position = 1 if self.return_latent else 2
+        done = False
+        step = 0
+        while True:
+            width = beam_scores.shape[0]
+            scores = torch.nn.functional.log_softmax(logits, dim=-1)
+            scores = self.processors(input_ids, scores)
+            if scores.shape[0] != width:
+                scores = scores.expand(width, -1)
+            vocab_size = scores.shape[-1]
+            scores = (scores + beam_scores[:, None]).view(1, -1)
+            num_candidates = 2 * width
+            if self.do_sample:
+                tokens = torch.multinomial(scores.softmax(dim=-1), num_samples=num_candidates)
+                next_scores = torch.gather(scores, -1, tokens)
+                next_scores, order = torch.sort(next_scores, descending=True, dim=1)
+                tokens = torch.gather(tokens, -1, order)
+            else:
+                next_scores, tokens = torch.topk(scores, num_candidates, dim=1, largest=True, sorted=True)
+            parents = (tokens // vocab_size)[0].tolist()
+            tokens = (tokens % vocab_size)[0].tolist()
+            next_scores = next_scores[0].tolist()
+
+            # `BeamSearchScorer.process()`: the stop tokens among the `width` best candidates end a hypothesis
+            new_scores, new_tokens, new_parents = [], [], []
+            for rank, (score, token, parent) in enumerate(zip(next_scores, tokens, parents)):
+                if token == stop_token:
+                    if rank < width:
+                        row = parent if step > 0 else 0
+                        hyps.add(input_ids[row, prompt_len:].clone(), score,
+                                 beam_indices=torch.cat([beam_rows[row], beam_rows.new_tensor([parent])]),
+                                 generated_len=step + 1)
+                    continue
+                new_scores.append(score)
+                new_tokens.append(token)
+                new_parents.append(parent)
+                if len(new_tokens) == width:
+                    break
+            best = max(next_scores)
+            # the scores of the candidates count their own token, as in `BeamSearchScorer.process()`
+            if len(hyps) >= k and hyps.worst_score >= self._attainable(best, step + 1):
+                done = True
+            elif self.prune and len(hyps) >= self.num_return_sequences:
+                threshold = sorted(score for score, _, _ in hyps.beams)[-self.num_return_sequences]
+                if threshold >= self._attainable(best, step + 1):
+                    done = True
+                else:
+                    keep = [i for i, score in enumerate(new_scores) if self._attainable(score, step + 1) > threshold]
+                    self.stats["pruned"] += width - len(keep)
+                    new_scores = [new_scores[i] for i in keep]
+                    new_tokens = [new_tokens[i] for i in keep]
+                    new_parents = [new_parents[i] for i in keep]
+            if done or not new_tokens:
+                done = True
+                break
+
+            beam_idx = torch.tensor(new_parents, dtype=torch.long, device=device)
+            beam_scores = torch.tensor(new_scores, dtype=torch.float, device=device)
+            next_tokens = torch.tensor(new_tokens, dtype=torch.long, device=device)
+            if step > 0:
+                input_ids, beam_rows = input_ids[beam_idx], beam_rows[beam_idx]
+                self.cache.reorder(beam_idx)
+            else:
+                # the beams of the first step are copies of the prefilled row
+                input_ids, beam_rows = input_ids.expand(len(new_tokens), -1), beam_rows.expand(len(new_tokens), -1)
+            input_ids = torch.cat([input_ids, next_tokens[:, None]], dim=-1)
+            beam_rows = torch.cat([beam_rows, beam_idx[:, None]], dim=-1)
+            step += 1
+            self.stats["steps"] += 1
+            if step >= max_new_tokens or (stopping_criteria is not None
+                                          and bool(stopping_criteria(input_ids, None).all())):
+                break
+            logits, latents = self._forward(next_tokens, position)
+            position += 1
+            if self.return_latent:
+                step_offsets.append(step_offsets[-1] + latent_steps[-1].shape[0])
+                latent_steps.append(latents)
+
+        if not done:
+            # `BeamSearchScorer.finalize()`: the running beams are hypotheses too
+            for i in range(input_ids.shape[0]):
+                hyps.add(input_ids[i, prompt_len:].clone(), beam_scores[i].item(), beam_indices=beam_rows[i],
+                         generated_len=step)
+        self.stats["cache_tokens"] = self.cache.length
+        self.stats["cache_bytes"] = self.cache.nbytes
+        self.cache = None
+        best = sorted(hyps.beams, key=lambda hyp: hyp[0], reverse=True)[:self.num_return_sequences]
+        return self._finalize(best, max_new_tokens, latent_steps, step_offsets, device)
+
+    def _finalize(self, best, max_new_tokens, latent_steps, step_offsets, device):
+        stop_token = self.gpt.stop_mel_token
+        length = min(max(len(codes) for _, codes, _ in best) + 1, max_new_tokens)
+        codes = torch.full((len(best), length), stop_token, dtype=torch.long, device=device)
+        for i, (_, hyp, _) in enumerate(best):
+            codes[i, :len(hyp)] = hyp[:length]
+        if not self.return_latent:
+            return codes, None
+        # the latent of the code of step j is the hidden state of its parent row at step j, row 0 after the end
+        latent_steps = torch.cat(latent_steps)
+        num_steps = min(length, len(step_offsets))
+        offsets = torch.tensor(step_offsets[:num_steps], dtype=torch.long, device=device)
+        rows = torch.zeros(len(best), num_steps, dtype=torch.long, device=device)
+        for i, (_, _, hyp_rows) in enumerate(best):
+            hyp_rows = hyp_rows[:num_steps]
+            rows[i, :len(hyp_rows)] = hyp_rows
+        return codes, latent_steps[offsets + rows]
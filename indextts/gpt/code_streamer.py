@@ -0,0 +1,82 @@
+import queue
+import threading
+
+import torch
+from transformers.generation.stopping_criteria import StoppingCriteria
+from transformers.generation.streamers import BaseStreamer
+
+
+class MelCodeStreamer(BaseStreamer):
+    """
+    Streamer for `UnifiedVoice.inference_speech(..., streamer=...)` that hands the generated mel codes to
+    another thread as soon as they are sampled.
+
+    `generate()` runs in a producer thread and calls `put()`/`end()`; the consumer iterates over the streamer
+    and receives one code (int) per decoding step. Only batch size 1 without beam search is supported, as
+    for every `transformers` streamer.
+    """
+
+    _END = object()
+
+    def __init__(self, timeout=None):
+        self.queue = queue.Queue()
+        self.timeout = timeout
+        self._prompt_skipped = False
+
+    def put(self, value):
+        # the first call receives the prompt `input_ids` of `generate()`
+        if not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+        if value.dim() > 1 and value.shape[0] > 1:
+            raise ValueError("MelCodeStreamer only supports batch size 1")
+        self.queue.put(int(value.reshape(-1)[0]))
+
+    def end(self):
+        self.queue.put(self._END)
+
+    def error(self, exc):
+        """
+        Forward an exception raised in the producer thread to the consumer.
+        """
+        self.queue.put(exc)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.queue.get(timeout=self.timeout)
+        if value is self._END:
+            raise StopIteration()
+        if isinstance(value, BaseException):
+            raise value
+        return value
+
+
+class EventStoppingCriteria(StoppingCriteria):
+    """
+    Stop `generate()` once `event` is set, e.g. when the consumer of a `MelCodeStreamer` is cancelled.
+    """
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class SilenceStoppingCriteria(StoppingCriteria):
+    """
+    Stop the rows of `generate()` whose last `max_consecutive` codes are all `silent_token`: a segment that keeps
+    generating silence instead of the stop token (a runaway generation) would otherwise run to `max_mel_tokens`.
+    The silence is cut to a short pause afterwards by `remove_long_silence()`.
+    """
+
+    def __init__(self, silent_token=52, max_consecutive=60):
+        self.silent_token = silent_token
+        self.max_consecutive = max_consecutive
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if input_ids.shape[1] < self.max_consecutive:
+            return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        return (input_ids[:, -self.max_consecutive:] == self.silent_token).all(dim=1)
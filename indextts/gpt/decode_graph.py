@@ -0,0 +1,149 @@
+import torch
+
+from indextts.gpt.kv_cache import StaticKVCache
+
+
+class _InPlaceKV:
+    """
+    KV cache of a captured decode step: writes the keys/values of the step at `cache_position` into fixed views
+    of the `StaticKVCache` buffers, without its host-side bookkeeping (done by `DecodeStep.replay()`).
+    """
+
+    def __init__(self, cache, batch_size):
+        self.key_cache = [k[:batch_size] for k in cache.key_cache]
+        self.value_cache = [v[:batch_size] for v in cache.value_cache]
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        cache_position = cache_kwargs["cache_position"]
+        k_out, v_out = self.key_cache[layer_idx], self.value_cache[layer_idx]
+        k_out.index_copy_(2, cache_position, key_states.to(k_out.dtype))
+        v_out.index_copy_(2, cache_position, value_states.to(v_out.dtype))
+        return k_out, v_out
+
+
+class DecodeStep:
+    """
+    The single-token decode step of `GPT2InferenceModel` for a fixed batch size, on static input/output buffers:
+    captured once in a CUDA graph (CUDA) or compiled by `torch.compile` (other devices), then replayed.
+    """
+
+    def __init__(self, model, cache, batch_size, mode):
+        self.model = model
+        self.cache = cache
+        self.batch_size = batch_size
+        device = cache.key_cache[0].device
+        self.dtype = cache.key_cache[0].dtype
+        self.input_ids = torch.zeros(batch_size, 1, dtype=torch.long, device=device)
+        self.position = torch.zeros(1, dtype=torch.long, device=device)
+        self.cache_position = torch.zeros(1, dtype=torch.long, device=device)
+        # additive attention mask over the whole cache: left padding and unwritten positions are masked
+        self.mask = torch.zeros(batch_size, 1, 1, cache.max_cache_len, dtype=self.dtype, device=device)
+        self._kv = _InPlaceKV(cache, batch_size)
+        self.graph = None
+        self.outputs = None
+        if mode == "cuda_graph":
+            self._step = self._forward
+            self._capture()
+        else:
+            self._step = torch.compile(self._forward, dynamic=False)
+            for _ in range(2):
+                self._step()
+
+    def _forward(self):
+        model = self.model
+        transformer = model.transformer
+        emb = model.embeddings(self.input_ids) + model.text_pos_embedding.emb(self.position).unsqueeze(0)
+        hidden_states = transformer.drop(emb.to(self.dtype))
+        for block in transformer.h:
+            hidden_states = block(hidden_states, past_key_value=self._kv, cache_position=self.cache_position,
+                                  attention_mask=self.mask, use_cache=True)[0]
+        latents = model.final_norm(transformer.ln_f(hidden_states))
+        return model.lm_head[-1](latents), latents
+
+    def _capture(self):
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            # warm up the kernels (cuBLAS workspaces, autotuning) outside of the capture
+            for _ in range(2):
+                self._forward()
+        torch.cuda.current_stream().wait_stream(stream)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.outputs = self._forward()
+
+    def replay(self, input_ids, position, attention_mask):
+        """
+        Run the step for `input_ids` (b, 1), b <= `batch_size`, fed at mel `position` after the tokens of
+        `attention_mask` (b, n), and advance the cache.
+        Returns:
+            logits: (b, 1, vocab)
+            latents: (b, 1, dim) final-norm hidden states
+        """
+        b, n = attention_mask.shape
+        cache = self.cache
+        if n > cache.max_cache_len:
+            raise ValueError(f"static KV cache overflow: {n} tokens > max_cache_len {cache.max_cache_len}")
+        self.input_ids[:b].copy_(input_ids)
+        self.position.fill_(position)
+        self.cache_position.fill_(n - 1)
+        self.mask.fill_(torch.finfo(self.dtype).min)
+        self.mask[:b, 0, 0, :n].masked_fill_(attention_mask.bool(), 0.0)
+        # the unused rows attend to everything, so they don't produce NaNs
+        self.mask[b:] = 0.0
+        if self.graph is not None:
+            self.graph.replay()
+            logits, latents = self.outputs
+        else:
+            logits, latents = self._step()
+        cache._seen_tokens = n
+        # the outputs are overwritten by the next replay
+        return logits[:b].clone(), latents[:b].clone()
+
+
+class DecodeGraphs:
+    """
+    Captured decode steps of `GPT2InferenceModel` for a few batch-size buckets, sharing one `StaticKVCache` sized
+    for the largest bucket. A batch of b rows is decoded by the step of the smallest bucket >= b, the spare rows are
+    computed and discarded. The KV cache of larger batches, or of another device/dtype, is not this cache, and
+    their steps run eagerly.
+    """
+
+    def __init__(self, model, buckets=(1,), device=None, dtype=None, mode=None):
+        """
+        Args:
+            model: `GPT2InferenceModel` with `static_kv_cache`
+            buckets: batch sizes of the captured steps
+            device, dtype: of the KV cache, those of the model parameters by default
+            mode: "cuda_graph" or "compile", by default CUDA graphs on CUDA and `torch.compile` elsewhere
+        """
+        param = next(model.parameters())
+        device = torch.device(device) if device is not None else param.device
+        dtype = dtype or param.dtype
+        mode = mode or ("cuda_graph" if device.type == "cuda" else "compile")
+        self.buckets = sorted(set(buckets))
+        self.cache = StaticKVCache(model.config, max_batch_size=self.buckets[-1], max_cache_len=model.max_cache_len,
+                                   device=device, dtype=dtype)
+        self.steps = {}
+        with torch.no_grad():
+            for batch_size in self.buckets:
+                self.steps[batch_size] = DecodeStep(model, self.cache, batch_size, mode)
+        self.cache.reset()
+
+    def cache_for(self, batch_size, device, dtype):
+        """
+        The shared `StaticKVCache` rewound for `batch_size` rows, None if no bucket fits.
+        """
+        key = self.cache.key_cache[0]
+        if batch_size > self.buckets[-1] or key.device != device or key.dtype != dtype:
+            return None
+        self.cache.reset(batch_size)
+        return self.cache
+
+    def step_for(self, cache):
+        """
+        The captured step of the rows of `cache`, None if it is not the shared cache.
+        """
+        if cache is not self.cache:
+            return None
+        return self.steps[next(b for b in self.buckets if b >= cache.active_batch_size)]
@@ -0,0 +1,449 @@
+import threading
+from concurrent.futures import Future
+from typing import List
+
+import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+from transformers.cache_utils import DynamicCache
+
+from indextts.gpt.paged_kv_cache import GatherWorkspace, KVPagePool, KVPoolExhausted, PagedKVCache
+
+
+class _Sequence:
+    """
+    One generation request of `DecodeScheduler`, from its admission to the stop token.
+    """
+
+    def __init__(self, future, conds_latent, text_inputs, max_new_tokens, do_sample, temperature, top_k, top_p,
+                 repetition_penalty, return_latent=False, max_silent_tokens=0, silent_token=52, prefix_key=None):
+        self.future = future
+        self.conds_latent = conds_latent
+        self.text_inputs = text_inputs
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.return_latent = return_latent
+        self.max_silent_tokens = max_silent_tokens
+        self.silent_token = silent_token
+        self.prefix_key = prefix_key
+        self.silent_run = 0  # number of trailing `silent_token` codes
+        self.codes = []
+        self.latents = []  # final-norm hidden state of every code, when `return_latent`
+        self.started = False
+        self.seq_id = None  # sequence of the `KVPagePool`
+
+
+class DecodeScheduler:
+    """
+    Continuous batching of the GPT decoding of concurrent requests.
+
+    Every call of `submit()` adds one text segment to a queue. A background thread decodes all the active
+    segments together, one token of each at every step: a segment leaves the batch as soon as it samples
+    `stop_mel_token` (or reaches its length limit), and the queued segments are admitted at the next step,
+    without waiting for the rest of the batch to finish.
+
+    The prompt of a new segment ([cond][text][start_mel], from `prepare_gpt_inputs()`) is prefilled on its own
+    (only [text][start_mel] when the GPT has a prefix cache and the segment a `prefix_key`, see
+    `UnifiedVoice.get_conditioning_prefix()`) and its KV cache is merged into the running batch. Rows are
+    right-aligned and left-padded, which is possible because the GPT has no position embedding inside the
+    transformer: the mel positions are added to the input embeddings of each row.
+
+    With a `KVPagePool`, each segment keeps its KV cache in its own pages instead, and no padding is stored.
+    Segments are admitted as long as the pool has pages for their prompt, and grow one page at a time; when
+    the pool runs out, the most recently admitted segment is preempted: its pages are freed and it is queued
+    again, to be decoded from the start.
+
+    Sampling follows `generate()` (repetition penalty over the prompt and the generated codes, then temperature,
+    top-k and top-p), with the parameters of each request, so a greedy request gives the same codes as
+    `UnifiedVoice.inference_speech(..., num_beams=1, do_sample=False)`.
+    """
+
+    def __init__(self, gpt, max_batch_size=8, dtype=None, kv_pool: KVPagePool = None):
+        """
+        Args:
+            gpt: `UnifiedVoice` after `post_init_gpt2_config()`.
+            max_batch_size: maximum number of segments decoded together.
+            dtype: autocast dtype of the decoding thread (autocast is thread-local), None for no autocast.
+            kv_pool: keep the KV cache of the segments in this pool, see `KVPagePool`.
+        """
+        self.gpt = gpt
+        self.max_batch_size = max_batch_size
+        self.dtype = dtype
+        self.kv_pool = kv_pool
+        self.stats = {"steps": 0, "tokens": 0, "requests": 0, "preempted": 0}
+        # keys/values gathered from the pages at each step, see `PagedKVCache`
+        self._workspace = GatherWorkspace() if kv_pool is not None else None
+
+        self._pending: List[_Sequence] = []
+        self._rows: List[_Sequence] = []
+        self._past = None  # [(k, v)] per layer, (b, heads, s, head_dim)
+        self._mask = None  # (b, s)
+        self._tokens = None  # (b,) last sampled code of each row, fed at the next step
+        self._positions = None  # (b,) mel position of `_tokens`
+        self._seen = None  # (b, vocab) codes for the repetition penalty
+        self._params = None
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+
+    @property
+    def num_active(self):
+        return len(self._rows)
+
+    @property
+    def num_pending(self):
+        return len(self._pending)
+
+    def submit(self, text_inputs, speech_conditioning_latent, emo_vec, max_generate_length=None, do_sample=True,
+               top_p=0.8, top_k=30, temperature=0.8, repetition_penalty=10.0, return_latent=False,
+               max_silent_tokens=0, silent_token=52, prefix_key=None) -> Future:
+        """
+        Queue one segment for decoding.
+        Args:
+            text_inputs: (1, L) text tokens
+            speech_conditioning_latent: (1, 32, dim) output of `get_conditioning()`
+            emo_vec: (1, dim) emotion vector
+            max_generate_length: limit the number of generated tokens (`max_mel_tokens - 1` by default)
+            return_latent: also return the GPT latents of the codes, see `UnifiedVoice.inference_speech()`
+            max_silent_tokens: if > 0, stop the segment after this many consecutive `silent_token` codes, as
+                `SilenceStoppingCriteria` does for `generate()`
+            prefix_key: key of the conditioning in `gpt.prefix_cache`, see `UnifiedVoice.get_conditioning_prefix()`
+        Returns:
+            a future of the generated codes (1, n), ending with `stop_mel_token` unless the length limit was hit,
+            or of (codes, latent (1, n, dim)) with `return_latent`
+        """
+        if self._closed:
+            raise RuntimeError("DecodeScheduler is closed")
+        gpt = self.gpt
+        with torch.no_grad():
+            conds_latent = gpt.get_conds_latent(speech_conditioning_latent, emo_vec)
+        max_new_tokens = gpt.max_mel_tokens - 1 if max_generate_length is None else max_generate_length
+        future = Future()
+        seq = _Sequence(future, conds_latent, text_inputs.reshape(-1), max_new_tokens, do_sample,
+                        temperature if do_sample else 1.0, top_k if do_sample and top_k else 0,
+                        top_p if do_sample and top_p is not None else 1.0, repetition_penalty or 1.0, return_latent,
+                        max_silent_tokens, silent_token, prefix_key)
+        with self._cond:
+            self._pending.append(seq)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="DecodeScheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def generate(self, text_inputs, speech_conditioning_latent, emo_vec, **kwargs):
+        """
+        Blocking `submit()`.
+        """
+        return self.submit(text_inputs, speech_conditioning_latent, emo_vec, **kwargs).result()
+
+    def close(self):
+        """
+        Stop the decoding thread; segments that are still queued or active are cancelled.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._pending and not self._rows:
+                    self._cond.wait()
+                if self._closed:
+                    break
+            try:
+                self.step()
+            except BaseException as e:
+                self._fail(e)
+        self._fail(RuntimeError("DecodeScheduler is closed"))
+
+    def _fail(self, exc):
+        with self._cond:
+            seqs = self._pending + self._rows
+            self._pending = []
+        self._rows = []
+        self._past = self._mask = self._tokens = self._positions = self._seen = None
+        self._params = None
+        for seq in seqs:
+            if seq.seq_id is not None:
+                self.kv_pool.free(seq.seq_id)
+                seq.seq_id = None
+        for seq in seqs:
+            if not seq.future.done():
+                seq.future.set_exception(exc)
+
+    @torch.no_grad()
+    def step(self):
+        """
+        Admit the queued segments that fit in the batch, then decode one token of every active segment.
+        Called by the decoding thread; can also be called directly when the thread is not started.
+        """
+        device_type = self.gpt.mel_head.weight.device.type
+        with torch.amp.autocast(device_type, enabled=self.dtype is not None, dtype=self.dtype):
+            with self._cond:
+                admitted = self._admit()
+            if admitted:
+                try:
+                    self._prefill(admitted)
+                except BaseException as e:
+                    for seq in admitted:
+                        if seq.seq_id is not None and seq not in self._rows:
+                            self.kv_pool.free(seq.seq_id)
+                            seq.seq_id = None
+                        if not seq.future.done():
+                            seq.future.set_exception(e)
+                    raise
+            if self._rows:
+                self._decode()
+
+    def _admit(self):
+        """
+        Pop the queued segments that fit in the batch and, with a `KVPagePool`, in the free pages.
+        """
+        admitted = []
+        spare_pages = None
+        if self.kv_pool is not None:
+            # keep a page per running segment, so that they can all grow at the next step
+            spare_pages = len(self.kv_pool.free_pages) - len(self._rows)
+        while self._pending and len(self._rows) + len(admitted) < self.max_batch_size:
+            seq = self._pending[0]
+            if spare_pages is not None:
+                # [cond][start_text, text, stop_text][start_mel] and the first generated code
+                pages = self.kv_pool.pages_needed(seq.conds_latent.shape[1] + seq.text_inputs.shape[0] + 4)
+                if pages + 1 > spare_pages and (self._rows or admitted):
+                    break
+                spare_pages -= pages + 1
+            self._pending.pop(0)
+            if seq.started or seq.future.set_running_or_notify_cancel():
+                seq.started = True
+                admitted.append(seq)
+        return admitted
+
+    def _prefill(self, seqs):
+        gpt = self.gpt
+        device = seqs[0].text_inputs.device
+        text_inputs = pad_sequence([seq.text_inputs for seq in seqs], batch_first=True,
+                                   padding_value=gpt.stop_text_token)
+        conds_latent = torch.cat([seq.conds_latent for seq in seqs], dim=0)
+        prefixes = None
+        if gpt.prefix_cache is not None and all(seq.prefix_key is not None for seq in seqs):
+            prefixes = [gpt.get_conditioning_prefix(seq.conds_latent, seq.prefix_key) for seq in seqs]
+        if prefixes is not None:
+            # the keys/values of [cond] are cached, only prefill [pad][text][start_mel] after them: the GPT has no
+            # position embedding inside the transformer, so the padding may sit between the two
+            fake_inputs, mel_emb, text_mask = gpt.prepare_gpt_inputs(conds_latent[:, :0], text_inputs)
+            prefix_len = prefixes[0].length
+            cache = DynamicCache.from_legacy_cache(tuple(
+                tuple(torch.cat([prefix.past[layer_idx][j] for prefix in prefixes]) for j in range(2))
+                for layer_idx in range(len(prefixes[0].past))))
+            attention_mask = torch.cat([torch.ones_like(text_mask[:, :1]).expand(-1, prefix_len), text_mask], dim=1)
+        else:
+            fake_inputs, mel_emb, attention_mask = gpt.prepare_gpt_inputs(conds_latent, text_inputs)
+            prefix_len = 0
+            cache = DynamicCache()
+        start_emb = gpt.mel_embedding(fake_inputs[:, -1:]) + gpt.mel_pos_embedding.emb(
+            torch.zeros(1, dtype=torch.long, device=device))
+        emb = torch.cat([mel_emb, start_emb.to(mel_emb.dtype)], dim=1)
+        logits, latents, cache = self._forward(emb, attention_mask, cache)
+        past = list(zip(cache.key_cache, cache.value_cache))
+        if self.kv_pool is not None:
+            # move the prompts to the pool without their padding, sharing the pages of the cached prefixes
+            pool = self.kv_pool
+            for i, seq in enumerate(seqs):
+                if prefixes is not None:
+                    seq.seq_id = pool.fork(prefixes[i].pool_sequence(pool))
+                else:
+                    seq.seq_id = pool.new_sequence()
+                start = prefix_len + int((attention_mask[i, prefix_len:] == 0).sum())
+                length = prefix_len + attention_mask.shape[1] - start
+                pool.reserve(seq.seq_id, length)
+                for layer_idx, (key, value) in enumerate(past):
+                    pool.write(seq.seq_id, layer_idx, key[i, :, start:], value[i, :, start:], start=prefix_len)
+                pool.seq_lens[seq.seq_id] = length
+            past = attention_mask = None
+
+        seen = torch.zeros(len(seqs), logits.shape[-1], dtype=torch.bool, device=device)
+        seen.scatter_(1, fake_inputs, True)
+        self._add_rows(seqs, past, attention_mask, seen)
+        # the first generated code is fed at mel position 2, as in `GPT2InferenceModel.forward()`, or at the
+        # position 1 of the teacher-forced `UnifiedVoice.forward()` when its latents are returned
+        positions = torch.tensor([1 if seq.return_latent else 2 for seq in seqs], dtype=torch.long, device=device)
+        self._positions = positions if self._positions is None else torch.cat([self._positions, positions])
+        tokens = self._sample(logits, rows=slice(len(self._rows) - len(seqs), None))
+        self._tokens = tokens if self._tokens is None else torch.cat([self._tokens, tokens])
+        self._update(len(self._rows) - len(seqs), tokens, latents)
+
+    def _decode(self):
+        gpt = self.gpt
+        if self.kv_pool is not None:
+            self._reserve_pages()
+            if not self._rows:
+                return
+        emb = gpt.mel_embedding(self._tokens.unsqueeze(1)) + gpt.mel_pos_embedding.emb(self._positions).unsqueeze(1)
+        if self.kv_pool is not None:
+            cache = PagedKVCache(self.kv_pool, [seq.seq_id for seq in self._rows], self._workspace)
+            # the rows are left-aligned in their pages: mask the positions past the length of each row
+            lengths = torch.tensor(cache.lengths, device=emb.device)
+            attention_mask = (torch.arange(int(lengths.max()) + 1, device=emb.device) <= lengths[:, None]).long()
+            logits, latents, _ = self._forward(emb, attention_mask, cache)
+            self.stats["gather_workspace_bytes"] = self._workspace.nbytes
+        else:
+            attention_mask = F.pad(self._mask, (0, 1), value=1)
+            logits, latents, cache = self._forward(emb, attention_mask, DynamicCache.from_legacy_cache(self._past))
+            self._past = list(zip(cache.key_cache, cache.value_cache))
+            self._mask = attention_mask
+        self._positions = self._positions + 1
+        self._tokens = self._sample(logits)
+        self.stats["steps"] += 1
+        self.stats["tokens"] += len(self._rows)
+        self._update(0, self._tokens, latents)
+
+    def _forward(self, emb, attention_mask, cache):
+        inference_model = self.gpt.inference_model
+        outputs = inference_model.transformer(inputs_embeds=emb, attention_mask=attention_mask,
+                                              past_key_values=cache, use_cache=True, return_dict=True)
+        latents = inference_model.final_norm(outputs.last_hidden_state[:, -1])
+        logits = inference_model.lm_head[-1](latents)
+        return logits.float(), latents, outputs.past_key_values
+
+    def _reserve_pages(self):
+        """
+        Make sure every row has a slot for its next token, preempting the latest admitted rows if needed.
+        """
+        pool = self.kv_pool
+        while self._rows:
+            seq_ids = [seq.seq_id for seq in self._rows]
+            if pool.can_reserve(seq_ids, [pool.seq_lens[seq_id] + 1 for seq_id in seq_ids]):
+                break
+            i = len(self._rows) - 1
+            seq = self._rows[i]
+            pool.free(seq.seq_id)
+            seq.seq_id = None
+            if len(self._rows) == 1:
+                # a single segment that doesn't fit would be preempted forever
+                seq.future.set_exception(KVPoolExhausted(
+                    f"KV page pool too small for a segment of {len(seq.codes)} codes"))
+            else:
+                seq.codes = []
+                seq.latents = []
+                seq.silent_run = 0
+                with self._cond:
+                    self._pending.insert(0, seq)
+                self.stats["preempted"] += 1
+            self._select_rows([j for j in range(len(self._rows)) if j != i])
+        pages_in_use = pool.num_pages - len(pool.free_pages)
+        self.stats["peak_kv_pages"] = max(self.stats.get("peak_kv_pages", 0), pages_in_use)
+
+    def _add_rows(self, seqs, past, attention_mask, seen):
+        self._rows.extend(seqs)
+        self._params = None
+        if self._seen is None:
+            self._past, self._mask, self._seen = past, attention_mask, seen
+            return
+        if self.kv_pool is not None:
+            self._seen = torch.cat([self._seen, seen])
+            return
+        # right-align the running rows and the new rows, left-padding the shorter ones
+        old_len, new_len = self._mask.shape[1], attention_mask.shape[1]
+        length = max(old_len, new_len)
+        self._past = [
+            tuple(torch.cat([F.pad(old, (0, 0, length - old_len, 0)), F.pad(new, (0, 0, length - new_len, 0))])
+                  for old, new in zip(old_layer, new_layer))
+            for old_layer, new_layer in zip(self._past, past)
+        ]
+        self._mask = torch.cat([F.pad(self._mask, (length - old_len, 0)), F.pad(attention_mask, (length - new_len, 0))])
+        self._seen = torch.cat([self._seen, seen])
+
+    def _update(self, first_row, tokens, latents):
+        """
+        Record the codes sampled for the rows from `first_row` on (and their latents), and evict the finished ones.
+        """
+        stop_mel_token = self.gpt.stop_mel_token
+        self._seen[torch.arange(first_row, len(self._rows), device=tokens.device), tokens] = True
+        finished = []
+        for i, code in enumerate(tokens.tolist(), start=first_row):
+            seq = self._rows[i]
+            seq.codes.append(code)
+            if seq.return_latent:
+                seq.latents.append(latents[i - first_row])
+            seq.silent_run = seq.silent_run + 1 if code == seq.silent_token else 0
+            if code == stop_mel_token or len(seq.codes) >= seq.max_new_tokens \
+                    or 0 < seq.max_silent_tokens <= seq.silent_run:
+                finished.append(i)
+        if not finished:
+            return
+        for i in finished:
+            seq = self._rows[i]
+            if seq.seq_id is not None:
+                self.kv_pool.free(seq.seq_id)
+                seq.seq_id = None
+            codes = torch.tensor([seq.codes], dtype=torch.long, device=tokens.device)
+            seq.future.set_result((codes, torch.stack(seq.latents).unsqueeze(0)) if seq.return_latent else codes)
+            self.stats["requests"] += 1
+        self._select_rows([i for i in range(len(self._rows)) if i not in set(finished)])
+
+    def _select_rows(self, keep):
+        """
+        Keep only the rows `keep` of the batch.
+        """
+        self._rows = [self._rows[i] for i in keep]
+        self._params = None
+        if not keep:
+            self._past = self._mask = self._tokens = self._positions = self._seen = None
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self._seen.device)
+        if self._past is not None:
+            mask = self._mask.index_select(0, index)
+            # drop the columns that are padding for every remaining row
+            start = int(mask.any(dim=0).long().argmax())
+            self._mask = mask[:, start:]
+            self._past = [tuple(t.index_select(0, index)[:, :, start:] for t in layer) for layer in self._past]
+        self._seen = self._seen.index_select(0, index)
+        self._positions = self._positions.index_select(0, index)
+        self._tokens = self._tokens.index_select(0, index)
+
+    def _sampling_params(self, device):
+        if self._params is None:
+            rows = self._rows
+            self._params = {
+                "do_sample": torch.tensor([seq.do_sample for seq in rows], dtype=torch.bool, device=device),
+                "temperature": torch.tensor([seq.temperature for seq in rows], dtype=torch.float, device=device),
+                "top_k": torch.tensor([seq.top_k for seq in rows], dtype=torch.long, device=device),
+                "top_p": torch.tensor([seq.top_p for seq in rows], dtype=torch.float, device=device),
+                "repetition_penalty": torch.tensor([seq.repetition_penalty for seq in rows], dtype=torch.float,
+                                                   device=device),
+            }
+        return self._params
+
+    def _sample(self, logits, rows=slice(None)):
+        params = {name: value[rows] for name, value in self._sampling_params(logits.device).items()}
+        scores = logits
+        penalty = params["repetition_penalty"].unsqueeze(1)
+        penalized = torch.where(scores < 0, scores * penalty, scores / penalty)
+        scores = torch.where(self._seen[rows], penalized, scores)
+        greedy = scores.argmax(dim=-1)
+        if not params["do_sample"].any():
+            return greedy
+
+        scores = scores / params["temperature"].unsqueeze(1)
+        top_k = params["top_k"].clamp(max=scores.shape[-1])
+        max_k = int(top_k.max())
+        if max_k > 0:
+            kth = torch.topk(scores, max_k, dim=-1).values.gather(1, (top_k - 1).clamp(min=0).unsqueeze(1))
+            scores = scores.masked_fill((scores < kth) & (top_k > 0).unsqueeze(1), -float("inf"))
+        sorted_scores, sorted_indices = torch.sort(scores, descending=False)
+        cumulative_probs = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+        sorted_to_remove = cumulative_probs <= (1 - params["top_p"]).unsqueeze(1)
+        sorted_to_remove[:, -1] = False
+        scores = scores.masked_fill(sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove), -float("inf"))
+        sampled = torch.multinomial(scores.softmax(dim=-1), num_samples=1).squeeze(1)
+        return torch.where(params["do_sample"], sampled, greedy)
@@ -0,0 +1,140 @@
+import math
+
+import torch
+from transformers.generation.logits_process import (RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper,
+                                                    TopKLogitsWarper, TopPLogitsWarper)
+
+
+class FusedSampler:
+    """
+    Repetition penalty, temperature, top-k and top-p sampling of the next mel code in a few passes over
+    preallocated buffers, a drop-in for the `generate()` logits processors of the same parameters.
+    `configure()` takes the parameters from the processors of a `generate()` call, and refuses the calls with any
+    other processor. The buffers are kept from call to call and only grow with the batch size.
+
+    The penalty comes from a per-row token-count histogram updated with the sampled codes instead of a gather/scatter
+    over the whole `input_ids` at every step. A penalized logit `l` is `l / p` when positive and `l * p` when
+    negative, i.e. `l * a + |l| * c` with `a = (1/p + p) / 2` and `c = (1/p - p) / 2`; `a` and `c` are kept in
+    buffers (1 and 0 for the unseen codes), so the penalty costs one `abs` and one `addcmul`. Top-k is taken first
+    and the temperature, softmax and top-p only run on the `top_k` candidates, which gives the same distribution as
+    the processors applied to the whole vocabulary.
+    """
+
+    def __init__(self, do_sample=True, top_p=None, top_k=None, temperature=None, repetition_penalty=None):
+        self.set_params(do_sample, top_p, top_k, temperature, repetition_penalty)
+        self.counts = None  # (b, vocab) number of occurrences of each code in the rows
+        self._scale = None
+        self._abs_scale = None
+        self._scores = None
+        self._abs = None
+        self._rows = None
+        self._buffers = None  # (counts, scale, abs_scale, scores, abs) of the largest batch so far
+
+    def set_params(self, do_sample=True, top_p=None, top_k=None, temperature=None, repetition_penalty=None):
+        self.do_sample = do_sample
+        self.top_p = top_p if do_sample and top_p is not None else 1.0
+        self.top_k = top_k if do_sample and top_k else 0
+        self.temperature = temperature if do_sample and temperature else 1.0
+        penalty = repetition_penalty or 1.0
+        self.penalty = penalty
+        self.seen_scale = (1 / penalty + penalty) / 2
+        self.seen_abs_scale = (1 / penalty - penalty) / 2
+
+    def configure(self, logits_processor, do_sample):
+        """
+        Take the parameters of the `generate()` processors `logits_processor`, built for `do_sample`.
+        Returns False, leaving the sampler unchanged, unless the list holds nothing but a repetition penalty
+        followed by the temperature, top-k and top-p warpers (each optional), with the options of `generate()`.
+        """
+        params = {"penalty": 1.0, "temperature": 1.0, "top_k": 0, "top_p": 1.0}
+        warpers = {TemperatureLogitsWarper: "temperature", TopKLogitsWarper: "top_k", TopPLogitsWarper: "top_p"}
+        seen = set()
+        for i, processor in enumerate(logits_processor):
+            kind = type(processor)
+            if kind in seen:
+                return False
+            seen.add(kind)
+            if kind is RepetitionPenaltyLogitsProcessor:
+                if i > 0 or getattr(processor, "prompt_ignore_length", None) is not None:
+                    return False
+                params["penalty"] = processor.penalty
+            elif kind in warpers and do_sample:
+                if getattr(processor, "filter_value", -math.inf) != -math.inf \
+                        or getattr(processor, "min_tokens_to_keep", 1) != 1:
+                    return False
+                params[warpers[kind]] = getattr(processor, warpers[kind])
+            else:
+                return False
+        self.set_params(do_sample, params["top_p"], params["top_k"], params["temperature"], params["penalty"])
+        return True
+
+    def reset(self, input_ids, vocab_size):
+        """
+        Start the rows of `input_ids` (b, s), the prompt ids of `generate()`.
+        """
+        b = input_ids.shape[0]
+        device = input_ids.device
+        buffers = self._buffers
+        if buffers is None or buffers[0].shape[0] < b or buffers[0].shape[1] != vocab_size \
+                or buffers[0].device != device:
+            buffers = (torch.empty(b, vocab_size, dtype=torch.int32, device=device),
+                       *(torch.empty(b, vocab_size, device=device) for _ in range(4)))
+            self._buffers = buffers
+        self.counts, self._scale, self._abs_scale, self._scores, self._abs = (buffer[:b] for buffer in buffers)
+        self._rows = torch.arange(b, device=device)
+        self.counts.zero_()
+        self._scale.fill_(1.0)
+        self._abs_scale.zero_()
+        self.counts.scatter_add_(1, input_ids, torch.ones_like(input_ids, dtype=torch.int32))
+        seen = self.counts > 0
+        self._scale.masked_fill_(seen, self.seen_scale)
+        self._abs_scale.masked_fill_(seen, self.seen_abs_scale)
+
+    def update(self, tokens):
+        """
+        Add the codes `tokens` (b,) to the rows.
+        """
+        rows = self._rows if self._rows is not None and self._rows.shape[0] == tokens.shape[0] \
+            else torch.arange(tokens.shape[0], device=tokens.device)
+        self.counts[rows, tokens] += 1
+        self._scale[rows, tokens] = self.seen_scale
+        self._abs_scale[rows, tokens] = self.seen_abs_scale
+
+    def penalize(self, logits):
+        """
+        Logits (b, vocab) with the repetition penalty of the codes seen by each row, in a reused buffer.
+        """
+        if self.penalty == 1.0:
+            return logits
+        torch.abs(logits, out=self._abs)
+        torch.mul(logits, self._scale, out=self._scores)
+        return self._scores.addcmul_(self._abs, self._abs_scale)
+
+    def candidates(self, logits):
+        """
+        The sampling distribution over the candidates of each row.
+        Returns:
+            probs: (b, k) unnormalized probabilities, 0 for the candidates removed by top-p
+            indices: (b, k) codes of the candidates
+        """
+        scores = self.penalize(logits)
+        k = self.top_k if 0 < self.top_k < scores.shape[-1] else scores.shape[-1]
+        values, indices = torch.topk(scores, k, dim=-1)
+        probs = values.div_(self.temperature).softmax(dim=-1)
+        if self.top_p < 1.0:
+            # the candidates whose higher-scored ones already reach `top_p` are removed, the first one never is
+            cumulative = probs.cumsum(dim=-1).sub_(probs)
+            probs = probs.masked_fill_(cumulative >= self.top_p, 0.0)
+        return probs, indices
+
+    def __call__(self, logits):
+        """
+        Next codes (b,) of the rows for their `logits` (b, vocab), added to the rows.
+        """
+        if self.do_sample:
+            probs, indices = self.candidates(logits)
+            tokens = indices.gather(1, torch.multinomial(probs, 1)).squeeze(1)
+        else:
+            tokens = self.penalize(logits).argmax(dim=-1)
+        self.update(tokens)
+        return tokens
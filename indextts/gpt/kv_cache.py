@@ -0,0 +1,70 @@
+import torch
+from transformers.cache_utils import StaticCache
+
+
+class StaticKVCache(StaticCache):
+    """
+    Preallocated KV cache for `GPT2InferenceModel` decoding.
+
+    The key/value buffers of every layer are allocated once with shape
+    `(max_batch_size, heads, max_cache_len, head_dim)`, and each new token is written in place at its
+    position instead of growing the past with `torch.cat`. Attention always runs over the whole buffer
+    (positions that are not written yet are masked out), so the cost of a decode step does not depend
+    on how many tokens have been generated.
+
+    The buffers are reused across `generate()` calls; `reset()` only rewinds the write position.
+    """
+
+    def __init__(self, config, max_batch_size, max_cache_len, device=None, dtype=torch.float32):
+        super().__init__(config, max_batch_size=max_batch_size, max_cache_len=max_cache_len, device=device,
+                         dtype=dtype)
+        self.active_batch_size = max_batch_size
+        self._seen_tokens = 0
+
+    def reset(self, batch_size=None):
+        """
+        Start a new sequence for `batch_size` rows (<= `max_batch_size`).
+        Stale entries are not cleared, they are masked by the causal mask until overwritten.
+        """
+        batch_size = self.max_batch_size if batch_size is None else batch_size
+        if batch_size > self.max_batch_size:
+            raise ValueError(f"batch size {batch_size} exceeds the cache capacity {self.max_batch_size}")
+        self.active_batch_size = batch_size
+        self._seen_tokens = 0
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        """
+        Write `key_states`/`value_states` of shape (b, heads, s, head_dim) in place, at `cache_position`
+        (or right after the tokens seen so far), and return the full buffers of the active batch.
+        """
+        k_out = self.key_cache[layer_idx][:self.active_batch_size]
+        v_out = self.value_cache[layer_idx][:self.active_batch_size]
+        seq_len = key_states.shape[-2]
+        cache_position = cache_kwargs.get("cache_position") if cache_kwargs is not None else None
+        if cache_position is None:
+            # `_seen_tokens` already counts these tokens after the first layer
+            start = self._seen_tokens if layer_idx == 0 else self._seen_tokens - seq_len
+            cache_position = torch.arange(start, start + seq_len, device=k_out.device)
+        if layer_idx == 0:
+            if self._seen_tokens + seq_len > self.max_cache_len:
+                raise ValueError(
+                    f"static KV cache overflow: {self._seen_tokens + seq_len} tokens > max_cache_len {self.max_cache_len}"
+                )
+            self._seen_tokens += seq_len
+        k_out.index_copy_(2, cache_position, key_states.to(k_out.dtype))
+        v_out.index_copy_(2, cache_position, value_states.to(v_out.dtype))
+        return k_out, v_out
+
+    def get_seq_length(self, layer_idx=0):
+        # tracked on the host, avoids the device sync of `StaticCache.get_seq_length()`
+        return self._seen_tokens
+
+    def reorder_cache(self, beam_idx):
+        """
+        Reorder the written part of the cache for beam search, in place, so the buffers keep their addresses.
+        """
+        seen = self._seen_tokens
+        for layer_idx in range(len(self.key_cache)):
+            for cache in (self.key_cache[layer_idx], self.value_cache[layer_idx]):
+                filled = cache[:self.active_batch_size, :, :seen]
+                filled.copy_(filled.index_select(0, beam_idx.to(cache.device)))
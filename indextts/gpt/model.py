@@ -57,6 +57,8 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.model_parallel = False
         self.device_map = None
         self.cached_mel_emb = None
+        # final-norm hidden states of the decoding steps, see `UnifiedVoice.inference_speech(return_latent=True)`
+        self.latent_steps = None
 
     def parallelize(self, device_map=None):
         self.device_map = (
@@ -155,8 +157,12 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             emb = torch.cat([mel_emb, text_emb], dim=1)
         else:
             emb = self.embeddings(input_ids)
+            # the latents of `UnifiedVoice.forward()` feed the code k at mel position k + 1 (teacher forcing),
+            # while `generate()` feeds it at k + 2: capture the latents at the positions of `forward()`, which
+            # changes the codes decoded after the first one
+            offset = 1 if self.latent_steps is not None else 0
             emb = emb + self.text_pos_embedding.get_fixed_embedding(
-                attention_mask.shape[1] - mel_len, attention_mask.device
+                attention_mask.shape[1] - mel_len - offset, attention_mask.device
             )
         transformer_outputs = self.transformer(
             inputs_embeds=emb,
@@ -182,7 +188,12 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
                 torch.cuda.set_device(self.transformer.first_device)
             hidden_states = hidden_states.to(self.lm_head.weight.device)
 
-        lm_logits = self.lm_head(hidden_states)
+        if self.latent_steps is not None:
+            hidden_states = self.final_norm(hidden_states)
+            self.latent_steps.append(hidden_states[:, -1])
+            lm_logits = self.lm_head[-1](hidden_states)
+        else:
+            lm_logits = self.lm_head(hidden_states)
 
         if not return_dict:
             return (lm_logits,) + transformer_outputs[1:]
@@ -658,7 +669,8 @@ class UnifiedVoice(nn.Module):
         fake_inputs[:, -1] = self.start_mel_token
         return fake_inputs, batched_mel_emb, attention_mask
     def inference_speech(self, speech_conditioning_mel, text_inputs, cond_mel_lengths=None, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, return_latent=False,
+                         **hf_generate_kwargs):
         """
         Args:
             speech_conditioning_mel: (b, n_mels, frames) or (n_mels, frames)
@@ -666,6 +678,11 @@ class UnifiedVoice(nn.Module):
             cond_mel_lengths: lengths of the conditioning mel spectrograms in shape (b,) or (1,)
             input_tokens: additional tokens for generation in shape (b, s) or (s,)
             max_generate_length: limit the number of generated tokens
+            return_latent: also return the latents of the generated codes (b, n, dim), as computed by
+                `forward(..., return_latent=True)` on them, from the hidden states of the decoding steps instead of
+                a second GPT pass. This changes the decoding: the codes are fed at the mel positions of `forward()`,
+                one before those of the default decoding, so the codes after the first one are not those of
+                `return_latent=False`
             hf_generate_kwargs: kwargs for `GPT2InferenceModel.generate(**hf_generate_kwargs)`
         """
         if speech_conditioning_mel.ndim == 2:
@@ -700,14 +717,51 @@ class UnifiedVoice(nn.Module):
             min_tokens_to_keep = 2 if hf_generate_kwargs.get("num_beams", 1) > 1 else 1
             logits_processor.append(TypicalLogitsWarper(mass=typical_mass, min_tokens_to_keep=min_tokens_to_keep))
         max_length = (trunc_index + self.max_mel_tokens - 1) if max_generate_length is None else trunc_index + max_generate_length
-        output = self.inference_model.generate(inputs, 
-                                            bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token,
-                                            eos_token_id=self.stop_mel_token, attention_mask=attention_mask,
-                                            max_length=max_length, logits_processor=logits_processor,
-                                            num_return_sequences=num_return_sequences,
-                                            **hf_generate_kwargs)
+        return_dict = hf_generate_kwargs.pop("return_dict_in_generate", False)
+        if return_latent:
+            self.inference_model.latent_steps = []
+            if hf_generate_kwargs.get("num_beams", 1) > 1:
+                # `generate()` only returns the `beam_indices` of the sequences with their scores
+                hf_generate_kwargs.setdefault("output_scores", True)
+        try:
+            output = self.inference_model.generate(inputs, 
+                                                bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token,
+                                                eos_token_id=self.stop_mel_token, attention_mask=attention_mask,
+                                                max_length=max_length, logits_processor=logits_processor,
+                                                num_return_sequences=num_return_sequences,
+                                                return_dict_in_generate=return_dict or return_latent,
+                                                **hf_generate_kwargs)
+        finally:
+            latent_steps = self.inference_model.latent_steps
+            self.inference_model.latent_steps = None
+        if return_latent:
+            latent = self.gather_latent(latent_steps, getattr(output, "beam_indices", None))
+            latent = latent[:, :output.sequences.shape[1] - trunc_index]
+            if not return_dict:
+                return output.sequences[:, trunc_index:], latent
+            output.sequences = output.sequences[:, trunc_index:]
+            return output, latent
         if isinstance(output, torch.Tensor):
             return output[:, trunc_index:]
         # GenerateOutput
         output.sequences = output.sequences[:, trunc_index:]
         return output
+
+    @staticmethod
+    def gather_latent(latent_steps, beam_indices=None):
+        """
+        Latents of the returned sequences from the hidden states captured at every decoding step.
+        Args:
+            latent_steps: [(rows, dim)] final-norm hidden states of the rows of each step, the state of a step
+                predicts the code generated at that step
+            beam_indices: (b, >= n) row of every generated code, from `generate(return_dict_in_generate=True,
+                output_scores=True)` with beam search, -1 after the end of the sequence; None when the rows are the
+                returned sequences
+        Returns:
+            (b, n, dim)
+        """
+        latent = torch.stack(latent_steps, dim=1)
+        if beam_indices is None:
+            return latent
+        steps = torch.arange(latent.shape[1], device=latent.device)
+        return latent[beam_indices[:, :latent.shape[1]].clamp(min=0).to(latent.device), steps]
@@ -6,6 +6,7 @@ import torch.nn.functional as F
 
 import transformers
 from transformers import GPT2Config, LogitsProcessorList
+from transformers.cache_utils import DynamicCache
 from indextts.gpt.transformers_gpt2 import GPT2PreTrainedModel, GPT2Model
 
 # from transformers import GPT2Config, GPT2PreTrainedModel, LogitsProcessorList
@@ -13,7 +14,14 @@ from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 from transformers.utils.model_parallel_utils import (assert_device_map,
                                                      get_device_map)
 
+from indextts.gpt.beam_search import BeamSearchDecoder
 from indextts.gpt.conformer_encoder import ConformerEncoder
+from indextts.gpt.decode_graph import DecodeGraphs
+from indextts.gpt.fused_sampler import FusedSampler
+from indextts.gpt.kv_cache import StaticKVCache
+from indextts.gpt.paged_kv_cache import GatherWorkspace, PagedKVCache
+from indextts.gpt.prefix_cache import ConditioningPrefix, PrefixKVCache
+from indextts.gpt.speculative import SpeculativeDecoder
 from indextts.gpt.perceiver import PerceiverResampler
 from indextts.utils.arch_util import AttentionBlock
 from indextts.utils.typical_sampling import TypicalLogitsWarper
@@ -43,7 +51,8 @@ class ResBlock(nn.Module):
 
 
 class GPT2InferenceModel(GPT2PreTrainedModel):
-    def __init__(self, config, gpt, text_pos_emb, embeddings, norm, linear, kv_cache=False):
+    def __init__(self, config, gpt, text_pos_emb, embeddings, norm, linear, kv_cache=False, static_kv_cache=False,
+                 max_cache_len=None, kv_pool=None):
         super().__init__(config)
         # Note: the argument named `text_pos_emb` here actually represents the mel position embedding
         self.transformer = gpt
@@ -52,11 +61,28 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         self.final_norm = norm
         self.lm_head = nn.Sequential(norm, linear)
         self.kv_cache = kv_cache
+        # preallocated KV buffers written in place, see `StaticKVCache`
+        self.static_kv_cache = kv_cache and static_kv_cache
+        self.max_cache_len = max_cache_len if max_cache_len is not None else config.n_positions
+        self.static_cache = None
+        # pages of a shared `KVPagePool`, see `PagedKVCache`
+        self.kv_pool = kv_pool if kv_cache else None
+        self.paged_cache = None
+        self.gather_workspace = GatherWorkspace() if self.kv_pool is not None else None
 
         # Model parallel
         self.model_parallel = False
         self.device_map = None
         self.cached_mel_emb = None
+        self.cached_prefix = None
+        # final-norm hidden states of the decoding steps, see `UnifiedVoice.inference_speech(return_latent=True)`
+        self.latent_steps = None
+        # `FusedSampler` of `generate()` without beam search, see `UnifiedVoice.inference_speech(fused_sampler=True)`;
+        # `sampler` is set to `fused_sampler`, whose buffers are kept between the calls, for the calls that use it
+        self.sampler = None
+        self.fused_sampler = FusedSampler()
+        # captured decode steps, see `UnifiedVoice.post_init_gpt2_config(compiled_decode_buckets=...)`
+        self.decode_graphs = None
 
     def parallelize(self, device_map=None):
         self.device_map = (
@@ -84,15 +110,74 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
     def set_output_embeddings(self, new_embeddings):
         self.lm_head = new_embeddings
 
-    def store_mel_emb(self, mel_emb):
+    def store_mel_emb(self, mel_emb, prefix=None):
+        """
+        Args:
+            mel_emb: (b, s, dim) prompt embeddings, from `UnifiedVoice.prepare_gpt_inputs()`
+            prefix: `ConditioningPrefix` of the first positions of `mel_emb`, these are not prefilled again
+        """
         self.cached_mel_emb = mel_emb
+        self.cached_prefix = prefix
+
+    def get_static_cache(self, batch_size, device, dtype):
+        """
+        Return the `StaticKVCache` rewound for a new sequence of `batch_size` rows, (re)allocated only when
+        the batch size, device or dtype doesn't fit the current buffers.
+        """
+        if self.decode_graphs is not None:
+            cache = self.decode_graphs.cache_for(batch_size, device, dtype)
+            if cache is not None:
+                return cache
+        cache = self.static_cache
+        if cache is None or cache.max_batch_size < batch_size \
+                or cache.key_cache[0].device != device or cache.key_cache[0].dtype != dtype:
+            self.static_cache = None
+            cache = StaticKVCache(self.config, max_batch_size=batch_size, max_cache_len=self.max_cache_len,
+                                  device=device, dtype=dtype)
+            self.static_cache = cache
+        cache.reset(batch_size)
+        return cache
+
+    def get_paged_cache(self, batch_size, prefix_seq_id=None):
+        """
+        Return a `PagedKVCache` of `batch_size` new sequences in `self.kv_pool`, releasing the previous one.
+        """
+        self.free_paged_cache()
+        self.paged_cache = PagedKVCache.allocate(self.kv_pool, batch_size, prefix_seq_id, self.gather_workspace)
+        return self.paged_cache
+
+    def get_prefix_cache(self, emb, prefix):
+        """
+        Return a KV cache for the `emb.shape[0]` rows of a new sequence that already holds the keys/values of
+        `prefix`: the pages of the prefix are shared with a `kv_pool`, copied to the static cache, and expanded
+        without copy otherwise.
+        """
+        batch_size = emb.shape[0]
+        if self.kv_pool is not None:
+            return self.get_paged_cache(batch_size, prefix.pool_sequence(self.kv_pool))
+        if self.static_kv_cache:
+            cache = self.get_static_cache(batch_size, emb.device, self._kv_dtype(emb))
+            for layer_idx, (key, value) in enumerate(prefix.expand(batch_size)):
+                cache.update(key, value, layer_idx)
+            return cache
+        return DynamicCache.from_legacy_cache(tuple(prefix.expand(batch_size)))
+
+    @staticmethod
+    def _kv_dtype(emb):
+        device_type = emb.device.type
+        return torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else emb.dtype
+
+    def free_paged_cache(self):
+        if self.paged_cache is not None:
+            self.paged_cache.free()
+            self.paged_cache = None
 
     def prepare_inputs_for_generation(self, input_ids, past_key_values=None, **kwargs):
         token_type_ids = kwargs.get("token_type_ids", None)  # usually None
         if not self.kv_cache:
             past_key_values = None
         # only last token for inputs_ids if past is defined in kwargs
-        if past_key_values:
+        if past_key_values is not None:
             input_ids = input_ids[:, -1].unsqueeze(-1)
             if token_type_ids is not None:
                 token_type_ids = token_type_ids[:, -1].unsqueeze(-1)
@@ -104,7 +189,7 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             # create position_ids on the fly for batch generation
             position_ids = attention_mask.long().cumsum(-1) - 1
             position_ids.masked_fill_(attention_mask == 0, 0)
-            if past_key_values:
+            if past_key_values is not None:
                 position_ids = position_ids[:, -1].unsqueeze(-1)
         else:
             position_ids = None
@@ -153,11 +238,33 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             else:  # this outcome only occurs once per loop in most cases
                 mel_emb = self.cached_mel_emb
             emb = torch.cat([mel_emb, text_emb], dim=1)
+            if self.cached_prefix is not None and self.kv_cache and past_key_values is None \
+                    and use_cache is not False:
+                # the keys/values of the conditioning prefix are cached, only prefill the text and mel positions
+                emb = emb[:, self.cached_prefix.length:]
+                if position_ids is not None:
+                    position_ids = position_ids[:, self.cached_prefix.length:]
+                past_key_values = self.get_prefix_cache(emb, self.cached_prefix)
         else:
+            # the latents of `UnifiedVoice.forward()` feed the code k at mel position k + 1 (teacher forcing),
+            # while `generate()` feeds it at k + 2: capture the latents at the positions of `forward()`, which
+            # changes the codes decoded after the first one
+            offset = 1 if self.latent_steps is not None else 0
+            position = attention_mask.shape[1] - mel_len - offset
+            step = self.decode_graphs.step_for(past_key_values) if self.decode_graphs is not None else None
+            if step is not None:
+                lm_logits, latents = step.replay(input_ids, position, attention_mask)
+                if self.latent_steps is not None:
+                    self.latent_steps.append(latents[:, -1])
+                if not return_dict:
+                    return lm_logits, past_key_values
+                return CausalLMOutputWithCrossAttentions(logits=lm_logits, past_key_values=past_key_values)
             emb = self.embeddings(input_ids)
-            emb = emb + self.text_pos_embedding.get_fixed_embedding(
-                attention_mask.shape[1] - mel_len, attention_mask.device
-            )
+            emb = emb + self.text_pos_embedding.get_fixed_embedding(position, attention_mask.device)
+        if self.kv_pool is not None and past_key_values is None and use_cache is not False:
+            past_key_values = self.get_paged_cache(emb.shape[0])
+        elif self.static_kv_cache and past_key_values is None and use_cache is not False:
+            past_key_values = self.get_static_cache(emb.shape[0], emb.device, self._kv_dtype(emb))
         transformer_outputs = self.transformer(
             inputs_embeds=emb,
             past_key_values=past_key_values,
@@ -182,7 +289,12 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
                 torch.cuda.set_device(self.transformer.first_device)
             hidden_states = hidden_states.to(self.lm_head.weight.device)
 
-        lm_logits = self.lm_head(hidden_states)
+        if self.latent_steps is not None:
+            hidden_states = self.final_norm(hidden_states)
+            self.latent_steps.append(hidden_states[:, -1])
+            lm_logits = self.lm_head[-1](hidden_states)
+        else:
+            lm_logits = self.lm_head(hidden_states)
 
         if not return_dict:
             return (lm_logits,) + transformer_outputs[1:]
@@ -202,7 +314,11 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         This function is used to re-order the :obj:`past_key_values` cache if
         :meth:`~transformers.PreTrainedModel.beam_search` or :meth:`~transformers.PreTrainedModel.beam_sample` is
         called. This is required to match :obj:`past_key_values` with the correct beam_idx at every generation step.
+        A :class:`StaticKVCache` or a :class:`PagedKVCache` is reordered in place.
         """
+        if isinstance(past, (StaticKVCache, PagedKVCache)):
+            past.reorder_cache(beam_idx)
+            return past
         return tuple(
             tuple(
                 past_state.index_select(0, beam_idx.to(past_state.device))
@@ -409,7 +525,21 @@ class UnifiedVoice(nn.Module):
         for module in embeddings:
             module.weight.data.normal_(mean=0.0, std=.02)
 
-    def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=False, half=False):
+    def post_init_gpt2_config(self, use_deepspeed=False, kv_cache=False, half=False, static_kv_cache=False,
+                              kv_pool=None, prefix_cache_size=0, compiled_decode_buckets=()):
+        """
+        Build `self.inference_model` for `inference_speech()`.
+        Args:
+            static_kv_cache: preallocate the KV cache (sized from `max_mel_tokens + max_text_tokens`) and write it
+                in place, instead of growing it at every generated token. Requires `kv_cache`, ignored with DeepSpeed.
+            kv_pool: a `KVPagePool` to keep the KV cache in, page by page, instead of allocating it at every call.
+                Takes precedence over `static_kv_cache`. Requires `kv_cache`, ignored with DeepSpeed.
+            prefix_cache_size: number of conditioning prefixes whose keys/values are kept for reuse, see
+                `get_conditioning_prefix()`. 0 disables it, ignored with DeepSpeed.
+            compiled_decode_buckets: batch sizes whose single-token decode step is captured now (CUDA graph on CUDA,
+                `torch.compile` elsewhere) and replayed while decoding, on a static KV cache; other batch sizes decode
+                eagerly. Implies `static_kv_cache`, ignored with `kv_pool` or DeepSpeed.
+        """
         seq_length = self.max_mel_tokens + self.max_text_tokens + 2
         gpt_config = GPT2Config(
             vocab_size=self.number_mel_codes,
@@ -429,7 +559,12 @@ class UnifiedVoice(nn.Module):
             self.final_norm,
             self.mel_head,
             kv_cache=kv_cache,
+            static_kv_cache=(static_kv_cache or bool(compiled_decode_buckets)) and not use_deepspeed,
+            kv_pool=None if use_deepspeed else kv_pool,
+            # [cond latents][duration x2][start_text, text, stop_text][start_mel, mel...]
+            max_cache_len=self.cond_num + 2 + self.max_text_tokens + 2 + self.max_mel_tokens + 1,
         )
+        self.prefix_cache = PrefixKVCache(prefix_cache_size) if prefix_cache_size > 0 and not use_deepspeed else None
         if use_deepspeed and half and torch.cuda.is_available():
             import deepspeed
             self.ds_engine = deepspeed.init_inference(model=self.inference_model,
@@ -446,6 +581,8 @@ class UnifiedVoice(nn.Module):
             self.inference_model = self.ds_engine.module.eval()
         else:
             self.inference_model = self.inference_model.eval()
+            if compiled_decode_buckets and kv_cache and kv_pool is None:
+                self.inference_model.decode_graphs = DecodeGraphs(self.inference_model, compiled_decode_buckets)
 
         # self.inference_model = PrunedGPT2InferenceModel(gpt_config, self.gpt, self.mel_pos_embedding, self.mel_embedding, self.final_norm, self.mel_head)
         self.gpt.wte = self.mel_embedding
@@ -483,13 +620,14 @@ class UnifiedVoice(nn.Module):
                 text_input_tokens[b, actual_end:] = self.stop_text_token
         return text_input_tokens
 
-    def get_logits(self, speech_conditioning_inputs, first_inputs, first_head, second_inputs=None, second_head=None, get_attns=False, return_latent=False):
+    def get_logits(self, speech_conditioning_inputs, first_inputs, first_head, second_inputs=None, second_head=None, get_attns=False, return_latent=False,
+                   attention_mask=None):
         if second_inputs is not None:
             emb = torch.cat([speech_conditioning_inputs, first_inputs, second_inputs], dim=1)
         else:
             emb = torch.cat([speech_conditioning_inputs, first_inputs], dim=1)
 
-        gpt_out = self.gpt(inputs_embeds=emb, return_dict=True, output_attentions=get_attns)
+        gpt_out = self.gpt(inputs_embeds=emb, attention_mask=attention_mask, return_dict=True, output_attentions=get_attns)
         if get_attns:
             return gpt_out.attentions
 
@@ -551,16 +689,20 @@ class UnifiedVoice(nn.Module):
         return conds.squeeze(1)
 
 
-    def forward(self, speech_conditioning_latent, text_inputs, text_lengths, mel_codes, mel_codes_lengths, emo_speech_conditioning_latent,
-                cond_mel_lengths=None, emo_cond_mel_lengths=None, emo_vec=None, use_speed=None, do_spk_cond=False):
+    def forward(self, speech_conditioning_latent, text_inputs, text_lengths, mel_codes, mel_codes_lengths, emo_speech_conditioning_latent=None,
+                cond_mel_lengths=None, emo_cond_mel_lengths=None, emo_vec=None, use_speed=None, do_spk_cond=False,
+                mask_padding=False):
         """
         Forward pass that uses both text and voice in either text conditioning mode or voice conditioning mode
 
-        speech_conditioning_input: MEL float tensor, (b,1024)
+        speech_conditioning_input: MEL float tensor, (b,1024), or the precomputed `get_conditioning()` latent when `do_spk_cond` is False
         text_inputs: long tensor, (b,t)
         text_lengths: long tensor, (b,)
         mel_inputs:  long tensor, (b,m)
         wav_lengths: long tensor, (b,)
+        emo_vec: precomputed emotion vector, `emo_speech_conditioning_latent` is not needed when it is given
+        mask_padding: mask out the right padding of `text_inputs` and `mel_codes` in attention, so that a padded
+            batch produces the same latents as running every item on its own.
 
         If return_attentions is specified, only logits are returned.
         If return_latent is specified, loss & logits are not computed or returned. Only the predicted latents are returned.
@@ -592,9 +734,55 @@ class UnifiedVoice(nn.Module):
         mel_emb = self.mel_embedding(mel_codes)
         mel_emb = mel_emb + self.mel_pos_embedding(mel_codes)
 
-        text_logits, mel_logits = self.get_logits(conds, text_emb, self.text_head, mel_emb, self.mel_head, get_attns=False, return_latent=True)
+        attention_mask = None
+        if mask_padding:
+            # [cond][start, text, stop][start, mel, stop]; the padding sits between the valid text and mel tokens
+            text_valid = torch.arange(text_emb.shape[1], device=text_emb.device)[None] < (text_lengths[:, None] + 2)
+            mel_valid = torch.arange(mel_emb.shape[1], device=mel_emb.device)[None] < (mel_codes_lengths[:, None] + 2)
+            cond_valid = torch.ones(conds.shape[:2], dtype=torch.bool, device=conds.device)
+            attention_mask = torch.cat([cond_valid, text_valid, mel_valid], dim=1).long()
+
+        text_logits, mel_logits = self.get_logits(conds, text_emb, self.text_head, mel_emb, self.mel_head, get_attns=False, return_latent=True,
+                                                  attention_mask=attention_mask)
         return mel_logits[:, :-2]  # Despite the name, these are not logits. Strip off the two tokens added by this forward pass.
 
+    def get_latent_prefix(self, speech_conditioning_latent, text_inputs, emo_vec):
+        """
+        Keys/values of the [conditioning][start, text, stop] inputs of `forward()`, to compute the latents of a code
+        sequence that grows with `extend_latent()`.
+        Args:
+            speech_conditioning_latent: (b, 32, dim) output of `get_conditioning()`
+            text_inputs: (b, L) unpadded text tokens
+            emo_vec: (b, dim) emotion vector
+        Returns:
+            `DynamicCache`
+        """
+        conds = self.get_conds_latent(speech_conditioning_latent, emo_vec)
+        text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
+        text_inputs, _ = self.build_aligned_inputs_and_targets(text_inputs, self.start_text_token, self.stop_text_token)
+        text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(text_inputs)
+        past_key_values = DynamicCache()
+        self.gpt(inputs_embeds=torch.cat([conds, text_emb], dim=1), past_key_values=past_key_values, use_cache=True,
+                 return_dict=True)
+        return past_key_values
+
+    def extend_latent(self, past_key_values, mel_inputs, position):
+        """
+        Latents of `forward()` for the next mel inputs, appending their keys/values to `past_key_values`.
+        The mel inputs of `forward()` are the `start_mel_token` followed by the codes, and the latent of code k is
+        the output at the input k, so the latents of codes [position, position + n) only need the codes before them.
+        Args:
+            past_key_values: `get_latent_prefix()` cache, extended with the mel inputs [0, position)
+            mel_inputs: (b, n) mel inputs [position, position + n)
+            position: mel position of `mel_inputs[:, 0]`
+        Returns:
+            (b, n, dim) latents of the codes [position, position + n)
+        """
+        positions = torch.arange(position, position + mel_inputs.shape[1], device=mel_inputs.device)
+        emb = self.mel_embedding(mel_inputs) + self.mel_pos_embedding.emb(positions).unsqueeze(0)
+        gpt_out = self.gpt(inputs_embeds=emb, past_key_values=past_key_values, use_cache=True, return_dict=True)
+        return self.final_norm(gpt_out.last_hidden_state)
+
     def prepare_gpt_inputs(
         self,
         conditional_latents: torch.Tensor,
@@ -661,28 +849,47 @@ class UnifiedVoice(nn.Module):
         return fake_inputs, batched_mel_emb, attention_mask
 
     def inference_speech(self, speech_condition, text_inputs, emo_speech_condition=None, cond_lengths=None, emo_cond_lengths=None, emo_vec=None, use_speed=False, input_tokens=None, num_return_sequences=1,
-                         max_generate_length=None, typical_sampling=False, typical_mass=.9, **hf_generate_kwargs):
+                         max_generate_length=None, typical_sampling=False, typical_mass=.9, speech_conditioning_latent=None, return_latent=False,
+                         drafter=None, fused_sampler=False, tree_beam_search=False, prefix_key=None, **hf_generate_kwargs):
         """
         Args:
-            speech_condition: (b, d, frames) or (d, frames)
+            speech_condition: (b, d, frames) or (d, frames), unused when `speech_conditioning_latent` is given
             text_inputs: (b, L)
             cond_mel_lengths: lengths of the conditioning mel spectrograms in shape (b,) or (1,)
+            emo_vec: precomputed emotion vector (b, dim), skips the emotion conditioning encoder
+            speech_conditioning_latent: precomputed `get_conditioning()` output (b, 32, dim), skips the conditioning encoder
             input_tokens: additional tokens for generation in shape (b, s) or (s,)
             max_generate_length: limit the number of generated tokens
+            return_latent: also return the latents of the generated codes (b, n, dim), as computed by `forward()`
+                on them, from the hidden states of the decoding steps instead of a second GPT pass. This changes the
+                decoding: the codes are fed at the mel positions of `forward()`, one before those of the default
+                decoding, so the codes after the first one are not those of `return_latent=False`
+            drafter: `NGramDrafter` or `EarlyExitDrafter` of `indextts.gpt.speculative`, decode with speculative
+                decoding instead of `generate()`; only for a single text without beam search, `drafter.stats` keeps
+                the acceptance rate and the speed
+            fused_sampler: select the codes with a `FusedSampler` instead of the logits processors of `generate()`
+                (same `repetition_penalty`, `temperature`, `top_k` and `top_p`); not used with beam search,
+                `typical_sampling` or any other processor (e.g. from `min_new_tokens`), which keep the processors
+            tree_beam_search: run the beam search (`num_beams` > 1) with a `BeamSearchDecoder`, which prefills the
+                prompt once and shares its keys/values between the beams, instead of `generate()`; only for a
+                single text
+            prefix_key: hashable key of the conditioning (speaker and emotion inputs) of `speech_conditioning_latent`
+                and `emo_vec` in `self.prefix_cache`, see `get_conditioning_prefix()`; the prefix cache is only used
+                when it is given
             hf_generate_kwargs: kwargs for `GPT2InferenceModel.generate(**hf_generate_kwargs)`
         """
 
-        if speech_condition.ndim == 2:
+        if speech_condition is not None and speech_condition.ndim == 2:
             speech_condition = speech_condition.unsqueeze(0)
         if emo_speech_condition is None:
             emo_speech_condition = speech_condition
-        if cond_lengths is None:
-            cond_lengths = torch.tensor([speech_condition.shape[-1]], device=speech_condition.device)
-        if emo_cond_lengths is None:
-            emo_cond_lengths = torch.tensor([emo_speech_condition.shape[-1]], device=speech_condition.device) 
-
-        speech_conditioning_latent = self.get_conditioning(speech_condition.transpose(1,2), cond_lengths)
+        if speech_conditioning_latent is None:
+            if cond_lengths is None:
+                cond_lengths = torch.tensor([speech_condition.shape[-1]], device=speech_condition.device)
+            speech_conditioning_latent = self.get_conditioning(speech_condition.transpose(1,2), cond_lengths)
         if emo_vec is None:
+            if emo_cond_lengths is None:
+                emo_cond_lengths = torch.tensor([emo_speech_condition.shape[-1]], device=emo_speech_condition.device)
             print('compute emo vec')
             emo_vec = self.get_emo_conditioning(emo_speech_condition.transpose(1,2), emo_cond_lengths)
             emo_vec = self.emovec_layer(emo_vec)
@@ -690,12 +897,28 @@ class UnifiedVoice(nn.Module):
         else:
             print('Use the specified emotion vector')
 
-        tmp = torch.zeros(text_inputs.size(0)).to(text_inputs.device)
-        duration_emb =  self.speed_emb(torch.zeros_like(tmp).long())
-        duration_emb_half = self.speed_emb(torch.ones_like(tmp).long())
-        conds_latent = torch.cat((speech_conditioning_latent + emo_vec.unsqueeze(1), duration_emb_half.unsqueeze(1), duration_emb.unsqueeze(1)), 1)
+        # a single conditioning latent is shared by the whole text batch in `prepare_gpt_inputs()`
+        conds_latent = self.get_conds_latent(speech_conditioning_latent, emo_vec)
+        if drafter is not None:
+            return self.inference_speech_speculative(conds_latent, text_inputs, drafter, speech_conditioning_latent,
+                                                     input_tokens=input_tokens,
+                                                     num_return_sequences=num_return_sequences,
+                                                     max_generate_length=max_generate_length,
+                                                     typical_sampling=typical_sampling, return_latent=return_latent,
+                                                     prefix_key=prefix_key, **hf_generate_kwargs)
+        if tree_beam_search and hf_generate_kwargs.get("num_beams", 1) > 1:
+            return self.inference_speech_beam(conds_latent, text_inputs, speech_conditioning_latent,
+                                              input_tokens=input_tokens, num_return_sequences=num_return_sequences,
+                                              max_generate_length=max_generate_length,
+                                              typical_sampling=typical_sampling, return_latent=return_latent,
+                                              prefix_key=prefix_key, **hf_generate_kwargs)
         input_ids, inputs_embeds, attention_mask = self.prepare_gpt_inputs(conds_latent, text_inputs)
-        self.inference_model.store_mel_emb(inputs_embeds)
+        prefix = None
+        if self.prefix_cache is not None and prefix_key is not None and conds_latent.shape[0] == 1 \
+                and bool(attention_mask.all()):
+            # the prompt starts with the conditioning in every row (no left padding)
+            prefix = self.get_conditioning_prefix(conds_latent, prefix_key)
+        self.inference_model.store_mel_emb(inputs_embeds, prefix)
         if input_tokens is None:
             inputs = input_ids
         else:
@@ -721,18 +944,142 @@ class UnifiedVoice(nn.Module):
             min_tokens_to_keep = 2 if hf_generate_kwargs.get("num_beams", 1) > 1 else 1
             logits_processor.append(TypicalLogitsWarper(mass=typical_mass, min_tokens_to_keep=min_tokens_to_keep))
         max_length = (trunc_index + self.max_mel_tokens - 1) if max_generate_length is None else trunc_index + max_generate_length
-        output = self.inference_model.generate(inputs, 
-                                            bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token,
-                                            eos_token_id=self.stop_mel_token, attention_mask=attention_mask,
-                                            max_length=max_length, logits_processor=logits_processor,
-                                            num_return_sequences=num_return_sequences,
-                                            **hf_generate_kwargs)
+        return_dict = hf_generate_kwargs.pop("return_dict_in_generate", False)
+        if return_latent:
+            self.inference_model.latent_steps = []
+            if hf_generate_kwargs.get("num_beams", 1) > 1:
+                # `generate()` only returns the `beam_indices` of the sequences with their scores
+                hf_generate_kwargs.setdefault("output_scores", True)
+        if fused_sampler and hf_generate_kwargs.get("num_beams", 1) == 1 and not typical_sampling:
+            # takes its parameters from the logits processors of `generate()`, which it replaces unless they
+            # hold other processors, see `FusedSampler.configure()`
+            self.inference_model.sampler = self.inference_model.fused_sampler
+        try:
+            output = self.inference_model.generate(inputs, 
+                                                bos_token_id=self.start_mel_token, pad_token_id=self.stop_mel_token,
+                                                eos_token_id=self.stop_mel_token, attention_mask=attention_mask,
+                                                max_length=max_length, logits_processor=logits_processor,
+                                                num_return_sequences=num_return_sequences,
+                                                return_dict_in_generate=return_dict or return_latent,
+                                                **hf_generate_kwargs)
+        finally:
+            latent_steps = self.inference_model.latent_steps
+            self.inference_model.latent_steps = None
+            self.inference_model.sampler = None
+        self.inference_model.free_paged_cache()
+        if return_latent:
+            latent = self.gather_latent(latent_steps, getattr(output, "beam_indices", None))
+            latent = latent[:, :output.sequences.shape[1] - trunc_index]
+            if not return_dict:
+                return output.sequences[:, trunc_index:], speech_conditioning_latent, latent
+            output.sequences = output.sequences[:, trunc_index:]
+            return output, speech_conditioning_latent, latent
         if isinstance(output, torch.Tensor):
             return output[:, trunc_index:], speech_conditioning_latent
         # GenerateOutput
         output.sequences = output.sequences[:, trunc_index:]
         return output, speech_conditioning_latent
 
+    def inference_speech_speculative(self, conds_latent, text_inputs, drafter, speech_conditioning_latent,
+                                     input_tokens=None, num_return_sequences=1, max_generate_length=None,
+                                     typical_sampling=False, return_latent=False, num_beams=1, do_sample=False,
+                                     top_p=1.0, top_k=50, temperature=1.0, repetition_penalty=1.0, streamer=None,
+                                     stopping_criteria=None, prefix_key=None, **hf_generate_kwargs):
+        """
+        `inference_speech(drafter=...)` with a `SpeculativeDecoder`, see `inference_speech()` for the arguments.
+        """
+        if text_inputs.shape[0] != 1 or num_beams != 1 or num_return_sequences != 1:
+            raise ValueError("speculative decoding supports a single text without beam search, "
+                             f"got batch size {text_inputs.shape[0]}, num_beams={num_beams}, "
+                             f"num_return_sequences={num_return_sequences}")
+        if input_tokens is not None or typical_sampling or hf_generate_kwargs.get("return_dict_in_generate"):
+            raise ValueError("speculative decoding does not support `input_tokens`, `typical_sampling` or "
+                             "`return_dict_in_generate`")
+        max_new_tokens = self.max_mel_tokens - 1 if max_generate_length is None else max_generate_length
+        decoder = SpeculativeDecoder(self, drafter, do_sample=do_sample, top_p=top_p, top_k=top_k,
+                                     temperature=temperature, repetition_penalty=repetition_penalty,
+                                     return_latent=return_latent)
+        codes = decoder.generate(conds_latent, text_inputs, max_new_tokens, streamer=streamer,
+                                 stopping_criteria=stopping_criteria, prefix_key=prefix_key)
+        if return_latent:
+            return codes, speech_conditioning_latent, torch.stack(decoder.latents).unsqueeze(0)
+        return codes, speech_conditioning_latent
+
+    def inference_speech_beam(self, conds_latent, text_inputs, speech_conditioning_latent, input_tokens=None,
+                              num_return_sequences=1, max_generate_length=None, typical_sampling=False,
+                              return_latent=False, num_beams=3, do_sample=False, top_p=1.0, top_k=50,
+                              temperature=1.0, repetition_penalty=1.0, length_penalty=1.0, early_stopping=False,
+                              prune_beams=True, stopping_criteria=None, prefix_key=None, **hf_generate_kwargs):
+        """
+        `inference_speech(tree_beam_search=True)` with a `BeamSearchDecoder`, see `inference_speech()` for the
+        arguments; `prune_beams` is the `prune` option of the decoder.
+        """
+        if text_inputs.shape[0] != 1:
+            raise ValueError(f"tree beam search supports a single text, got batch size {text_inputs.shape[0]}")
+        if input_tokens is not None or typical_sampling or early_stopping is not False or hf_generate_kwargs:
+            raise ValueError("tree beam search does not support `input_tokens`, `typical_sampling`, "
+                             f"`early_stopping` or {sorted(hf_generate_kwargs)}")
+        max_new_tokens = self.max_mel_tokens - 1 if max_generate_length is None else max_generate_length
+        decoder = BeamSearchDecoder(self, num_beams=num_beams, do_sample=do_sample, top_p=top_p, top_k=top_k,
+                                    temperature=temperature, repetition_penalty=repetition_penalty,
+                                    length_penalty=length_penalty, num_return_sequences=num_return_sequences,
+                                    prune=prune_beams, return_latent=return_latent)
+        codes, latent = decoder.generate(conds_latent, text_inputs, max_new_tokens,
+                                         stopping_criteria=stopping_criteria, prefix_key=prefix_key)
+        if return_latent:
+            return codes, speech_conditioning_latent, latent
+        return codes, speech_conditioning_latent
+
+    @staticmethod
+    def gather_latent(latent_steps, beam_indices=None):
+        """
+        Latents of the returned sequences from the hidden states captured at every decoding step.
+        Args:
+            latent_steps: [(rows, dim)] final-norm hidden states of the rows of each step, the state of a step
+                predicts the code generated at that step
+            beam_indices: (b, >= n) row of every generated code, from `generate(return_dict_in_generate=True,
+                output_scores=True)` with beam search, -1 after the end of the sequence; None when the rows are the
+                returned sequences
+        Returns:
+            (b, n, dim)
+        """
+        latent = torch.stack(latent_steps, dim=1)
+        if beam_indices is None:
+            return latent
+        steps = torch.arange(latent.shape[1], device=latent.device)
+        return latent[beam_indices[:, :latent.shape[1]].clamp(min=0).to(latent.device), steps]
+
+    def get_conds_latent(self, speech_conditioning_latent, emo_vec):
+        """
+        Conditioning prefix of the GPT inputs: [speaker latents + emotion vector][duration embeddings].
+        Args:
+            speech_conditioning_latent: (b, 32, dim) output of `get_conditioning()`
+            emo_vec: (b, dim) emotion vector
+        Returns:
+            (b, 34, dim) the `conditional_latents` of `prepare_gpt_inputs()`
+        """
+        tmp = torch.zeros(speech_conditioning_latent.size(0), device=speech_conditioning_latent.device)
+        duration_emb = self.speed_emb(torch.zeros_like(tmp).long())
+        duration_emb_half = self.speed_emb(torch.ones_like(tmp).long())
+        return torch.cat((speech_conditioning_latent + emo_vec.unsqueeze(1), duration_emb_half.unsqueeze(1),
+                          duration_emb.unsqueeze(1)), 1)
+
+    def get_conditioning_prefix(self, conds_latent, prefix_key):
+        """
+        `ConditioningPrefix` of `conds_latent` (1, 34, dim), computed on the first use of this conditioning and
+        then taken from `self.prefix_cache`.
+        `prefix_key` identifies the conditioning (e.g. the reference prompts and emotion inputs `conds_latent` was
+        computed from): the same key must always give the same `conds_latent`.
+        """
+        def compute():
+            with torch.no_grad():
+                outputs = self.inference_model.transformer(inputs_embeds=conds_latent, past_key_values=DynamicCache(),
+                                                           use_cache=True, return_dict=True)
+            cache = outputs.past_key_values
+            return ConditioningPrefix(list(zip(cache.key_cache, cache.value_cache)))
+
+        return self.prefix_cache.get_or_compute(PrefixKVCache.key_of(prefix_key, conds_latent), compute)
+
     def get_emovec(self, emo_speech_conditioning_latent, emo_cond_lengths):
         emo_vec_syn_ori = self.get_emo_conditioning(emo_speech_conditioning_latent.transpose(1,2), emo_cond_lengths)
         emo_vec_syn = self.emovec_layer(emo_vec_syn_ori)
@@ -0,0 +1,332 @@
+import threading
+from typing import Dict, List
+
+import torch
+from transformers.cache_utils import Cache
+
+
+class KVPoolExhausted(RuntimeError):
+    """
+    Raised when a `KVPagePool` has no free page left for a sequence.
+    """
+
+
+class KVPagePool:
+    """
+    Block-paged KV memory shared by all the sequences decoded by a GPT.
+
+    The keys and values of every layer live in one preallocated buffer of `num_pages` pages of `page_size`
+    tokens. A sequence owns a block table (the list of its pages, in order) and grows one page at a time, so
+    it only holds the memory of the tokens it has actually produced instead of a worst-case
+    `max_mel_tokens` reservation. Freed pages go back to a free list and are reused by the next sequences,
+    without going through the CUDA caching allocator.
+
+    Token `t` of a sequence is stored in slot `block_table[t // page_size] * page_size + t % page_size` of the
+    flat `(num_pages * page_size, heads, head_dim)` buffer of each layer.
+
+    Pages are reference counted, so that sequences can share a common prefix (`fork()`): the full pages of
+    the prefix are shared, and its last, partially filled page is copied, since the new tokens of the fork
+    are written there (copy-on-write). Shared pages are never written again.
+
+    The pool only changes where the keys and values are stored: the attention still runs on dense tensors,
+    gathered from the pages at every layer and step by `PagedKVCache`.
+    """
+
+    def __init__(self, num_layers, num_heads, head_dim, num_pages, page_size=16, device=None, dtype=torch.float32):
+        self.num_layers = num_layers
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.num_pages = num_pages
+        self.page_size = page_size
+        shape = (num_pages * page_size, num_heads, head_dim)
+        self.key_pages = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(num_layers)]
+        self.value_pages = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(num_layers)]
+        # LIFO, so the pages that were just released are reused first
+        self.free_pages: List[int] = list(range(num_pages - 1, -1, -1))
+        self.page_refs: List[int] = [0] * num_pages
+        self.block_tables: Dict[int, List[int]] = {}
+        self.seq_lens: Dict[int, int] = {}
+        self._next_seq_id = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_memory(cls, memory_mb, num_layers, num_heads, head_dim, page_size=16, device=None,
+                    dtype=torch.float32):
+        """
+        Size the pool to use about `memory_mb` MB for keys and values.
+        """
+        element_size = torch.empty((), dtype=dtype).element_size()
+        page_bytes = 2 * num_layers * page_size * num_heads * head_dim * element_size
+        num_pages = max(1, int(memory_mb * 1024 * 1024 // page_bytes))
+        return cls(num_layers, num_heads, head_dim, num_pages, page_size=page_size, device=device, dtype=dtype)
+
+    @property
+    def device(self):
+        return self.key_pages[0].device
+
+    @property
+    def dtype(self):
+        return self.key_pages[0].dtype
+
+    def pages_needed(self, num_tokens):
+        return -(-num_tokens // self.page_size)
+
+    def new_sequence(self):
+        with self._lock:
+            seq_id = self._next_seq_id
+            self._next_seq_id += 1
+            self.block_tables[seq_id] = []
+            self.seq_lens[seq_id] = 0
+        return seq_id
+
+    def reserve(self, seq_id, num_tokens):
+        """
+        Make sure that sequence `seq_id` has pages for `num_tokens` tokens in total.
+        """
+        with self._lock:
+            block_table = self.block_tables[seq_id]
+            missing = self.pages_needed(num_tokens) - len(block_table)
+            if missing > len(self.free_pages):
+                raise KVPoolExhausted(f"KV page pool exhausted: {missing} pages needed, "
+                                      f"{len(self.free_pages)} of {self.num_pages} free")
+            for _ in range(missing):
+                page = self.free_pages.pop()
+                self.page_refs[page] = 1
+                block_table.append(page)
+
+    def can_reserve(self, seq_ids, num_tokens):
+        """
+        Whether every sequence in `seq_ids` can grow to `num_tokens[i]` tokens at the same time.
+        """
+        with self._lock:
+            missing = sum(max(0, self.pages_needed(n) - len(self.block_tables[seq_id]))
+                          for seq_id, n in zip(seq_ids, num_tokens))
+            return missing <= len(self.free_pages)
+
+    def free(self, seq_id):
+        with self._lock:
+            for page in reversed(self.block_tables.pop(seq_id)):
+                self.page_refs[page] -= 1
+                if self.page_refs[page] == 0:
+                    self.free_pages.append(page)
+            del self.seq_lens[seq_id]
+
+    def fork(self, seq_id):
+        """
+        New sequence starting with the tokens of `seq_id`, sharing its full pages.
+        """
+        with self._lock:
+            length = self.seq_lens[seq_id]
+            full_pages, partial = divmod(length, self.page_size)
+            if partial and not self.free_pages:
+                raise KVPoolExhausted(f"KV page pool exhausted: 1 page needed, 0 of {self.num_pages} free")
+            block_table = self.block_tables[seq_id][:full_pages]
+            for page in block_table:
+                self.page_refs[page] += 1
+            if partial:
+                page = self.free_pages.pop()
+                self.page_refs[page] = 1
+                src = self.block_tables[seq_id][full_pages] * self.page_size
+                dst = page * self.page_size
+                for pages in self.key_pages + self.value_pages:
+                    pages[dst:dst + partial].copy_(pages[src:src + partial])
+                block_table = block_table + [page]
+            fork_id = self._next_seq_id
+            self._next_seq_id += 1
+            self.block_tables[fork_id] = block_table
+            self.seq_lens[fork_id] = length
+        return fork_id
+
+    def can_admit(self, num_tokens, num_sequences=1):
+        """
+        Whether `num_sequences` new sequences of `num_tokens` tokens fit in the free pages.
+        """
+        return self.admission_capacity(num_tokens) >= num_sequences
+
+    def admission_capacity(self, num_tokens):
+        """
+        Number of new sequences of `num_tokens` tokens that fit in the free pages.
+        """
+        return len(self.free_pages) // max(1, self.pages_needed(num_tokens))
+
+    def stats(self):
+        """
+        Pages in use, internal fragmentation (share of the allocated token slots that hold no token) and memory.
+        """
+        with self._lock:
+            pages_in_use = self.num_pages - len(self.free_pages)
+            tokens = sum(self.seq_lens.values())
+            sequences = len(self.block_tables)
+            shared_pages = sum(1 for refs in self.page_refs if refs > 1)
+            # token slots filled in each physical page, a shared page counts once
+            filled = {}
+            for seq_id, block_table in self.block_tables.items():
+                length = self.seq_lens[seq_id]
+                for i, page in enumerate(block_table):
+                    filled[page] = max(filled.get(page, 0), min(self.page_size, max(0, length - i * self.page_size)))
+        allocated = pages_in_use * self.page_size
+        page_bytes = 2 * self.num_layers * self.page_size * self.num_heads * self.head_dim * self.dtype.itemsize
+        return {
+            "pages_total": self.num_pages,
+            "pages_in_use": pages_in_use,
+            "pages_free": self.num_pages - pages_in_use,
+            "pages_shared": shared_pages,
+            "sequences": sequences,
+            "tokens": tokens,
+            "fragmentation": 1.0 - sum(filled.values()) / allocated if allocated else 0.0,
+            "memory_mb": self.num_pages * page_bytes / 1024 / 1024,
+            "memory_in_use_mb": pages_in_use * page_bytes / 1024 / 1024,
+        }
+
+    def slot_mapping(self, seq_ids, start, length):
+        """
+        Flat slot index of the positions `start[i]` to `start[i] + length - 1` of each sequence, as a (b, length)
+        tensor. Positions past the pages of a sequence map to slot 0; they must be masked out by the caller.
+        """
+        page_size = self.page_size
+        max_pages = self.pages_needed(max(s + length for s in start))
+        tables = torch.zeros(len(seq_ids), max(1, max_pages), dtype=torch.long)
+        for i, seq_id in enumerate(seq_ids):
+            block_table = self.block_tables[seq_id][:max_pages]
+            tables[i, :len(block_table)] = torch.tensor(block_table, dtype=torch.long)
+        positions = torch.tensor(start, dtype=torch.long).unsqueeze(1) + torch.arange(length).unsqueeze(0)
+        positions = positions.clamp(max=tables.shape[1] * page_size - 1)
+        slots = tables.gather(1, positions // page_size) * page_size + positions % page_size
+        return slots.to(self.device, non_blocking=True)
+
+    def write(self, seq_id, layer_idx, key, value, start=0):
+        """
+        Write `key`/`value` (heads, s, head_dim) of one sequence at positions `start` to `start + s - 1`.
+        Pages must have been reserved.
+        """
+        slots = self.slot_mapping([seq_id], [start], key.shape[-2])[0]
+        self.key_pages[layer_idx].index_copy_(0, slots, key.transpose(0, 1).to(self.dtype))
+        self.value_pages[layer_idx].index_copy_(0, slots, value.transpose(0, 1).to(self.dtype))
+
+
+class GatherWorkspace:
+    """
+    Buffers that `PagedKVCache.update()` gathers the keys and values of a layer into, reused by all the layers
+    and decode steps instead of allocating dense tensors every time. The gathered keys/values of a layer are
+    only read by its attention, before the next layer gathers its own, so one pair of buffers is enough for a
+    decoding loop; loops that run concurrently need their own workspace.
+    The buffers grow to the largest (rows x length) gathered, doubling their size when they are too small.
+    """
+
+    def __init__(self):
+        self.keys = None
+        self.values = None
+
+    @property
+    def nbytes(self):
+        return 0 if self.keys is None else 2 * self.keys.numel() * self.keys.element_size()
+
+    def get(self, num_slots, pages):
+        """
+        (num_slots, heads, head_dim) views of the buffers, of the device and dtype of `pages`.
+        """
+        keys = self.keys
+        if keys is None or keys.device != pages.device or keys.dtype != pages.dtype:
+            keys = None
+        if keys is None or keys.shape[0] < num_slots:
+            capacity = num_slots if keys is None else max(num_slots, 2 * keys.shape[0])
+            self.keys = self.values = None
+            self.keys = pages.new_empty((capacity,) + pages.shape[1:])
+            self.values = pages.new_empty((capacity,) + pages.shape[1:])
+        return self.keys[:num_slots], self.values[:num_slots]
+
+
+class PagedKVCache(Cache):
+    """
+    `transformers` cache view of a batch of `KVPagePool` sequences, for `GPT2InferenceModel` and the
+    `DecodeScheduler`.
+
+    `update()` writes the new keys/values of each row after the tokens it already has, and returns the keys
+    and values of each row gathered from its pages into (b, heads, s, head_dim) tensors, left-aligned: the rows
+    may have different lengths, the attention mask must cover `max(length) + new tokens` positions and mask
+    the positions of a row past its own length.
+    There is no paged attention kernel: every layer of every step copies the whole cache of its rows out of the
+    pages, which costs about as much memory traffic as reading a dense cache. The pages save the worst-case
+    reservations and the reallocations of the stored cache; the gathered copies only take the memory of one layer,
+    in a `GatherWorkspace` reused by the layers and steps. The returned tensors are views of that workspace,
+    valid until the next `update()`.
+    """
+
+    def __init__(self, pool: KVPagePool, seq_ids: List[int], workspace: GatherWorkspace = None):
+        super().__init__()
+        self.pool = pool
+        self.seq_ids = list(seq_ids)
+        self.lengths = [pool.seq_lens[seq_id] for seq_id in self.seq_ids]
+        self.workspace = workspace if workspace is not None else GatherWorkspace()
+        self._write_slots = None
+        self._read_slots = None
+
+    @classmethod
+    def allocate(cls, pool: KVPagePool, batch_size, prefix_seq_id=None, workspace: GatherWorkspace = None):
+        """
+        View of `batch_size` new sequences, starting as forks of `prefix_seq_id` if given.
+        """
+        if prefix_seq_id is not None:
+            return cls(pool, [pool.fork(prefix_seq_id) for _ in range(batch_size)], workspace)
+        return cls(pool, [pool.new_sequence() for _ in range(batch_size)], workspace)
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        pool = self.pool
+        b, heads, seq_len, head_dim = key_states.shape
+        if layer_idx == 0:
+            new_lengths = [length + seq_len for length in self.lengths]
+            for seq_id, length in zip(self.seq_ids, new_lengths):
+                pool.reserve(seq_id, length)
+            self._write_slots = pool.slot_mapping(self.seq_ids, self.lengths, seq_len).reshape(-1)
+            self._read_slots = pool.slot_mapping(self.seq_ids, [0] * b, max(new_lengths)).reshape(-1)
+            self.lengths = new_lengths
+            for seq_id, length in zip(self.seq_ids, new_lengths):
+                pool.seq_lens[seq_id] = length
+        key_pages, value_pages = pool.key_pages[layer_idx], pool.value_pages[layer_idx]
+        key_pages.index_copy_(0, self._write_slots,
+                              key_states.transpose(1, 2).reshape(-1, heads, head_dim).to(key_pages.dtype))
+        value_pages.index_copy_(0, self._write_slots,
+                                value_states.transpose(1, 2).reshape(-1, heads, head_dim).to(value_pages.dtype))
+        read_slots = self._read_slots
+        keys, values = self.workspace.get(read_slots.numel(), key_pages)
+        torch.index_select(key_pages, 0, read_slots, out=keys)
+        torch.index_select(value_pages, 0, read_slots, out=values)
+        keys = keys.view(b, -1, heads, head_dim).transpose(1, 2)
+        values = values.view(b, -1, heads, head_dim).transpose(1, 2)
+        return keys.to(key_states.dtype), values.to(value_states.dtype)
+
+    def get_seq_length(self, layer_idx=0):
+        return max(self.lengths) if self.lengths else 0
+
+    def get_max_cache_shape(self):
+        return None
+
+    def reorder_cache(self, beam_idx):
+        """
+        Reorder the rows for beam search: row i takes the content of row `beam_idx[i]`.
+        All the rows have the same length in `generate()`. Pages shared by both rows (a forked prefix) are
+        left untouched.
+        """
+        beam_idx = beam_idx.tolist()
+        if beam_idx == list(range(len(self.seq_ids))):
+            return
+        length = max(self.lengths)
+        slots = self.pool.slot_mapping(self.seq_ids, [0] * len(self.seq_ids), length)
+        src = slots[beam_idx].reshape(-1)
+        dst = slots.reshape(-1)
+        differ = src != dst
+        src, dst = src[differ], dst[differ]
+        for pages in self.pool.key_pages + self.pool.value_pages:
+            pages.index_copy_(0, dst, pages.index_select(0, src))
+        self.lengths = [self.lengths[i] for i in beam_idx]
+        for seq_id, length in zip(self.seq_ids, self.lengths):
+            self.pool.seq_lens[seq_id] = length
+
+    def free(self):
+        """
+        Return the pages of all the rows to the pool.
+        """
+        for seq_id in self.seq_ids:
+            self.pool.free(seq_id)
+        self.seq_ids = []
+        self.lengths = []
@@ -0,0 +1,129 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional
+
+import torch
+
+
+class ConditioningPrefix:
+    """
+    GPT keys/values of the conditioning prefix `[cond latents + emo vec][duration embeddings]` of the prompt.
+
+    The prefix comes first in the prompt and the attention is causal, so its keys/values don't depend on the
+    text: they are computed once and shared by every segment, beam and request with the same conditioning,
+    and only the text and mel positions are prefilled. The tensors are never written: a `DynamicCache` built
+    on `expand()` copies them when it grows, and a `KVPagePool` sequence forks them (copy-on-write).
+    """
+
+    def __init__(self, past):
+        self.past = past  # [(k, v)] per layer, (1, heads, length, head_dim)
+        self.length = past[0][0].shape[-2]
+        self._pool_seqs = {}
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for layer in self.past for t in layer)
+
+    def expand(self, batch_size):
+        """
+        Keys/values of `batch_size` rows, without copy.
+        """
+        return [tuple(t.expand(batch_size, -1, -1, -1) for t in layer) for layer in self.past]
+
+    def pool_sequence(self, pool):
+        """
+        The prefix as a sequence of `pool`, written on first use. Fork it to share its pages.
+        """
+        with self._lock:
+            seq_id = self._pool_seqs.get(id(pool), (None, None))[1]
+            if seq_id is None:
+                seq_id = pool.new_sequence()
+                pool.reserve(seq_id, self.length)
+                for layer_idx, (key, value) in enumerate(self.past):
+                    pool.write(seq_id, layer_idx, key[0], value[0])
+                pool.seq_lens[seq_id] = self.length
+                self._pool_seqs[id(pool)] = (pool, seq_id)
+        return seq_id
+
+    def release(self):
+        """
+        Free the pool sequences of the prefix; pages still shared by forks are freed with the forks.
+        """
+        with self._lock:
+            for pool, seq_id in self._pool_seqs.values():
+                pool.free(seq_id)
+            self._pool_seqs = {}
+
+
+class PrefixKVCache:
+    """
+    LRU cache of `ConditioningPrefix`, keyed by what the conditioning latents were computed from (the reference
+    prompts and emotion inputs, given by the caller) rather than by their content, which would need a copy of the
+    latents to the host and a device synchronization at every call.
+    """
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, ConditioningPrefix]" = OrderedDict()
+        # shared by `inference_speech()` and the `DecodeScheduler` thread
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key_of(prefix_key: Hashable, conds_latent: torch.Tensor) -> Hashable:
+        # the keys/values also depend on the autocast dtype of the caller
+        device_type = conds_latent.device.type
+        autocast_dtype = torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else None
+        return prefix_key, tuple(conds_latent.shape), str(conds_latent.dtype), str(autocast_dtype), \
+            str(conds_latent.device)
+
+    def get(self, key) -> Optional[ConditioningPrefix]:
+        with self._lock:
+            prefix = self._entries.get(key)
+            if prefix is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return prefix
+
+    def get_or_compute(self, key, compute: Callable[[], ConditioningPrefix]) -> ConditioningPrefix:
+        """
+        The prefix of `key`, computed by `compute()` and cached on a miss; concurrent callers of the same key wait
+        for the first one instead of computing it again.
+        """
+        with self._lock:
+            prefix = self.get(key)
+            if prefix is None:
+                prefix = compute()
+                self.put(key, prefix)
+            return prefix
+
+    def put(self, key, prefix: ConditioningPrefix):
+        with self._lock:
+            self.pop(key)
+            while self._entries and len(self._entries) >= self.max_entries:
+                self.pop(next(iter(self._entries)))
+            self._entries[key] = prefix
+
+    def pop(self, key) -> Optional[ConditioningPrefix]:
+        with self._lock:
+            prefix = self._entries.pop(key, None)
+        if prefix is not None:
+            prefix.release()
+        return prefix
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self.pop(key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "bytes": sum(prefix.nbytes for prefix in self._entries.values())}
@@ -0,0 +1,259 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers.pytorch_utils import Conv1D
+
+QUANTIZE_MODES = ("int8", "int4")
+# the weight-only kernels of the CPU are made for the decode steps: with more rows (prefill) the weights are
+# dequantized for a dense matmul. Both take the activations in their own dtype (float32, float16 or bfloat16).
+KERNEL_MAX_ROWS = 16
+_HAS_INT8_KERNEL = hasattr(torch.ops.aten, "_weight_int8pack_mm")
+_HAS_INT4_KERNEL = hasattr(torch.ops.aten, "_weight_int4pack_mm_for_cpu")
+
+
+@torch.compiler.disable
+def _int8_mm(x, weight, scales):
+    # inductor can't lower the weight-only kernels, `torch.compile` calls them eagerly
+    return torch.ops.aten._weight_int8pack_mm(x, weight, scales.to(x.dtype))
+
+
+@torch.compiler.disable
+def _int4_mm(x, weight, groupsize, scales_and_zeros):
+    return torch.ops.aten._weight_int4pack_mm_for_cpu(x, weight, groupsize, scales_and_zeros.to(x.dtype))
+
+
+def quantize_per_channel(weight):
+    """
+    Symmetric int8 quantization of the rows (output channels) of `weight` (out, in).
+    Returns:
+        weight_int8: (out, in) int8
+        scales: (out,) float32, weight ~= weight_int8 * scales[:, None]
+    """
+    weight = weight.float()
+    scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+    weight_int8 = torch.round(weight / scales[:, None]).clamp(-128, 127).to(torch.int8)
+    return weight_int8, scales
+
+
+def group_quantize(weight, groupsize=128):
+    """
+    Asymmetric 4-bit quantization of `weight` (out, in) by groups of `groupsize` input channels, as the int4 helpers
+    of gpt-fast (`indextts/s2mel/modules/gpt_fast/quantize.py`).
+    Returns:
+        weight_int4: (out, in) int32 in [0, 15]
+        scales_and_zeros: (in // groupsize, out, 2) float32, weight ~= (weight_int4 - 8) * scale + zero
+    """
+    out_features, in_features = weight.shape
+    if in_features % groupsize:
+        raise ValueError(f"in_features {in_features} is not a multiple of the groupsize {groupsize}")
+    groups = weight.float().reshape(out_features, in_features // groupsize, groupsize)
+    max_val, min_val = groups.amax(dim=-1, keepdim=True), groups.amin(dim=-1, keepdim=True)
+    scales = (max_val - min_val).clamp(min=1e-6) / 15
+    zeros = min_val + scales * 8
+    weight_int4 = torch.round((groups - min_val) / scales).clamp(0, 15).to(torch.int32)
+    scales_and_zeros = torch.cat([scales, zeros], dim=-1).transpose(0, 1).contiguous()
+    return weight_int4.reshape(out_features, in_features), scales_and_zeros
+
+
+def _dense_weight(layer):
+    # `Conv1D` of GPT-2 keeps its weight as (in, out)
+    return layer.weight.t() if isinstance(layer, Conv1D) else layer.weight
+
+
+def _features(layer):
+    out_features, in_features = _dense_weight(layer).shape
+    return in_features, out_features
+
+
+class WeightOnlyInt8Linear(nn.Module):
+    """
+    `nn.Linear` / `Conv1D` with int8 weights and per-channel scales, the activations are not quantized.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, dtype=torch.float32):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.empty(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("scales", torch.empty(out_features, dtype=dtype))
+        self.register_buffer("bias", torch.empty(out_features, dtype=dtype) if bias else None)
+
+    @classmethod
+    def from_float(cls, layer):
+        in_features, out_features = _features(layer)
+        dtype = layer.weight.dtype
+        module = cls(in_features, out_features, bias=layer.bias is not None, dtype=dtype)
+        weight, scales = quantize_per_channel(_dense_weight(layer).detach())
+        module.weight.copy_(weight)
+        module.scales.copy_(scales)
+        if layer.bias is not None:
+            module.bias.copy_(layer.bias.detach())
+        return module.to(layer.weight.device)
+
+    def forward(self, x):
+        shape = x.shape[:-1]
+        x = x.reshape(-1, self.in_features)
+        if _HAS_INT8_KERNEL and x.device.type == "cpu" and x.shape[0] <= KERNEL_MAX_ROWS:
+            out = _int8_mm(x, self.weight, self.scales)
+        else:
+            out = F.linear(x, self.weight.to(x.dtype)) * self.scales.to(x.dtype)
+        if self.bias is not None:
+            out = out + self.bias.to(x.dtype)
+        return out.reshape(*shape, self.out_features)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+
+class WeightOnlyInt4Linear(nn.Module):
+    """
+    `nn.Linear` / `Conv1D` with 4-bit weights quantized by groups of `groupsize` input channels, two per byte.
+    With `packed`, the weights are in the layout of the CPU int4 kernel (`_convert_weight_to_int4pack_for_cpu`) and
+    the layer only runs on CPU; otherwise they are dequantized at every call.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, groupsize=128, packed=False, dtype=torch.float32):
+        super().__init__()
+        if groupsize not in (32, 64, 128, 256):
+            raise ValueError(f"groupsize must be 32, 64, 128 or 256, got {groupsize}")
+        if in_features % groupsize:
+            raise ValueError(f"in_features {in_features} is not a multiple of the groupsize {groupsize}")
+        if packed and not _HAS_INT4_KERNEL:
+            raise RuntimeError("this PyTorch build has no CPU int4 kernel, use packed=False")
+        self.in_features = in_features
+        self.out_features = out_features
+        self.groupsize = groupsize
+        self.packed = packed
+        # the CPU kernel takes a multiple of 16 output channels, the extra ones are zero and sliced off
+        rows = -(-out_features // 16) * 16 if packed else out_features
+        self.register_buffer("weight", torch.empty(rows, in_features // 2, dtype=torch.uint8))
+        self.register_buffer("scales_and_zeros", torch.empty(in_features // groupsize, rows, 2, dtype=dtype))
+        self.register_buffer("bias", torch.empty(out_features, dtype=dtype) if bias else None)
+
+    @classmethod
+    def from_float(cls, layer, groupsize=128, packed=False):
+        in_features, out_features = _features(layer)
+        packed = packed and _HAS_INT4_KERNEL
+        module = cls(in_features, out_features, bias=layer.bias is not None, groupsize=groupsize, packed=packed,
+                     dtype=layer.weight.dtype)
+        weight, scales_and_zeros = group_quantize(_dense_weight(layer).detach().cpu(), groupsize)
+        if packed:
+            padding = module.weight.shape[0] - out_features
+            weight = F.pad(weight, (0, 0, 0, padding), value=8)
+            scales_and_zeros = F.pad(scales_and_zeros, (0, 0, 0, padding))
+            module.weight.copy_(torch.ops.aten._convert_weight_to_int4pack_for_cpu(weight, 1))
+        else:
+            module.weight.copy_((weight[:, ::2] | (weight[:, 1::2] << 4)).to(torch.uint8))
+        module.scales_and_zeros.copy_(scales_and_zeros)
+        if layer.bias is not None:
+            module.bias.copy_(layer.bias.detach())
+        return module.to(layer.weight.device if not packed else "cpu")
+
+    def dequantize(self, dtype):
+        weight = torch.stack([self.weight & 0x0F, self.weight >> 4], dim=-1).reshape(self.out_features, -1)
+        groups = weight.reshape(self.out_features, -1, self.groupsize).to(dtype) - 8
+        scales, zeros = self.scales_and_zeros.to(dtype).transpose(0, 1).unsqueeze(-1).unbind(dim=-2)
+        return (groups * scales + zeros).reshape(self.out_features, self.in_features)
+
+    def forward(self, x):
+        shape = x.shape[:-1]
+        x = x.reshape(-1, self.in_features)
+        if self.packed:
+            if x.device.type != "cpu":
+                raise RuntimeError("int4 weights packed for the CPU kernel, quantize with packed=False for "
+                                   f"{x.device.type}")
+            out = _int4_mm(x, self.weight, self.groupsize, self.scales_and_zeros)[:, :self.out_features]
+        else:
+            out = F.linear(x, self.dequantize(x.dtype))
+        if self.bias is not None:
+            out = out + self.bias.to(x.dtype)
+        return out.reshape(*shape, self.out_features)
+
+    def extra_repr(self):
+        return (f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}, "
+                f"groupsize={self.groupsize}, packed={self.packed}")
+
+
+def _quantizable_layers(model):
+    # the `Conv1D` layers of the GPT-2 blocks and the linear heads of `UnifiedVoice`
+    for name, module in model.named_modules():
+        if isinstance(module, (Conv1D, nn.Linear)) and (name.startswith("gpt.h.") or name in ("mel_head",
+                                                                                               "text_head")):
+            yield name, module
+
+
+def _set_layer(model, name, layer):
+    parent, _, attr = name.rpartition(".")
+    setattr(model.get_submodule(parent) if parent else model, attr, layer)
+
+
+def _check_model(model):
+    if hasattr(model, "inference_model"):
+        # `GPT2InferenceModel` holds its own reference to `mel_head`
+        raise ValueError("quantize the GPT before post_init_gpt2_config()")
+
+
+def quantize_gpt(model, mode="int8", groupsize=128, packed=None):
+    """
+    Replace the `Conv1D` layers of the GPT-2 blocks and the `mel_head` / `text_head` of a `UnifiedVoice` in place by
+    weight-only quantized layers. Call before `post_init_gpt2_config()`.
+    Args:
+        model: `UnifiedVoice` with its float weights
+        mode: "int8" (per-channel scales) or "int4" (groups of `groupsize` input channels)
+        packed: int4 weights in the layout of the CPU kernel, by default if the model is on CPU
+    Returns:
+        the quantization config, also kept as `model.quantization` for `save_quantized_checkpoint()`
+    """
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"unknown quantization mode {mode!r}, expected one of {QUANTIZE_MODES}")
+    _check_model(model)
+    if packed is None:
+        packed = next(model.parameters()).device.type == "cpu"
+    config = {"mode": mode, "groupsize": groupsize, "packed": []}
+    for name, layer in list(_quantizable_layers(model)):
+        if mode == "int8":
+            quantized = WeightOnlyInt8Linear.from_float(layer)
+        else:
+            quantized = WeightOnlyInt4Linear.from_float(layer, groupsize, packed=packed)
+            if quantized.packed:
+                config["packed"].append(name)
+        _set_layer(model, name, quantized)
+    model.quantization = config
+    return config
+
+
+def save_quantized_checkpoint(model, path):
+    """
+    Save the weights of a `UnifiedVoice` quantized by `quantize_gpt()` with its quantization config. Call before
+    `post_init_gpt2_config()`, which adds the weights of the inference model to the state dict.
+    """
+    if getattr(model, "quantization", None) is None:
+        raise ValueError("the model is not quantized, call quantize_gpt() first")
+    if hasattr(model, "inference_model"):
+        raise ValueError("save the quantized GPT before post_init_gpt2_config()")
+    torch.save({"quantization": model.quantization, "model": model.state_dict()}, path)
+
+
+def load_quantized_checkpoint(model, path):
+    """
+    Load a checkpoint of `save_quantized_checkpoint()` into a freshly built `UnifiedVoice`: its layers are replaced by
+    empty quantized layers of the saved config, without quantizing the initial float weights.
+    Returns:
+        the quantization config
+    """
+    _check_model(model)
+    checkpoint = torch.load(path, map_location="cpu")
+    config = checkpoint["quantization"]
+    packed = set(config["packed"])
+    for name, layer in list(_quantizable_layers(model)):
+        in_features, out_features = _features(layer)
+        kwargs = dict(bias=layer.bias is not None, dtype=layer.weight.dtype)
+        if config["mode"] == "int8":
+            quantized = WeightOnlyInt8Linear(in_features, out_features, **kwargs)
+        else:
+            quantized = WeightOnlyInt4Linear(in_features, out_features, groupsize=config["groupsize"],
+                                             packed=name in packed, **kwargs)
+        _set_layer(model, name, quantized)
+    model.load_state_dict(checkpoint["model"], strict=True)
+    model.quantization = config
+    return config
@@ -0,0 +1,257 @@
+import time
+
+import torch
+from transformers.cache_utils import DynamicCache
+
+
+class NGramDrafter:
+    """
+    Drafts the codes that followed the latest earlier occurrence of the last `n` generated codes.
+
+    Costs no forward pass; works well on the repetitive parts of the code sequence (silences, held vowels).
+    The draft is deterministic, so a drafted code is accepted with the probability the GPT gives it.
+    """
+
+    def __init__(self, n=3, num_draft_tokens=4):
+        self.n = n
+        self.num_draft_tokens = num_draft_tokens
+        self.stats = new_stats()
+
+    def propose(self, decoder, k):
+        codes = decoder.codes
+        for n in range(min(self.n, len(codes) - 1), 0, -1):
+            tail = codes[-n:]
+            for start in range(len(codes) - n - 1, -1, -1):
+                if codes[start:start + n] == tail:
+                    return codes[start + n:start + n + k], None
+        return [], None
+
+
+class EarlyExitDrafter:
+    """
+    Drafts with the first `num_layers` layers of the GPT itself, followed by its final norms and `mel_head`.
+
+    The draft shares the weights and the KV cache of the first layers with the GPT, so it needs no extra memory;
+    its keys/values are dropped before the verification pass, which recomputes them with the full model.
+    """
+
+    def __init__(self, num_layers, num_draft_tokens=4):
+        self.num_layers = num_layers
+        self.num_draft_tokens = num_draft_tokens
+        self.stats = new_stats()
+
+    @torch.no_grad()
+    def propose(self, decoder, k):
+        gpt = decoder.gpt
+        transformer = gpt.gpt
+        cache = decoder.cache
+        length = cache.get_seq_length()
+        token = decoder.codes[-1]
+        position = decoder.position
+        seen = decoder.seen.clone()
+        drafts, probs = [], []
+        for i in range(k):
+            hidden = gpt.mel_embedding(torch.tensor([[token]], device=seen.device)) \
+                + gpt.mel_pos_embedding.emb(torch.tensor([position + i], device=seen.device)).unsqueeze(0)
+            hidden = transformer.drop(hidden)
+            cache_position = torch.tensor([length + i], device=seen.device)
+            # a single query attends to every cached position, no mask is needed
+            for block in transformer.h[:self.num_layers]:
+                hidden = block(hidden, past_key_value=cache, cache_position=cache_position, use_cache=True)[0]
+            logits = gpt.mel_head(gpt.final_norm(transformer.ln_f(hidden[:, -1]))).float()
+            prob = decoder.probs(logits, seen.unsqueeze(0))[0]
+            token = int(prob.argmax()) if not decoder.do_sample else int(torch.multinomial(prob, 1))
+            seen[token] = True
+            drafts.append(token)
+            probs.append(prob)
+            if token == gpt.stop_mel_token:
+                break
+        cache.crop(length)
+        return drafts, torch.stack(probs) if probs else None
+
+
+def new_stats():
+    return {"calls": 0, "steps": 0, "drafted": 0, "accepted": 0, "tokens": 0, "time": 0.0}
+
+
+def format_stats(stats):
+    """
+    Acceptance rate and speed of the speculative decoding, from the `stats` of a drafter.
+    """
+    acceptance = stats["accepted"] / max(stats["drafted"], 1)
+    tokens_per_pass = stats["tokens"] / max(stats["steps"] + stats["calls"], 1)
+    tokens_per_second = stats["tokens"] / stats["time"] if stats["time"] > 0 else 0.0
+    return (f"acceptance {acceptance:.1%} ({stats['accepted']}/{stats['drafted']}), "
+            f"{tokens_per_pass:.2f} tokens per GPT pass, {tokens_per_second:.1f} tokens/s")
+
+
+class SpeculativeDecoder:
+    """
+    Speculative decoding of the mel codes of one segment (batch size 1, no beam search).
+
+    At every step the drafter proposes up to `num_draft_tokens` codes, and the GPT scores the last accepted code
+    and the drafts in one forward pass. The drafts are accepted from the left with the speculative sampling rule
+    (a draft `x` with the draft probability `q(x)` is kept with probability `min(1, p(x) / q(x))`, and the first
+    rejected one is replaced by a sample of `max(p - q, 0)`), so the codes follow the same distribution as
+    `generate()`: repetition penalty, then temperature, top-k and top-p. Greedy decoding gives the same codes.
+    A step always yields at least one code: the replacement, or a code sampled after the last accepted draft.
+    """
+
+    def __init__(self, gpt, drafter, do_sample=True, top_p=0.8, top_k=30, temperature=0.8, repetition_penalty=10.0,
+                 return_latent=False):
+        """
+        Args:
+            gpt: `UnifiedVoice` after `post_init_gpt2_config()`.
+            drafter: `NGramDrafter` or `EarlyExitDrafter`.
+            return_latent: feed the codes at the mel positions of the teacher-forced `UnifiedVoice.forward()` and
+                keep their latents, see `UnifiedVoice.inference_speech(return_latent=True)`.
+        """
+        self.gpt = gpt
+        self.drafter = drafter
+        self.do_sample = do_sample
+        self.top_p = top_p if do_sample and top_p is not None else 1.0
+        self.top_k = top_k if do_sample and top_k else 0
+        self.temperature = temperature if do_sample else 1.0
+        self.repetition_penalty = repetition_penalty or 1.0
+        self.return_latent = return_latent
+        self.cache = None
+        self.codes = []
+        self.latents = []
+        self.seen = None
+        self.position = None  # mel position of `codes[-1]`, which is not in the KV cache yet
+
+    def probs(self, logits, seen):
+        """
+        Distributions of the next code (n, vocab) for the `logits` (n, vocab) of rows that have `seen` (n, vocab) the
+        codes of their prompt and of the codes generated before them; one-hot when not sampling.
+        """
+        penalized = torch.where(logits < 0, logits * self.repetition_penalty, logits / self.repetition_penalty)
+        scores = torch.where(seen, penalized, logits)
+        if not self.do_sample:
+            return torch.nn.functional.one_hot(scores.argmax(dim=-1), scores.shape[-1]).float()
+        scores = scores / self.temperature
+        if self.top_k > 0:
+            kth = torch.topk(scores, min(self.top_k, scores.shape[-1]), dim=-1).values[:, -1:]
+            scores = scores.masked_fill(scores < kth, -float("inf"))
+        if self.top_p < 1.0:
+            sorted_scores, sorted_indices = torch.sort(scores, descending=False)
+            cumulative_probs = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+            sorted_to_remove = cumulative_probs <= (1 - self.top_p)
+            sorted_to_remove[:, -1] = False
+            scores = scores.masked_fill(sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove), -float("inf"))
+        return scores.softmax(dim=-1)
+
+    def _forward(self, emb):
+        length = self.cache.get_seq_length()
+        attention_mask = torch.ones(1, length + emb.shape[1], dtype=torch.long, device=emb.device)
+        outputs = self.gpt.gpt(inputs_embeds=emb, attention_mask=attention_mask, past_key_values=self.cache,
+                               use_cache=True, return_dict=True)
+        latents = self.gpt.final_norm(outputs.last_hidden_state[0])
+        return self.gpt.mel_head(latents).float(), latents
+
+    def _sample(self, prob):
+        return int(torch.multinomial(prob, 1)) if self.do_sample else int(prob.argmax())
+
+    @torch.no_grad()
+    def generate(self, conds_latent, text_inputs, max_new_tokens, streamer=None, stopping_criteria=None,
+                 prefix_key=None):
+        """
+        Args:
+            conds_latent: (1, 34, dim) output of `UnifiedVoice.get_conds_latent()`
+            text_inputs: (1, L) text tokens
+            max_new_tokens: maximum number of generated codes
+            streamer: receives the prompt ids, then every accepted code, like with `generate()`
+            stopping_criteria: `StoppingCriteriaList`, checked after every step
+            prefix_key: key of the conditioning in `gpt.prefix_cache`, see `UnifiedVoice.get_conditioning_prefix()`
+        Returns:
+            the generated codes (1, n), ending with `stop_mel_token` unless the length limit was hit
+        """
+        gpt = self.gpt
+        stats = self.drafter.stats
+        start_time = time.perf_counter()
+        fake_inputs, inputs_embeds, _ = gpt.prepare_gpt_inputs(conds_latent, text_inputs)
+        device = inputs_embeds.device
+        start_emb = gpt.mel_embedding(fake_inputs[:, -1:]) + gpt.mel_pos_embedding.emb(
+            torch.zeros(1, dtype=torch.long, device=device))
+        emb = torch.cat([inputs_embeds, start_emb.to(inputs_embeds.dtype)], dim=1)
+        self.cache = DynamicCache()
+        if gpt.prefix_cache is not None and prefix_key is not None:
+            prefix = gpt.get_conditioning_prefix(conds_latent, prefix_key)
+            self.cache = DynamicCache.from_legacy_cache(tuple(prefix.expand(1)))
+            emb = emb[:, prefix.length:]
+        self.seen = torch.zeros(gpt.number_mel_codes, dtype=torch.bool, device=device)
+        self.seen[fake_inputs[0]] = True
+        if streamer is not None:
+            streamer.put(fake_inputs.cpu())
+
+        logits, latents = self._forward(emb)
+        code = self._sample(self.probs(logits[-1:], self.seen.unsqueeze(0))[0])
+        self._append(code, latents[-1], streamer)
+        # the first generated code is fed at mel position 2, as in `GPT2InferenceModel.forward()`
+        self.position = 1 if self.return_latent else 2
+        stats["calls"] += 1
+        while not self._finished(max_new_tokens, stopping_criteria):
+            k = min(self.drafter.num_draft_tokens, max_new_tokens - len(self.codes) - 1)
+            drafts, draft_probs = self.drafter.propose(self, k) if k > 0 else ([], None)
+            tokens = torch.tensor([[self.codes[-1]] + drafts], dtype=torch.long, device=device)
+            positions = self.position + torch.arange(tokens.shape[1], device=device)
+            length = self.cache.get_seq_length()
+            logits, latents = self._forward(gpt.mel_embedding(tokens) + gpt.mel_pos_embedding.emb(positions))
+            # the scores after each draft see the drafts before it
+            seen = self.seen.unsqueeze(0).repeat(tokens.shape[1], 1)
+            for i, draft in enumerate(drafts):
+                seen[i + 1:, draft] = True
+            probs = self.probs(logits, seen)
+
+            accepted = 0
+            code = None
+            for i, draft in enumerate(drafts):
+                p = probs[i]
+                q = draft_probs[i] if draft_probs is not None else torch.nn.functional.one_hot(
+                    torch.tensor(draft, device=device), p.shape[-1]).float()
+                if not self.do_sample:
+                    keep = int(p.argmax()) == draft
+                else:
+                    keep = torch.rand((), device=device) * q[draft] < p[draft]
+                if not keep:
+                    residual = (p - q).clamp(min=0) if self.do_sample else p
+                    code = self._sample(residual / residual.sum() if residual.sum() > 0 else p)
+                    break
+                accepted += 1
+                self._append(draft, latents[i], streamer)
+                if draft == gpt.stop_mel_token:
+                    break
+            stats["steps"] += 1
+            stats["drafted"] += len(drafts)
+            stats["accepted"] += accepted
+            # the fed code and the accepted drafts stay in the KV cache
+            self.cache.crop(length + 1 + accepted)
+            self.position += 1 + accepted
+            if self.codes[-1] == gpt.stop_mel_token or len(self.codes) >= max_new_tokens:
+                break
+            if code is None:
+                code = self._sample(probs[accepted])
+            self._append(code, latents[accepted], streamer)
+
+        if streamer is not None:
+            streamer.end()
+        stats["time"] += time.perf_counter() - start_time
+        self.cache = None
+        return torch.tensor([self.codes], dtype=torch.long, device=device)
+
+    def _append(self, code, latent, streamer):
+        self.codes.append(code)
+        self.seen[code] = True
+        self.drafter.stats["tokens"] += 1
+        if self.return_latent:
+            self.latents.append(latent)
+        if streamer is not None:
+            streamer.put(torch.tensor([code]))
+
+    def _finished(self, max_new_tokens, stopping_criteria):
+        if self.codes[-1] == self.gpt.stop_mel_token or len(self.codes) >= max_new_tokens:
+            return True
+        if stopping_criteria is not None:
+            codes = torch.tensor([self.codes], dtype=torch.long, device=self.seen.device)
+            return bool(stopping_criteria(codes, None).all())
+        return False
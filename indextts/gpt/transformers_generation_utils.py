@@ -3192,6 +3192,13 @@ class GenerationMixin:
         this_peer_finished = False
         unfinished_sequences = torch.ones(batch_size, dtype=torch.long, device=input_ids.device)
         model_kwargs = self._get_initial_cache_position(input_ids, model_kwargs)
+        # `FusedSampler` set by the model: replaces the logits processors and the token selection, unless they
+        # hold other processors than the ones it fuses
+        sampler = getattr(self, "sampler", None)
+        if sampler is not None and not sampler.configure(logits_processor, do_sample):
+            sampler = None
+        if sampler is not None:
+            sampler.reset(input_ids, self.config.vocab_size)
 
         while self._has_unfinished_sequences(
             this_peer_finished, synced_gpus, device=input_ids.device, cur_len=cur_len, max_length=max_length
@@ -3221,7 +3228,11 @@ class GenerationMixin:
             next_token_logits = next_token_logits.to(input_ids.device)
 
             # pre-process distribution
-            next_token_scores = logits_processor(input_ids, next_token_logits)
+            if sampler is not None:
+                # the scores are only kept for `output_scores`
+                next_token_scores = next_token_logits
+            else:
+                next_token_scores = logits_processor(input_ids, next_token_logits)
 
             # Store scores, attentions and hidden_states when required
             if return_dict_in_generate:
@@ -3244,7 +3255,9 @@ class GenerationMixin:
                     )
 
             # token selection
-            if do_sample:
+            if sampler is not None:
+                next_tokens = sampler(next_token_logits)
+            elif do_sample:
                 probs = nn.functional.softmax(next_token_scores, dim=-1)
                 # TODO (joao): this OP throws "skipping cudagraphs due to ['incompatible ops']", find solution
                 next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
@@ -22,12 +22,13 @@ from indextts.utils.checkpoint import load_checkpoint
 from indextts.utils.feature_extractors import MelSpectrogramFeatures
 
 from indextts.utils.front import TextNormalizer, TextTokenizer
+from indextts.utils.segments import bucket_segments, pad_tokens_cat, torch_empty_cache
 
 
 class IndexTTS:
     def __init__(
             self, cfg_path="checkpoints/config.yaml", model_dir="checkpoints", use_fp16=True, device=None,
-            use_cuda_kernel=None,
+            use_cuda_kernel=None, fused_gpt_latent=False,
     ):
         """
         Args:
@@ -36,6 +37,12 @@ class IndexTTS:
             use_fp16 (bool): whether to use fp16.
             device (str): device to use (e.g., 'cuda:0', 'cpu'). If None, it will be set automatically based on the availability of CUDA or MPS.
             use_cuda_kernel (None | bool): whether to use BigVGan custom fused activation CUDA kernel, only for CUDA device.
+            fused_gpt_latent (bool): take the GPT latents from the decoding pass (`inference_speech(return_latent=True)`)
+                instead of a second GPT forward on the generated codes. This is a different decoding mode, not an
+                exact shortcut: to get the latents of that forward, every code is fed one mel position earlier than
+                in the default decoding, so the codes after the first one differ from the default. Its output has
+                not been evaluated against the default for quality; keep it off where the default output matters.
+                `tests/fused_latent_codes_test.py` checks its latents against the second forward on the same codes.
         """
         if device is not None:
             self.device = device
@@ -63,6 +70,7 @@ class IndexTTS:
         self.model_dir = model_dir
         self.dtype = torch.float16 if self.use_fp16 else None
         self.stop_mel_token = self.cfg.gpt.stop_mel_token
+        self.fused_gpt_latent = fused_gpt_latent
 
         # Comment-off to load the VQ-VAE model for debugging tokenizer
         #   https://github.com/index-tts/index-tts/issues/34
@@ -131,13 +139,16 @@ class IndexTTS:
         self.gr_progress = None
         self.model_version = self.cfg.version if hasattr(self.cfg, "version") else None
 
-    def remove_long_silence(self, codes: torch.Tensor, silent_token=52, max_consecutive=30):
+    def remove_long_silence(self, codes: torch.Tensor, silent_token=52, max_consecutive=30, latent=None):
         """
         Shrink special tokens (silent_token and stop_mel_token) in codes
         codes: [B, T]
+        latent: [B, T, D] GPT latents of the codes, from `inference_speech(return_latent=True)`, shrunk the same way
+        and returned as a third output
         """
         code_lens = []
         codes_list = []
+        latent_list = []
         device = codes.device
         dtype = codes.dtype
         isfix = False
@@ -168,16 +179,24 @@ class IndexTTS:
                 # new code
                 len_ = len(ncode_idx)
                 codes_list.append(code[ncode_idx])
+                if latent is not None:
+                    latent_list.append(latent[i, ncode_idx])
                 isfix = True
             else:
                 # shrink to len_
                 codes_list.append(code[:len_])
+                if latent is not None:
+                    latent_list.append(latent[i, :len_])
             code_lens.append(len_)
         if isfix:
             if len(codes_list) > 1:
                 codes = pad_sequence(codes_list, batch_first=True, padding_value=self.stop_mel_token)
+                if latent is not None:
+                    latent = pad_sequence(latent_list, batch_first=True)
             else:
                 codes = codes_list[0].unsqueeze(0)
+                if latent is not None:
+                    latent = latent_list[0].unsqueeze(0)
         else:
             # unchanged
             pass
@@ -186,94 +205,19 @@ class IndexTTS:
         if max_len < codes.shape[1]:
             codes = codes[:, :max_len]
         code_lens = torch.tensor(code_lens, dtype=torch.long, device=device)
+        if latent is not None:
+            return codes, code_lens, latent[:, :max_len]
         return codes, code_lens
 
     def bucket_segments(self, segments, bucket_max_size=4) -> List[List[Dict]]:
-        """
-        Segment data bucketing.
-        if ``bucket_max_size=1``, return all segments in one bucket.
-        """
-        outputs: List[Dict] = []
-        for idx, sent in enumerate(segments):
-            outputs.append({"idx": idx, "sent": sent, "len": len(sent)})
-
-        if len(outputs) > bucket_max_size:
-            # split segments into buckets by segment length
-            buckets: List[List[Dict]] = []
-            factor = 1.5
-            last_bucket = None
-            last_bucket_sent_len_median = 0
-
-            for sent in sorted(outputs, key=lambda x: x["len"]):
-                current_sent_len = sent["len"]
-                if current_sent_len == 0:
-                    print(">> skip empty segment")
-                    continue
-                if last_bucket is None \
-                        or current_sent_len >= int(last_bucket_sent_len_median * factor) \
-                        or len(last_bucket) >= bucket_max_size:
-                    # new bucket
-                    buckets.append([sent])
-                    last_bucket = buckets[-1]
-                    last_bucket_sent_len_median = current_sent_len
-                else:
-                    # current bucket can hold more segments
-                    last_bucket.append(sent)  # sorted
-                    mid = len(last_bucket) // 2
-                    last_bucket_sent_len_median = last_bucket[mid]["len"]
-            last_bucket = None
-            # merge all buckets with size 1
-            out_buckets: List[List[Dict]] = []
-            only_ones: List[Dict] = []
-            for b in buckets:
-                if len(b) == 1:
-                    only_ones.append(b[0])
-                else:
-                    out_buckets.append(b)
-            if len(only_ones) > 0:
-                # merge into previous buckets if possible
-                # print("only_ones:", [(o["idx"], o["len"]) for o in only_ones])
-                for i in range(len(out_buckets)):
-                    b = out_buckets[i]
-                    if len(b) < bucket_max_size:
-                        b.append(only_ones.pop(0))
-                        if len(only_ones) == 0:
-                            break
-                # combined all remaining sized 1 buckets
-                if len(only_ones) > 0:
-                    out_buckets.extend(
-                        [only_ones[i:i + bucket_max_size] for i in range(0, len(only_ones), bucket_max_size)])
-            return out_buckets
-        return [outputs]
+        return bucket_segments(segments, bucket_max_size)
 
     def pad_tokens_cat(self, tokens: List[torch.Tensor]) -> torch.Tensor:
-        if self.model_version and self.model_version >= 1.5:
-            # 1.5版本以上，直接使用stop_text_token 右侧填充，填充到最大长度
-            # [1, N] -> [N,]
-            tokens = [t.squeeze(0) for t in tokens]
-            return pad_sequence(tokens, batch_first=True, padding_value=self.cfg.gpt.stop_text_token,
-                                padding_side="right")
-        max_len = max(t.size(1) for t in tokens)
-        outputs = []
-        for tensor in tokens:
-            pad_len = max_len - tensor.size(1)
-            if pad_len > 0:
-                n = min(8, pad_len)
-                tensor = torch.nn.functional.pad(tensor, (0, n), value=self.cfg.gpt.stop_text_token)
-                tensor = torch.nn.functional.pad(tensor, (0, pad_len - n), value=self.cfg.gpt.start_text_token)
-            tensor = tensor[:, :max_len]
-            outputs.append(tensor)
-        tokens = torch.cat(outputs, dim=0)
-        return tokens
+        return pad_tokens_cat(tokens, self.cfg.gpt.stop_text_token, self.cfg.gpt.start_text_token,
+                              self.model_version)
 
     def torch_empty_cache(self):
-        try:
-            if "cuda" in str(self.device):
-                torch.cuda.empty_cache()
-            elif "mps" in str(self.device):
-                torch.mps.empty_cache()
-        except Exception as e:
-            pass
+        torch_empty_cache(self.device)
 
     def _set_gr_progress(self, value, desc):
         if self.gr_progress is not None:
@@ -384,6 +328,7 @@ class IndexTTS:
         # Sequential processing of bucketing data
         all_batch_num = sum(len(s) for s in all_segments)
         all_batch_codes = []
+        all_batch_latents = []
         processed_num = 0
         for item_tokens in all_text_tokens:
             batch_num = len(item_tokens)
@@ -411,7 +356,11 @@ class IndexTTS:
                                                            num_beams=num_beams,
                                                            repetition_penalty=repetition_penalty,
                                                            max_generate_length=max_mel_tokens,
+                                                           return_latent=self.fused_gpt_latent,
                                                            **generation_kwargs)
+                    if self.fused_gpt_latent:
+                        temp_codes, temp_latents = temp_codes
+                        all_batch_latents.append(temp_latents)
                     all_batch_codes.append(temp_codes)
             gpt_gen_time += time.perf_counter() - m_start_time
 
@@ -420,7 +369,8 @@ class IndexTTS:
         all_idxs = []
         all_latents = []
         has_warned = False
-        for batch_codes, batch_tokens, batch_segments in zip(all_batch_codes, all_text_tokens, all_segments):
+        for batch_idx, (batch_codes, batch_tokens, batch_segments) in enumerate(
+                zip(all_batch_codes, all_text_tokens, all_segments)):
             for i in range(batch_codes.shape[0]):
                 codes = batch_codes[i]  # [x]
                 if not has_warned and codes[-1] != self.stop_mel_token:
@@ -434,6 +384,13 @@ class IndexTTS:
                 if verbose:
                     print("codes:", codes.shape)
                     print(codes)
+                if self.fused_gpt_latent:
+                    # the latents come from the decoding pass
+                    codes, code_lens, latent = self.remove_long_silence(
+                        codes, silent_token=52, max_consecutive=30, latent=all_batch_latents[batch_idx][i:i + 1])
+                    all_idxs.append(batch_segments[i]["idx"])
+                    all_latents.append(latent)
+                    continue
                 codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
                 if verbose:
                     print("fix codes:", codes.shape)
@@ -453,7 +410,7 @@ class IndexTTS:
                                      return_latent=True, clip_inputs=False)
                         gpt_forward_time += time.perf_counter() - m_start_time
                         all_latents.append(latent)
-        del all_batch_codes, all_text_tokens, all_segments
+        del all_batch_codes, all_batch_latents, all_text_tokens, all_segments
         # bigvgan chunk
         chunk_size = 2
         all_latents = [all_latents[all_idxs.index(i)] for i in range(len(all_latents))]
@@ -604,7 +561,11 @@ class IndexTTS:
                                                       num_beams=num_beams,
                                                       repetition_penalty=repetition_penalty,
                                                       max_generate_length=max_mel_tokens,
+                                                      return_latent=self.fused_gpt_latent,
                                                       **generation_kwargs)
+                    latent = None
+                    if self.fused_gpt_latent:
+                        codes, latent = codes
                 gpt_gen_time += time.perf_counter() - m_start_time
                 if not has_warned and (codes[:, -1] != self.stop_mel_token).any():
                     warnings.warn(
@@ -623,7 +584,11 @@ class IndexTTS:
 
                 # remove ultra-long silence if exits
                 # temporarily fix the long silence bug.
-                codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
+                if latent is not None:
+                    codes, code_lens, latent = self.remove_long_silence(codes, silent_token=52, max_consecutive=30,
+                                                                        latent=latent)
+                else:
+                    codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
                 if verbose:
                     print(codes, type(codes))
                     print(f"fix codes shape: {codes.shape}, codes type: {codes.dtype}")
@@ -633,14 +598,15 @@ class IndexTTS:
                 m_start_time = time.perf_counter()
                 # latent, text_lens_out, code_lens_out = \
                 with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
-                    latent = \
-                        self.gpt(auto_conditioning, text_tokens,
-                                 torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
-                                 code_lens * self.gpt.mel_length_compression,
-                                 cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]],
-                                                               device=text_tokens.device),
-                                 return_latent=True, clip_inputs=False)
-                    gpt_forward_time += time.perf_counter() - m_start_time
+                    if latent is None:
+                        latent = \
+                            self.gpt(auto_conditioning, text_tokens,
+                                     torch.tensor([text_tokens.shape[-1]], device=text_tokens.device), codes,
+                                     code_lens * self.gpt.mel_length_compression,
+                                     cond_mel_lengths=torch.tensor([auto_conditioning.shape[-1]],
+                                                                   device=text_tokens.device),
+                                     return_latent=True, clip_inputs=False)
+                        gpt_forward_time += time.perf_counter() - m_start_time
 
                     m_start_time = time.perf_counter()
                     wav, _ = self.bigvgan(latent, auto_conditioning.transpose(1, 2))
@@ -4,7 +4,10 @@ from subprocess import CalledProcessError
 os.environ['HF_HUB_CACHE'] = './checkpoints/hf_cache'
 import json
 import re
+import threading
 import time
+from typing import Dict, List
+
 import librosa
 import torch
 import torchaudio
@@ -18,16 +21,26 @@ warnings.filterwarnings("ignore", category=UserWarning)
 from omegaconf import OmegaConf
 
 from indextts.gpt.model_v2 import UnifiedVoice
-from indextts.utils.maskgct_utils import build_semantic_model, build_semantic_codec
+from indextts.gpt.code_streamer import MelCodeStreamer, EventStoppingCriteria, SilenceStoppingCriteria
+from indextts.gpt.decode_scheduler import DecodeScheduler
+from indextts.gpt.paged_kv_cache import KVPagePool
+from indextts.gpt.quantize import load_quantized_checkpoint, quantize_gpt, save_quantized_checkpoint
+from indextts.gpt.speculative import format_stats
+from indextts.utils.maskgct_utils import build_semantic_model, build_semantic_codec, get_semantic_features
 from indextts.utils.checkpoint import load_checkpoint
 from indextts.utils.front import TextNormalizer, TextTokenizer
+from indextts.utils.text_utils import get_mel_token_budget
+from indextts.utils.conditioning_cache import ConditioningCache
+from indextts.utils.voice_profile import VoiceProfile, audio_sha256
+from indextts.utils.segments import bucket_segments, pad_tokens_cat, torch_empty_cache
 
 from indextts.s2mel.modules.commons import load_checkpoint2, MyModel
 from indextts.s2mel.modules.bigvgan import bigvgan
+from indextts.s2mel.modules.bigvgan.tiled import TiledBigVGAN
 from indextts.s2mel.modules.campplus.DTDNN import CAMPPlus
 from indextts.s2mel.modules.audio import mel_spectrogram
 
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, StoppingCriteriaList
 from modelscope import AutoModelForCausalLM
 from huggingface_hub import hf_hub_download
 import safetensors
@@ -35,10 +48,26 @@ from transformers import SeamlessM4TFeatureExtractor
 import random
 import torch.nn.functional as F
 
+
+# mel codes per second: the semantic codec runs at 50 Hz on 16 kHz audio, s2mel makes 1.72 mel frames of a code
+CODE_RATE = 50.0
+
+
+class TruncatedSegmentWarning(RuntimeWarning):
+    """
+    A segment stopped without the stop token: at its token budget (`max_mel_tokens`, `mel_budget_slack`) or after
+    `max_silent_tokens` silent codes, so its speech may be cut short. Turn it into an exception with
+    `warnings.simplefilter("error", TruncatedSegmentWarning)`; `infer_stream()` also flags the chunk.
+    """
+
+
 class IndexTTS2:
     def __init__(
             self, cfg_path="checkpoints/config.yaml", model_dir="checkpoints", use_fp16=False, device=None,
-            use_cuda_kernel=None,use_deepspeed=False
+            use_cuda_kernel=None,use_deepspeed=False, use_static_kv_cache=False, cond_cache_mb=256,
+            max_prompt_frames=None, decode_batch_size=0, kv_pool_mb=0, prefix_cache_size=0,
+            fused_gpt_latent=False, speculative_drafter=None, fused_sampler=False, compiled_decode_buckets=(),
+            tree_beam_search=False, quantize=None, vocoder_chunk_frames=None
     ):
         """
         Args:
@@ -48,6 +77,41 @@ class IndexTTS2:
             device (str): device to use (e.g., 'cuda:0', 'cpu'). If None, it will be set automatically based on the availability of CUDA or MPS.
             use_cuda_kernel (None | bool): whether to use BigVGan custom fused activation CUDA kernel, only for CUDA device.
             use_deepspeed (bool): whether to use DeepSpeed or not.
+            use_static_kv_cache (bool): preallocate the GPT KV cache and update it in place while decoding.
+            cond_cache_mb (int): memory budget (MB) of the LRU cache of reference prompt conditioning.
+            max_prompt_frames (None | int): only use the last `max_prompt_frames` mel frames of the reference audio as
+                s2mel context (86 frames per second), bounds the s2mel cost of long reference prompts.
+            decode_batch_size (int): if > 0, the GPT decoding of concurrent `infer()` calls (e.g. from several
+                web UI sessions) is batched by a `DecodeScheduler` with up to this many segments; only used with
+                `num_beams=1`.
+            kv_pool_mb (int): if > 0, keep the GPT KV cache in a `KVPagePool` of this size (MB), allocated once
+                and shared page by page by the decoded sequences, instead of allocating it at every call.
+            prefix_cache_size (int): number of reference prompts whose GPT keys/values of the conditioning prefix are
+                cached and reused by every segment, beam and request with the same prompt (0, the default, disables
+                the cache). The prompts are identified by their conditioning cache keys (path and modification time,
+                emotion inputs), see `_prefix_key()`.
+            fused_gpt_latent (bool): take the GPT latents from the decoding pass (`inference_speech(return_latent=True)`)
+                instead of a second GPT forward on the generated codes. This is a different decoding mode, not an
+                exact shortcut: to get the latents of that forward, every code is fed one mel position earlier than
+                in the default decoding, so the codes after the first one differ from the default. Its output has
+                not been evaluated against the default for quality; keep it off where the default output matters.
+                `tests/fused_latent_codes_test.py` checks its latents against the second forward on the same codes.
+            speculative_drafter (None | NGramDrafter | EarlyExitDrafter): decode the segments with speculative decoding
+                (`inference_speech(drafter=...)`) when `num_beams=1`; its `stats` keep the acceptance rate and speed.
+            fused_sampler (bool): sample the codes with a `FusedSampler` (`inference_speech(fused_sampler=True)`)
+                instead of the logits processors of `generate()` when `num_beams=1`.
+            compiled_decode_buckets (tuple[int]): batch sizes (segments x beams) whose GPT decode step is captured at
+                load (CUDA graph on CUDA, `torch.compile` elsewhere) and replayed on a static KV cache, e.g. `(1, 3)`;
+                other batch sizes decode eagerly. Ignored with `kv_pool_mb` or DeepSpeed.
+            tree_beam_search (bool): run the beam search of a single segment with a `BeamSearchDecoder`
+                (`inference_speech(tree_beam_search=True)`): the prompt is prefilled once for all the beams, reorders
+                don't copy the KV cache, and the beams that can't win are dropped early.
+            quantize (None | str): "int8" or "int4", weight-only quantization of the GPT-2 layers and heads of the GPT
+                (`indextts.gpt.quantize`), for CPU or low-memory serving. The quantized weights are saved next to the
+                GPT checkpoint (e.g. `gpt_int8.pth`) and loaded from there by the next runs.
+            vocoder_chunk_frames (None | int): vocode the mels by overlapping windows of this many frames
+                (`TiledBigVGAN`), the peak memory of BigVGAN no longer grows with the segment length; in `infer_fast()`
+                all the segments are then vocoded in one pass. None vocodes each mel at once.
         """
         if device is not None:
             self.device = device
@@ -80,7 +144,10 @@ class IndexTTS2:
 
         self.gpt = UnifiedVoice(**self.cfg.gpt)
         self.gpt_path = os.path.join(self.model_dir, self.cfg.gpt_checkpoint)
-        load_checkpoint(self.gpt, self.gpt_path)
+        if quantize:
+            self._load_quantized_gpt(quantize)
+        else:
+            load_checkpoint(self.gpt, self.gpt_path)
         self.gpt = self.gpt.to(self.device)
         if self.use_fp16:
             self.gpt.eval().half()
@@ -95,7 +162,23 @@ class IndexTTS2:
                 use_deepspeed = False
                 print(f">> Failed to load DeepSpeed. Falling back to normal inference. Error: {e}")
 
-        self.gpt.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=True, half=self.use_fp16)
+        self.kv_pool = None
+        if kv_pool_mb > 0:
+            self.kv_pool = KVPagePool.from_memory(kv_pool_mb, self.cfg.gpt.layers, self.cfg.gpt.heads,
+                                                  self.cfg.gpt.model_dim // self.cfg.gpt.heads, device=self.device,
+                                                  dtype=torch.float16 if self.use_fp16 else torch.float32)
+        self.gpt.post_init_gpt2_config(use_deepspeed=use_deepspeed, kv_cache=True, half=self.use_fp16,
+                                       static_kv_cache=use_static_kv_cache, kv_pool=self.kv_pool,
+                                       prefix_cache_size=prefix_cache_size,
+                                       compiled_decode_buckets=compiled_decode_buckets)
+        self.fused_gpt_latent = fused_gpt_latent
+        self.speculative_drafter = speculative_drafter
+        self.fused_sampler = fused_sampler
+        self.tree_beam_search = tree_beam_search
+        self.decode_scheduler = None
+        if decode_batch_size > 0:
+            self.decode_scheduler = DecodeScheduler(self.gpt, max_batch_size=decode_batch_size, dtype=self.dtype,
+                                                    kv_pool=self.kv_pool)
 
         if self.use_cuda_kernel:
             # preload the CUDA kernel for BigVGAN
@@ -109,8 +192,9 @@ class IndexTTS2:
                 self.use_cuda_kernel = False
 
         self.extract_features = SeamlessM4TFeatureExtractor.from_pretrained("facebook/w2v-bert-2.0")
+        # the semantic features are the hidden states of layer 17, the later w2v-bert layers are dropped
         self.semantic_model, self.semantic_mean, self.semantic_std = build_semantic_model(
-            os.path.join(self.model_dir, self.cfg.w2v_stat))
+            os.path.join(self.model_dir, self.cfg.w2v_stat), output_layer=17)
         self.semantic_model = self.semantic_model.to(self.device)
         self.semantic_model.eval()
         self.semantic_mean = self.semantic_mean.to(self.device)
@@ -135,6 +219,7 @@ class IndexTTS2:
         )
         self.s2mel = s2mel.to(self.device)
         self.s2mel.models['cfm'].estimator.setup_caches(max_batch_size=1, max_seq_length=8192)
+        self.max_prompt_frames = max_prompt_frames
         self.s2mel.eval()
         print(">> s2mel weights restored from:", s2mel_path)
 
@@ -153,6 +238,7 @@ class IndexTTS2:
         self.bigvgan = self.bigvgan.to(self.device)
         self.bigvgan.remove_weight_norm()
         self.bigvgan.eval()
+        self.vocoder = TiledBigVGAN(self.bigvgan, chunk_frames=vocoder_chunk_frames)
         print(">> bigvgan weights restored from:", bigvgan_name)
 
         self.bpe_path = os.path.join(self.model_dir, self.cfg.dataset["bpe_model"])
@@ -184,37 +270,54 @@ class IndexTTS2:
         }
         self.mel_fn = lambda x: mel_spectrogram(x, **mel_fn_args)
 
-        # 缓存参考音频：
-        self.cache_spk_cond = None
-        self.cache_s2mel_style = None
-        self.cache_s2mel_prompt = None
-        self.cache_spk_audio_prompt = None
-        self.cache_emo_cond = None
-        self.cache_emo_audio_prompt = None
-        self.cache_mel = None
+        # 缓存参考音频的条件特征（按参考音频 LRU 淘汰）：
+        self.cond_cache = ConditioningCache(max_bytes=int(cond_cache_mb * 1024 * 1024))
+
+        # concurrent calls (the web UI runs several requests at once to batch them in the decode scheduler) share the
+        # models: the decoding state of `self.gpt.inference_model` (prompt embeddings, KV caches, latent capture,
+        # sampler), the s2mel/BigVGAN stage and the conditioning of new prompts are used by one call at a time, only
+        # the segments decoded by `self.decode_scheduler` run together
+        self._decode_lock = threading.RLock()
+        self._synth_lock = threading.RLock()
+        self._cond_lock = threading.RLock()
+        self._local = threading.local()
 
         # 进度引用显示（可选）
         self.gr_progress = None
         self.model_version = self.cfg.version if hasattr(self.cfg, "version") else None
 
+    def _load_quantized_gpt(self, mode):
+        # the int4 CPU kernel has its own weight layout, those checkpoints only load on CPU
+        packed = mode == "int4" and self.device == "cpu"
+        quantized_path = f"{os.path.splitext(self.gpt_path)[0]}_{mode}{'_cpu' if packed else ''}.pth"
+        if os.path.exists(quantized_path):
+            load_quantized_checkpoint(self.gpt, quantized_path)
+            self.gpt_path = quantized_path
+            return
+        load_checkpoint(self.gpt, self.gpt_path)
+        quantize_gpt(self.gpt, mode, packed=packed)
+        try:
+            save_quantized_checkpoint(self.gpt, quantized_path)
+            print(f">> GPT quantized to {mode}, saved to:", quantized_path)
+        except OSError as e:
+            print(f">> GPT quantized to {mode}, failed to save it to {quantized_path}: {e}")
+
     @torch.no_grad()
     def get_emb(self, input_features, attention_mask):
-        vq_emb = self.semantic_model(
-            input_features=input_features,
-            attention_mask=attention_mask,
-            output_hidden_states=True,
-        )
-        feat = vq_emb.hidden_states[17]  # (B, T, C)
+        feat = get_semantic_features(self.semantic_model, input_features, attention_mask)  # (B, T, C)
         feat = (feat - self.semantic_mean) / self.semantic_std
         return feat
 
-    def remove_long_silence(self, codes: torch.Tensor, silent_token=52, max_consecutive=30):
+    def remove_long_silence(self, codes: torch.Tensor, silent_token=52, max_consecutive=30, latent=None):
         """
         Shrink special tokens (silent_token and stop_mel_token) in codes
         codes: [B, T]
+        latent: [B, T, D] GPT latents of the codes, from `inference_speech(return_latent=True)`, shrunk the same way
+        and returned as a third output
         """
         code_lens = []
         codes_list = []
+        latent_list = []
         device = codes.device
         dtype = codes.dtype
         isfix = False
@@ -245,16 +348,24 @@ class IndexTTS2:
                 # new code
                 len_ = len(ncode_idx)
                 codes_list.append(code[ncode_idx])
+                if latent is not None:
+                    latent_list.append(latent[i, ncode_idx])
                 isfix = True
             else:
                 # shrink to len_
                 codes_list.append(code[:len_])
+                if latent is not None:
+                    latent_list.append(latent[i, :len_])
             code_lens.append(len_)
         if isfix:
             if len(codes_list) > 1:
                 codes = pad_sequence(codes_list, batch_first=True, padding_value=self.stop_mel_token)
+                if latent is not None:
+                    latent = pad_sequence(latent_list, batch_first=True)
             else:
                 codes = codes_list[0].unsqueeze(0)
+                if latent is not None:
+                    latent = latent_list[0].unsqueeze(0)
         else:
             # unchanged
             pass
@@ -263,6 +374,8 @@ class IndexTTS2:
         if max_len < codes.shape[1]:
             codes = codes[:, :max_len]
         code_lens = torch.tensor(code_lens, dtype=torch.long, device=device)
+        if latent is not None:
+            return codes, code_lens, latent[:, :max_len]
         return codes, code_lens
 
     def insert_interval_silence(self, wavs, sampling_rate=22050, interval_silence=200):
@@ -288,6 +401,25 @@ class IndexTTS2:
 
         return wavs_list
 
+    def bucket_segments(self, segments, bucket_max_size=4, lengths=None) -> List[List[Dict]]:
+        return bucket_segments(segments, bucket_max_size, lengths)
+
+    def pad_tokens_cat(self, tokens: List[torch.Tensor]) -> torch.Tensor:
+        return pad_tokens_cat(tokens, self.cfg.gpt.stop_text_token, self.cfg.gpt.start_text_token,
+                              self.model_version)
+
+    def torch_empty_cache(self):
+        torch_empty_cache(self.device)
+
+    @property
+    def gr_progress(self):
+        # per thread, each web UI request sets its own progress before calling `infer()`
+        return getattr(self._local, "gr_progress", None)
+
+    @gr_progress.setter
+    def gr_progress(self, progress):
+        self._local.gr_progress = progress
+
     def _set_gr_progress(self, value, desc):
         if self.gr_progress is not None:
             self.gr_progress(value, desc=desc)
@@ -322,21 +454,11 @@ class IndexTTS2:
 
         return emo_vector
 
-    # 原始推理模式
-    def infer(self, spk_audio_prompt, text, output_path,
-              emo_audio_prompt=None, emo_alpha=1.0,
-              emo_vector=None,
-              use_emo_text=False, emo_text=None, use_random=False, interval_silence=200,
-              verbose=False, max_text_tokens_per_segment=120, **generation_kwargs):
-        print(">> starting inference...")
-        self._set_gr_progress(0, "starting inference...")
-        if verbose:
-            print(f"origin text:{text}, spk_audio_prompt:{spk_audio_prompt}, "
-                  f"emo_audio_prompt:{emo_audio_prompt}, emo_alpha:{emo_alpha}, "
-                  f"emo_vector:{emo_vector}, use_emo_text:{use_emo_text}, "
-                  f"emo_text:{emo_text}")
-        start_time = time.perf_counter()
-
+    def _prepare_emo_args(self, text, spk_audio_prompt, emo_audio_prompt, emo_alpha, emo_vector, use_emo_text, emo_text):
+        """
+        Resolve the emotion guidance arguments of `infer()`.
+        Returns: (emo_audio_prompt, emo_alpha, emo_vector)
+        """
         if use_emo_text or emo_vector is not None:
             # we're using a text or emotion vector guidance; so we must remove
             # "emotion reference voice", to ensure we use correct emotion mixing!
@@ -367,58 +489,170 @@ class IndexTTS2:
             emo_audio_prompt = spk_audio_prompt
             # must always use alpha=1.0 when we don't have an external reference voice
             emo_alpha = 1.0
+        return emo_audio_prompt, emo_alpha, emo_vector
 
-        # 如果参考音频改变了，才需要重新生成, 提升速度
-        if self.cache_spk_cond is None or self.cache_spk_audio_prompt != spk_audio_prompt:
-            if self.cache_spk_cond is not None:
-                self.cache_spk_cond = None
-                self.cache_s2mel_style = None
-                self.cache_s2mel_prompt = None
-                self.cache_mel = None
-                torch.cuda.empty_cache()
-            audio,sr = self._load_and_cut_audio(spk_audio_prompt,15,verbose)
-            audio_22k = torchaudio.transforms.Resample(sr, 22050)(audio)
-            audio_16k = torchaudio.transforms.Resample(sr, 16000)(audio)
-
-            inputs = self.extract_features(audio_16k, sampling_rate=16000, return_tensors="pt")
-            input_features = inputs["input_features"]
-            attention_mask = inputs["attention_mask"]
-            input_features = input_features.to(self.device)
-            attention_mask = attention_mask.to(self.device)
-            spk_cond_emb = self.get_emb(input_features, attention_mask)
-
-            _, S_ref = self.semantic_codec.quantize(spk_cond_emb)
-            ref_mel = self.mel_fn(audio_22k.to(spk_cond_emb.device).float())
-            ref_target_lengths = torch.LongTensor([ref_mel.size(2)]).to(ref_mel.device)
-            feat = torchaudio.compliance.kaldi.fbank(audio_16k.to(ref_mel.device),
-                                                     num_mel_bins=80,
-                                                     dither=0,
-                                                     sample_frequency=16000)
-            feat = feat - feat.mean(dim=0, keepdim=True)  # feat2另外一个滤波器能量组特征[922, 80]
-            style = self.campplus_model(feat.unsqueeze(0))  # 参考音频的全局style2[1,192]
-
-            prompt_condition = self.s2mel.models['length_regulator'](S_ref,
-                                                                     ylens=ref_target_lengths,
-                                                                     n_quantizers=3,
-                                                                     f0=None)[0]
-
-            self.cache_spk_cond = spk_cond_emb
-            self.cache_s2mel_style = style
-            self.cache_s2mel_prompt = prompt_condition
-            self.cache_spk_audio_prompt = spk_audio_prompt
-            self.cache_mel = ref_mel
-        else:
-            style = self.cache_s2mel_style
-            prompt_condition = self.cache_s2mel_prompt
-            spk_cond_emb = self.cache_spk_cond
-            ref_mel = self.cache_mel
+    def _cond_cache_key(self, kind, audio_prompt):
+        # the file modification time invalidates entries of a prompt that was overwritten in place
+        try:
+            mtime = os.path.getmtime(audio_prompt)
+        except OSError:
+            mtime = None
+        return kind, os.path.abspath(audio_prompt), mtime
 
+    def _prefix_key(self, spk_audio_prompt, emo_audio_prompt, emo_alpha, emo_vector, use_random):
+        """
+        Key of the GPT conditioning of these inputs in the prefix cache (`UnifiedVoice.get_conditioning_prefix()`),
+        made of the conditioning cache keys of the prompts and the emotion mixing arguments; None when the emotion
+        vector is not reproducible (`use_random`).
+        """
+        if emo_vector is not None and use_random:
+            return None
+
+        def prompt_key(kind, prompt):
+            return prompt.key if isinstance(prompt, VoiceProfile) else self._cond_cache_key(kind, prompt)
+
+        return (prompt_key("spk", spk_audio_prompt), prompt_key("emo", emo_audio_prompt), float(emo_alpha),
+                None if emo_vector is None else tuple(float(x) for x in emo_vector))
+
+    def create_voice_profile(self, spk_audio_prompt, output_path=None, verbose=False):
+        """
+        Precompute the conditioning of a reference voice, to pass it to `infer()` instead of the audio path.
+        Args:
+            spk_audio_prompt (str): path to the reference audio.
+            output_path (str): if given, save the profile there as a safetensors file.
+        Returns: VoiceProfile
+        """
+        conds = self._get_spk_conditions(spk_audio_prompt, verbose)
+        profile = VoiceProfile(conds, audio_sha256(spk_audio_prompt), self.model_version, source=spk_audio_prompt)
+        if output_path:
+            profile.save(output_path)
+            if verbose:
+                print(f">> voice profile of {spk_audio_prompt} saved to: {output_path}")
+        return profile
+
+    def load_voice_profile(self, path):
+        """
+        Load a voice profile saved by `create_voice_profile()` onto the model device.
+        Raises ValueError if it was computed by another model version.
+        """
+        profile = VoiceProfile.load(path)
+        model_version = None if self.model_version is None else str(self.model_version)
+        if profile.model_version != model_version:
+            raise ValueError(f"voice profile {path} was created with model version {profile.model_version}, "
+                             f"but the loaded model version is {model_version}")
+        return profile.to(self.device)
+
+    @torch.no_grad()
+    def _get_spk_conditions(self, spk_audio_prompt, verbose=False):
+        """
+        Speaker conditioning of the reference audio, cached per prompt in `self.cond_cache`.
+        `spk_audio_prompt` can also be a `VoiceProfile`, whose precomputed conditioning is returned as is.
+        Returns: dict of
+            spk_cond_latent: conformer-perceiver output of the GPT, (1, 32, dim)
+            emovec: emotion vector of the speaker prompt, (1, dim)
+            style: CAMPPlus global style, (1, 192)
+            prompt_condition: s2mel prompt condition, (1, frames, 512)
+            ref_mel: reference mel, (1, 80, frames)
+            speech_ratio: fraction of non-silent codes in the reference audio, (), how much the speaker pauses
+        """
+        if isinstance(spk_audio_prompt, VoiceProfile):
+            return spk_audio_prompt.conditions
+        with self._cond_lock:
+            return self._compute_spk_conditions(spk_audio_prompt, verbose)
+
+    def _compute_spk_conditions(self, spk_audio_prompt, verbose=False):
+        key = self._cond_cache_key("spk", spk_audio_prompt)
+        conds = self.cond_cache.get(key)
+        if conds is not None:
+            return conds
+
+        audio,sr = self._load_and_cut_audio(spk_audio_prompt,15,verbose)
+        audio_22k = torchaudio.transforms.Resample(sr, 22050)(audio)
+        audio_16k = torchaudio.transforms.Resample(sr, 16000)(audio)
+
+        inputs = self.extract_features(audio_16k, sampling_rate=16000, return_tensors="pt")
+        input_features = inputs["input_features"]
+        attention_mask = inputs["attention_mask"]
+        input_features = input_features.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        spk_cond_emb = self.get_emb(input_features, attention_mask)
+
+        ref_codes, S_ref = self.semantic_codec.quantize(spk_cond_emb)
+        ref_mel = self.mel_fn(audio_22k.to(spk_cond_emb.device).float())
+        ref_target_lengths = torch.LongTensor([ref_mel.size(2)]).to(ref_mel.device)
+        feat = torchaudio.compliance.kaldi.fbank(audio_16k.to(ref_mel.device),
+                                                 num_mel_bins=80,
+                                                 dither=0,
+                                                 sample_frequency=16000)
+        feat = feat - feat.mean(dim=0, keepdim=True)  # feat2另外一个滤波器能量组特征[922, 80]
+        style = self.campplus_model(feat.unsqueeze(0))  # 参考音频的全局style2[1,192]
+
+        prompt_condition = self.s2mel.models['length_regulator'](S_ref,
+                                                                 ylens=ref_target_lengths,
+                                                                 n_quantizers=3,
+                                                                 f0=None)[0]
+
+        conds = self._get_gpt_conditions(spk_cond_emb)
+        conds.update(style=style, prompt_condition=prompt_condition, ref_mel=ref_mel,
+                     speech_ratio=(ref_codes != 52).float().mean().cpu())
+        self.cond_cache.put(key, conds)
+        return conds
+
+    @torch.no_grad()
+    def _get_emo_conditions(self, emo_audio_prompt, verbose=False):
+        """
+        Emotion conditioning of the reference audio, cached per prompt in `self.cond_cache`.
+        `emo_audio_prompt` can also be a `VoiceProfile`.
+        Returns: dict of `emovec`, (1, dim)
+        """
+        if isinstance(emo_audio_prompt, VoiceProfile):
+            return {"emovec": emo_audio_prompt.conditions["emovec"]}
+        with self._cond_lock:
+            return self._compute_emo_conditions(emo_audio_prompt, verbose)
+
+    def _compute_emo_conditions(self, emo_audio_prompt, verbose=False):
+        key = self._cond_cache_key("emo", emo_audio_prompt)
+        conds = self.cond_cache.get(key)
+        if conds is not None:
+            return conds
+
+        emo_audio, _ = self._load_and_cut_audio(emo_audio_prompt,15,verbose,sr=16000)
+        emo_inputs = self.extract_features(emo_audio, sampling_rate=16000, return_tensors="pt")
+        emo_input_features = emo_inputs["input_features"]
+        emo_attention_mask = emo_inputs["attention_mask"]
+        emo_input_features = emo_input_features.to(self.device)
+        emo_attention_mask = emo_attention_mask.to(self.device)
+        emo_cond_emb = self.get_emb(emo_input_features, emo_attention_mask)
+
+        emo_cond_lengths = torch.tensor([emo_cond_emb.shape[-1]], device=emo_cond_emb.device)
+        with torch.amp.autocast(emo_cond_emb.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+            conds = {"emovec": self.gpt.get_emovec(emo_cond_emb, emo_cond_lengths)}
+        self.cond_cache.put(key, conds)
+        return conds
+
+    @torch.no_grad()
+    def _get_gpt_conditions(self, cond_emb):
+        """
+        Run the GPT conditioning encoders once on the w2v-bert features of a prompt.
+        Returns: dict of `spk_cond_latent` (conformer-perceiver output) and `emovec`
+        """
+        cond_lengths = torch.tensor([cond_emb.shape[-1]], device=cond_emb.device)
+        with torch.amp.autocast(cond_emb.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+            spk_cond_latent = self.gpt.get_conditioning(cond_emb.transpose(1, 2), cond_lengths)
+            emovec = self.gpt.get_emovec(cond_emb, cond_lengths)
+        return {"spk_cond_latent": spk_cond_latent, "emovec": emovec}
+
+    @torch.no_grad()
+    def _get_emovec(self, spk_conds, emo_conds, emo_alpha, emo_vector=None, use_random=False):
+        """
+        Merge the speaker and emotion references (and the optional `emo_vector`) into the GPT emotion vector.
+        """
         if emo_vector is not None:
             weight_vector = torch.tensor(emo_vector).to(self.device)
             if use_random:
                 random_index = [random.randint(0, x - 1) for x in self.emo_num]
             else:
-                random_index = [find_most_similar_cosine(style, tmp) for tmp in self.spk_matrix]
+                random_index = [find_most_similar_cosine(spk_conds["style"], tmp) for tmp in self.spk_matrix]
 
             emo_matrix = [tmp[index].unsqueeze(0) for index, tmp in zip(random_index, self.emo_matrix)]
             emo_matrix = torch.cat(emo_matrix, 0)
@@ -426,22 +660,491 @@ class IndexTTS2:
             emovec_mat = torch.sum(emovec_mat, 0)
             emovec_mat = emovec_mat.unsqueeze(0)
 
-        if self.cache_emo_cond is None or self.cache_emo_audio_prompt != emo_audio_prompt:
-            if self.cache_emo_cond is not None:
-                self.cache_emo_cond = None
-                torch.cuda.empty_cache()
-            emo_audio, _ = self._load_and_cut_audio(emo_audio_prompt,15,verbose,sr=16000)
-            emo_inputs = self.extract_features(emo_audio, sampling_rate=16000, return_tensors="pt")
-            emo_input_features = emo_inputs["input_features"]
-            emo_attention_mask = emo_inputs["attention_mask"]
-            emo_input_features = emo_input_features.to(self.device)
-            emo_attention_mask = emo_attention_mask.to(self.device)
-            emo_cond_emb = self.get_emb(emo_input_features, emo_attention_mask)
-
-            self.cache_emo_cond = emo_cond_emb
-            self.cache_emo_audio_prompt = emo_audio_prompt
+        # same as `UnifiedVoice.merge_emovec()`, on the cached per-prompt emovecs
+        base_vec = spk_conds["emovec"]
+        emovec = base_vec + emo_alpha * (emo_conds["emovec"] - base_vec)
+
+        if emo_vector is not None:
+            emovec = emovec_mat + (1 - torch.sum(weight_vector)) * emovec
+            # emovec = emovec_mat
+        return emovec
+
+    def _use_decode_scheduler(self, num_beams, length_penalty, generation_kwargs):
+        """
+        Whether a segment is decoded by `self.decode_scheduler`: it only does sampling or greedy search with the
+        repetition penalty, temperature, top-k and top-p of `infer()`, the other requests go through
+        `inference_speech()`.
+        """
+        return (self.decode_scheduler is not None and num_beams == 1 and not length_penalty
+                and not generation_kwargs)
+
+    @staticmethod
+    def _warn_truncated(max_generate_length, max_mel_tokens, max_silent_tokens, max_text_tokens_per_segment,
+                        text_tokens=None):
+        warnings.warn(
+            f"WARN: generation stopped without a stop token, at the token budget ({max_generate_length}, "
+            f"`max_mel_tokens` {max_mel_tokens})"
+            + (f" or after {max_silent_tokens} silent tokens" if max_silent_tokens else "") + ". "
+            + (f"Input text tokens: {text_tokens}. " if text_tokens is not None else "")
+            + f"Consider reducing `max_text_tokens_per_segment`({max_text_tokens_per_segment}) or increasing "
+              f"`max_mel_tokens` / `mel_budget_slack`.",
+            category=TruncatedSegmentWarning, stacklevel=3,
+        )
+
+    def _mel_token_budget(self, sent, spk_conds, max_mel_tokens, slack):
+        """
+        Maximum number of codes of the text segment `sent` (tokens), see `get_mel_token_budget()`; capped by
+        `max_mel_tokens`, which is also the budget when `slack` is None.
+        The duration of the text is estimated at the slowest speaking rate of `get_text_tts_dur()`: there is no
+        transcript of the reference audio to measure the speaker's own rate. The only per-speaker statistic is how
+        much the speaker pauses (`speech_ratio` of `spk_conds`); the codes themselves run at the fixed rate of the
+        semantic codec, `CODE_RATE` per second.
+        The budget only bounds the decoding steps (`max_generate_length`): the static KV cache and the captured
+        decode steps keep their size for `max_mel_tokens`, they are allocated once and reused by every call.
+        """
+        if slack is None:
+            return max_mel_tokens
+        text = self.tokenizer.decode(self.tokenizer.convert_tokens_to_ids(sent))
+        speech_ratio = float(spk_conds.get("speech_ratio", 1.0))
+        return min(max_mel_tokens, get_mel_token_budget(text, CODE_RATE, speech_ratio, slack))
+
+    def _pop_cfm_kwargs(self, generation_kwargs):
+        """
+        Pop the s2mel sampling options from the `**generation_kwargs` of `infer()`.
+        Returns: kwargs of `CFM.inference()`
+            diffusion_steps: number of sampling steps, default 25
+            inference_cfg_rate: classifier-free guidance rate, default 0.7
+            ode_solver: "euler", "midpoint", "heun" or "multistep", see `flow_matching.ODE_SOLVERS`
+            sway_coef: sway sampling coefficient of the timesteps (e.g. -1.0), default None (uniform)
+            cfg_steps: only apply classifier-free guidance on the first `cfg_steps` steps, default None (all)
+            cfg_schedule: decay of `inference_cfg_rate` over the steps, "constant", "linear" or "cosine"
+            cfm_progress: called as `cfm_progress(step, n_steps)` after every sampling step, default None
+        """
+        return {
+            "n_timesteps": generation_kwargs.pop("diffusion_steps", 25),
+            "inference_cfg_rate": generation_kwargs.pop("inference_cfg_rate", 0.7),
+            "solver": generation_kwargs.pop("ode_solver", "euler"),
+            "sway_coef": generation_kwargs.pop("sway_coef", None),
+            "cfg_steps": generation_kwargs.pop("cfg_steps", None),
+            "cfg_schedule": generation_kwargs.pop("cfg_schedule", "constant"),
+            "progress": generation_kwargs.pop("cfm_progress", None),
+            "max_prompt_len": self.max_prompt_frames,
+        }
+
+    # 快速推理：分句按长度分桶，GPT、s2mel 和 BigVGAN 都按批推理
+    def infer_fast(self, spk_audio_prompt, text, output_path,
+                   emo_audio_prompt=None, emo_alpha=1.0,
+                   emo_vector=None,
+                   use_emo_text=False, emo_text=None, use_random=False, interval_silence=200,
+                   verbose=False, max_text_tokens_per_segment=120, segments_bucket_max_size=4,
+                   **generation_kwargs):
+        """
+        Args:
+            ``spk_audio_prompt``: 参考音频路径，或 ``create_voice_profile()`` 预先计算的 ``VoiceProfile``
+            ``max_text_tokens_per_segment``: 分句的最大token数，默认``120``，可以根据GPU硬件情况调整
+                - 越小，batch 越多，推理速度越*快*，占用内存更多，可能影响质量
+                - 越大，batch 越少，推理速度越*慢*，占用内存和质量更接近于非快速推理
+            ``segments_bucket_max_size``: 分句分桶的最大容量，默认``4``，可以根据GPU内存调整
+                - 越大，bucket数量越少，batch越多，推理速度越*快*，占用内存更多，可能影响质量
+                - 越小，bucket数量越多，batch越少，推理速度越*慢*，占用内存和质量更接近于非快速推理
+            Other arguments are the same as `infer()`.
+        """
+        print(">> starting fast inference...")
+        self._set_gr_progress(0, "starting fast inference...")
+        if verbose:
+            print(f"origin text:{text}, spk_audio_prompt:{spk_audio_prompt}, "
+                  f"emo_audio_prompt:{emo_audio_prompt}, emo_alpha:{emo_alpha}, "
+                  f"emo_vector:{emo_vector}, use_emo_text:{use_emo_text}, "
+                  f"emo_text:{emo_text}")
+        start_time = time.perf_counter()
+
+        emo_audio_prompt, emo_alpha, emo_vector = self._prepare_emo_args(
+            text, spk_audio_prompt, emo_audio_prompt, emo_alpha, emo_vector, use_emo_text, emo_text)
+        spk_conds = self._get_spk_conditions(spk_audio_prompt, verbose)
+        emo_conds = self._get_emo_conditions(emo_audio_prompt, verbose)
+        emovec = self._get_emovec(spk_conds, emo_conds, emo_alpha, emo_vector, use_random)
+        prefix_key = self._prefix_key(spk_audio_prompt, emo_audio_prompt, emo_alpha, emo_vector, use_random)
+        spk_cond_latent = spk_conds["spk_cond_latent"]
+        style = spk_conds["style"]
+        prompt_condition = spk_conds["prompt_condition"]
+        ref_mel = spk_conds["ref_mel"]
+
+        # text_tokens
+        self._set_gr_progress(0.1, "text processing...")
+        text_tokens_list = self.tokenizer.tokenize(text)
+        segments = self.tokenizer.split_segments(text_tokens_list, max_text_tokens_per_segment)
+        if verbose:
+            print(">> text token count:", len(text_tokens_list))
+            print("   segments count:", len(segments))
+            print("   max_text_tokens_per_segment:", max_text_tokens_per_segment)
+            print(*segments, sep="\n")
+        do_sample = generation_kwargs.pop("do_sample", True)
+        top_p = generation_kwargs.pop("top_p", 0.8)
+        top_k = generation_kwargs.pop("top_k", 30)
+        temperature = generation_kwargs.pop("temperature", 0.8)
+        autoregressive_batch_size = 1
+        length_penalty = generation_kwargs.pop("length_penalty", 0.0)
+        num_beams = generation_kwargs.pop("num_beams", 3)
+        repetition_penalty = generation_kwargs.pop("repetition_penalty", 10.0)
+        max_mel_tokens = generation_kwargs.pop("max_mel_tokens", 1500)
+        mel_budget_slack = generation_kwargs.pop("mel_budget_slack", None)
+        max_silent_tokens = generation_kwargs.pop("max_silent_tokens", None)
+        stopping_criteria = StoppingCriteriaList([SilenceStoppingCriteria(52, max_silent_tokens)]) \
+            if max_silent_tokens else None
+        sampling_rate = 22050
+        hop_length = self.cfg.s2mel['preprocess_params']['spect_params']['hop_length']
+        cfm_kwargs = self._pop_cfm_kwargs(generation_kwargs)
+
+        gpt_gen_time = 0
+        gpt_forward_time = 0
+        s2mel_time = 0
+        bigvgan_time = 0
+
+        bucket_max_size = segments_bucket_max_size if self.device != "cpu" else 1
+        # each batch stops at the budget of its longest segment; without `mel_budget_slack` every budget is
+        # `max_mel_tokens`, so the segments are bucketed by their token count
+        budgets = [self._mel_token_budget(sent, spk_conds, max_mel_tokens, mel_budget_slack) for sent in segments]
+        all_segments = self.bucket_segments(segments, bucket_max_size=bucket_max_size,
+                                            lengths=budgets if mel_budget_slack is not None else None)
+        bucket_count = len(all_segments)
+        if verbose:
+            print(">> segments bucket_count:", bucket_count,
+                  "bucket sizes:", [(len(s), [t["idx"] for t in s]) for s in all_segments],
+                  "bucket_max_size:", bucket_max_size)
+
+        # Sequential processing of bucketing data, each bucket runs as one batch through GPT and s2mel
+        all_batch_num = sum(len(s) for s in all_segments)
+        all_mels: Dict[int, torch.Tensor] = {}
+        processed_num = 0
+        has_warned = False
+        for bucket in all_segments:
+            batch_num = len(bucket)
+            item_tokens: List[torch.Tensor] = []
+            for item in bucket:
+                text_tokens = self.tokenizer.convert_tokens_to_ids(item["sent"])
+                text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=self.device).unsqueeze(0)
+                item_tokens.append(text_tokens)
+            if batch_num > 1:
+                batch_text_tokens = self.pad_tokens_cat(item_tokens)
+            else:
+                batch_text_tokens = item_tokens[0]
+            text_lens = torch.tensor([t.shape[-1] for t in item_tokens], device=self.device)
+            max_generate_length = max(budgets[item["idx"]] for item in bucket)
+            processed_num += batch_num
+            self._set_gr_progress(0.2 + 0.6 * processed_num / all_batch_num,
+                                  f"speech synthesis {processed_num}/{all_batch_num}...")
+
+            # gpt speech
+            m_start_time = time.perf_counter()
+            with torch.no_grad():
+                with self._decode_lock, torch.amp.autocast(batch_text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                    outputs = self.gpt.inference_speech(
+                        None,
+                        batch_text_tokens,
+                        speech_conditioning_latent=spk_cond_latent,
+                        emo_vec=emovec,
+                        do_sample=do_sample,
+                        top_p=top_p,
+                        top_k=top_k,
+                        temperature=temperature,
+                        num_return_sequences=autoregressive_batch_size,
+                        length_penalty=length_penalty,
+                        num_beams=num_beams,
+                        repetition_penalty=repetition_penalty,
+                        max_generate_length=max_generate_length,
+                        stopping_criteria=stopping_criteria,
+                        return_latent=self.fused_gpt_latent,
+                        fused_sampler=self.fused_sampler,
+                        prefix_key=prefix_key,
+                        tree_beam_search=self.tree_beam_search and batch_text_tokens.shape[0] == 1
+                        and not generation_kwargs,
+                        **generation_kwargs
+                    )
+                    codes, speech_conditioning_latent = outputs[:2]
+                    latent = outputs[2] if self.fused_gpt_latent else None
+            gpt_gen_time += time.perf_counter() - m_start_time
+            if not has_warned and (codes[:, -1] != self.stop_mel_token).any():
+                self._warn_truncated(max_generate_length, max_mel_tokens, max_silent_tokens,
+                                     max_text_tokens_per_segment)
+                has_warned = True
+
+            if latent is not None:
+                codes, code_lens, latent = self.remove_long_silence(codes, silent_token=52, max_consecutive=30,
+                                                                    latent=latent)
+            else:
+                codes, code_lens = self.remove_long_silence(codes, silent_token=52, max_consecutive=30)
+            if verbose:
+                print("fix codes:", codes.shape)
+                print(codes)
+                print("code_lens:", code_lens)
+
+            # gpt latent, the padded batch is masked so every item sees only its own text and codes
+            if latent is None:
+                m_start_time = time.perf_counter()
+                with torch.no_grad():
+                    with torch.amp.autocast(batch_text_tokens.device.type, enabled=self.dtype is not None,
+                                            dtype=self.dtype):
+                        latent = self.gpt(
+                            speech_conditioning_latent.expand(batch_num, -1, -1),
+                            batch_text_tokens,
+                            text_lens,
+                            codes,
+                            code_lens,
+                            emo_vec=emovec,
+                            use_speed=torch.zeros(batch_num, device=self.device).long(),
+                            mask_padding=True,
+                        )
+                gpt_forward_time += time.perf_counter() - m_start_time
+
+            # s2mel, the length regulator interpolates to the longest item so it runs per item, the CFM samples
+            # the bucket in one loop
+            m_start_time = time.perf_counter()
+            with self._synth_lock, torch.no_grad():
+                latent = self.s2mel.models['gpt_layer'](latent)
+                mus = []
+                for i in range(batch_num):
+                    code_len = code_lens[i].item()
+                    S_infer = self.semantic_codec.quantizer.vq2emb(codes[i:i + 1, :code_len].unsqueeze(1))
+                    S_infer = S_infer.transpose(1, 2)
+                    S_infer = S_infer + latent[i:i + 1, :code_len]
+                    target_lengths = (code_lens[i:i + 1] * 1.72).long()
+                    cond = self.s2mel.models['length_regulator'](S_infer,
+                                                                 ylens=target_lengths,
+                                                                 n_quantizers=3,
+                                                                 f0=None)[0]
+                    mus.append(torch.cat([prompt_condition[0], cond[0]], dim=0))
+                vc_targets = self.s2mel.models['cfm'].inference_batch(mus, [ref_mel[0]] * batch_num,
+                                                                      style.expand(batch_num, -1), **cfm_kwargs)
+                for item, vc_target in zip(bucket, vc_targets):
+                    all_mels[item["idx"]] = vc_target
+            s2mel_time += time.perf_counter() - m_start_time
+
+        # bigvgan chunk, consecutive segments are vocoded together and split back at the frame boundaries; the tiled
+        # vocoder bounds the memory whatever the length, so it takes all of them at once
+        chunk_size = max(len(all_mels), 1) if self.vocoder.chunk_frames else 2
+        all_mels = [all_mels[i] for i in sorted(all_mels.keys())]
+        chunk_mels = [all_mels[i: i + chunk_size] for i in range(0, len(all_mels), chunk_size)]
+        chunk_length = len(chunk_mels)
+        self._set_gr_progress(0.8, "bigvgan decoding...")
+        wavs = []
+        for items in chunk_mels:
+            mel = torch.cat(items, dim=-1).unsqueeze(0)
+            m_start_time = time.perf_counter()
+            with self._synth_lock, torch.no_grad():
+                wav = self.vocoder(mel.float()).squeeze(1)
+            bigvgan_time += time.perf_counter() - m_start_time
+            split_sizes = [m.size(-1) * hop_length for m in items]
+            split_sizes[-1] = wav.size(-1) - sum(split_sizes[:-1])
+            for item_wav in torch.split(wav, split_sizes, dim=-1):
+                item_wav = torch.clamp(32767 * item_wav, -32767.0, 32767.0)
+                wavs.append(item_wav.cpu())  # to cpu before saving
+        del all_mels, chunk_mels
+        end_time = time.perf_counter()
+        self.torch_empty_cache()
+
+        self._set_gr_progress(0.9, "saving audio...")
+        wavs = self.insert_interval_silence(wavs, sampling_rate=sampling_rate, interval_silence=interval_silence)
+        wav = torch.cat(wavs, dim=1)
+        wav_length = wav.shape[-1] / sampling_rate
+        print(f">> gpt_gen_time: {gpt_gen_time:.2f} seconds")
+        print(f">> gpt_forward_time: {gpt_forward_time:.2f} seconds")
+        print(f">> s2mel_time: {s2mel_time:.2f} seconds")
+        print(f">> bigvgan_time: {bigvgan_time:.2f} seconds")
+        print(f">> Total fast inference time: {end_time - start_time:.2f} seconds")
+        print(f">> Generated audio length: {wav_length:.2f} seconds")
+        print(f">> [fast] bigvgan chunk_length: {chunk_length}")
+        print(f">> [fast] batch_num: {all_batch_num} bucket_max_size: {bucket_max_size}",
+              f"bucket_count: {bucket_count}" if bucket_max_size > 1 else "")
+        print(f">> [fast] RTF: {(end_time - start_time) / wav_length:.4f}")
+
+        # save audio
+        wav = wav.cpu()  # to cpu
+        if output_path:
+            # 直接保存音频到指定路径中
+            if os.path.isfile(output_path):
+                os.remove(output_path)
+                print(">> remove old wav file:", output_path)
+            if os.path.dirname(output_path) != "":
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            torchaudio.save(output_path, wav.type(torch.int16), sampling_rate)
+            print(">> wav file saved to:", output_path)
+            return output_path
         else:
-            emo_cond_emb = self.cache_emo_cond
+            # 返回以符合Gradio的格式要求
+            wav_data = wav.type(torch.int16)
+            wav_data = wav_data.numpy().T
+            return (sampling_rate, wav_data)
+
+    # 原始推理模式
+    def infer(self, spk_audio_prompt, text, output_path,
+              emo_audio_prompt=None, emo_alpha=1.0,
+              emo_vector=None,
+              use_emo_text=False, emo_text=None, use_random=False, interval_silence=200,
+              verbose=False, max_text_tokens_per_segment=120, **generation_kwargs):
+        """
+        Args:
+            ``spk_audio_prompt``: 参考音频路径，或 ``create_voice_profile()`` 预先计算的 ``VoiceProfile``
+            ``emo_audio_prompt``: 情感参考音频路径，或 ``VoiceProfile``
+            ``mel_budget_slack``: 按分句音节数的上限估计和参考音频的停顿比例给每个分句一个 mel token 预算，再乘以此系数
+                （如 ``1.5``），不超过 ``max_mel_tokens``；默认 ``None``，只用 ``max_mel_tokens``
+            ``max_silent_tokens``: 连续生成这么多个静音 token 后停止该分句（如 ``60``）；默认 ``None``，不启用
+            没有生成结束 token 就停止的分句会发出 ``TruncatedSegmentWarning``
+        """
+        print(">> starting inference...")
+        self._set_gr_progress(0, "starting inference...")
+        if verbose:
+            print(f"origin text:{text}, spk_audio_prompt:{spk_audio_prompt}, "
+                  f"emo_audio_prompt:{emo_audio_prompt}, emo_alpha:{emo_alpha}, "
+                  f"emo_vector:{emo_vector}, use_emo_text:{use_emo_text}, "
+                  f"emo_text:{emo_text}")
+        start_time = time.perf_counter()
+        sampling_rate = 22050
+
+        timings = {}
+        wavs = [wav for _, wav, _ in self._infer_segments(
+            spk_audio_prompt, text, emo_audio_prompt=emo_audio_prompt, emo_alpha=emo_alpha,
+            emo_vector=emo_vector, use_emo_text=use_emo_text, emo_text=emo_text, use_random=use_random,
+            verbose=verbose, max_text_tokens_per_segment=max_text_tokens_per_segment, timings=timings,
+            **generation_kwargs)]
+        end_time = time.perf_counter()
+
+        self._set_gr_progress(0.9, "saving audio...")
+        wavs = self.insert_interval_silence(wavs, sampling_rate=sampling_rate, interval_silence=interval_silence)
+        wav = torch.cat(wavs, dim=1)
+        wav_length = wav.shape[-1] / sampling_rate
+        print(f">> gpt_gen_time: {timings['gpt_gen_time']:.2f} seconds")
+        if self.speculative_drafter is not None:
+            print(f">> speculative decoding (since loading): {format_stats(self.speculative_drafter.stats)}")
+        print(f">> gpt_forward_time: {timings['gpt_forward_time']:.2f} seconds")
+        print(f">> s2mel_time: {timings['s2mel_time']:.2f} seconds")
+        print(f">> bigvgan_time: {timings['bigvgan_time']:.2f} seconds")
+        print(f">> Total inference time: {end_time - start_time:.2f} seconds")
+        print(f">> Generated audio length: {wav_length:.2f} seconds")
+        print(f">> RTF: {(end_time - start_time) / wav_length:.4f}")
+
+        # save audio
+        wav = wav.cpu()  # to cpu
+        if output_path:
+            # 直接保存音频到指定路径中
+            if os.path.isfile(output_path):
+                os.remove(output_path)
+                print(">> remove old wav file:", output_path)
+            if os.path.dirname(output_path) != "":
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            torchaudio.save(output_path, wav.type(torch.int16), sampling_rate)
+            print(">> wav file saved to:", output_path)
+            return output_path
+        else:
+            # 返回以符合Gradio的格式要求
+            wav_data = wav.type(torch.int16)
+            wav_data = wav_data.numpy().T
+            return (sampling_rate, wav_data)
+
+    # 流式推理：每个分句合成完成后立即返回其音频
+    def infer_stream(self, spk_audio_prompt, text,
+                     emo_audio_prompt=None, emo_alpha=1.0,
+                     emo_vector=None,
+                     use_emo_text=False, emo_text=None, use_random=False, interval_silence=200,
+                     verbose=False, max_text_tokens_per_segment=120, cancel_event=None,
+                     sub_segment=False, first_chunk_codes=40, chunk_codes=80, overlap_codes=8, **generation_kwargs):
+        """
+        Generator version of `infer()`: yields the audio of each text segment as soon as BigVGAN has decoded it.
+
+        Args:
+            ``interval_silence``: 分句之间的静音时长（毫秒），加在每个分句第一个音频块的前面（第一个分句除外）
+            ``cancel_event``: 可选的 ``threading.Event``，设置后停止合成。
+                也可以直接对生成器调用 ``close()`` 来取消。
+            ``sub_segment``: 低延迟模式，GPT 每生成 ``chunk_codes`` 个 mel code 就合成一个音频块，
+                不再等待整个分句生成完毕（只支持 ``num_beams=1`` 采样）
+            ``first_chunk_codes``: 低延迟模式下第一个音频块的 code 数，越小首包延迟越低
+            ``chunk_codes``: 低延迟模式下后续音频块的 code 数
+            ``overlap_codes``: 相邻音频块重叠的 code 数，s2mel 以此为左侧上下文，重叠部分的音频做交叉淡化
+            Other arguments are the same as `infer()`.
+        Yields: dict of
+            wav: int16 PCM of the chunk, (1, samples)
+            sampling_rate: 22050
+            index: chunk index
+            segment: index of the text segment of the chunk
+            chunk_time: seconds spent synthesizing this chunk
+            elapsed: seconds since the call started (for the first chunk, the time to first audio)
+            audio_duration: seconds of audio in this chunk
+            truncated: the segment stopped without the stop token, on its last chunk (see `TruncatedSegmentWarning`)
+        """
+        if verbose:
+            print(f"origin text:{text}, spk_audio_prompt:{spk_audio_prompt}, "
+                  f"emo_audio_prompt:{emo_audio_prompt}, emo_alpha:{emo_alpha}, "
+                  f"emo_vector:{emo_vector}, use_emo_text:{use_emo_text}, "
+                  f"emo_text:{emo_text}")
+        start_time = time.perf_counter()
+        sampling_rate = 22050
+        silence = torch.zeros(1, int(sampling_rate * interval_silence / 1000.0)) if interval_silence > 0 else None
+
+        timings = {}
+        segment_wavs = self._infer_segments(
+            spk_audio_prompt, text, emo_audio_prompt=emo_audio_prompt, emo_alpha=emo_alpha,
+            emo_vector=emo_vector, use_emo_text=use_emo_text, emo_text=emo_text, use_random=use_random,
+            verbose=verbose, max_text_tokens_per_segment=max_text_tokens_per_segment, timings=timings,
+            should_stop=cancel_event.is_set if cancel_event is not None else None,
+            stream_chunks=dict(first_chunk_codes=first_chunk_codes, chunk_codes=chunk_codes,
+                               overlap_codes=overlap_codes) if sub_segment else None,
+            **generation_kwargs)
+        chunk_start_time = start_time
+        last_seg_idx = 0
+        try:
+            for index, (seg_idx, wav, truncated) in enumerate(segment_wavs):
+                if seg_idx != last_seg_idx and silence is not None:
+                    wav = torch.cat([silence.expand(wav.size(0), -1), wav], dim=1)
+                last_seg_idx = seg_idx
+                now = time.perf_counter()
+                chunk = {
+                    "wav": wav.type(torch.int16),
+                    "sampling_rate": sampling_rate,
+                    "index": index,
+                    "segment": seg_idx,
+                    "chunk_time": now - chunk_start_time,
+                    "elapsed": now - start_time,
+                    "audio_duration": wav.shape[-1] / sampling_rate,
+                    "truncated": truncated,
+                }
+                if verbose:
+                    print(f">> chunk {index}: {chunk['audio_duration']:.2f}s audio, "
+                          f"synthesized in {chunk['chunk_time']:.2f}s, elapsed {chunk['elapsed']:.2f}s")
+                yield chunk
+                chunk_start_time = time.perf_counter()
+        finally:
+            # stop the segment generator when the caller cancels by closing this one
+            segment_wavs.close()
+
+    def _infer_segments(self, spk_audio_prompt, text,
+                        emo_audio_prompt=None, emo_alpha=1.0,
+                        emo_vector=None,
+                        use_emo_text=False, emo_text=None, use_random=False,
+                        verbose=False, max_text_tokens_per_segment=120, timings=None, should_stop=None,
+                        stream_chunks=None, **generation_kwargs):
+        """
+        Synthesize `text` one segment at a time, shared by `infer()` and `infer_stream()`.
+        Yields: (segment index, wav, truncated) of each segment, wav is (1, samples) on cpu, scaled to the int16 range;
+        `truncated` is True if the segment stopped without the stop token (see `TruncatedSegmentWarning`).
+        `timings` accumulates the seconds spent in each stage; synthesis stops before the next
+        segment once `should_stop()` returns True.
+        With `stream_chunks` (kwargs of `_infer_segment_chunks()`), each segment is yielded in several
+        chunks while the GPT is still generating it.
+        """
+        if timings is None:
+            timings = {}
+        for key in ("gpt_gen_time", "gpt_forward_time", "s2mel_time", "bigvgan_time"):
+            timings.setdefault(key, 0)
+
+        emo_audio_prompt, emo_alpha, emo_vector = self._prepare_emo_args(
+            text, spk_audio_prompt, emo_audio_prompt, emo_alpha, emo_vector, use_emo_text, emo_text)
+        spk_conds = self._get_spk_conditions(spk_audio_prompt, verbose)
+        emo_conds = self._get_emo_conditions(emo_audio_prompt, verbose)
+        emovec = self._get_emovec(spk_conds, emo_conds, emo_alpha, emo_vector, use_random)
+        prefix_key = self._prefix_key(spk_audio_prompt, emo_audio_prompt, emo_alpha, emo_vector, use_random)
+        spk_cond_latent = spk_conds["spk_cond_latent"]
+        style = spk_conds["style"]
+        prompt_condition = spk_conds["prompt_condition"]
+        ref_mel = spk_conds["ref_mel"]
 
         self._set_gr_progress(0.1, "text processing...")
         text_tokens_list = self.tokenizer.tokenize(text)
@@ -468,15 +1171,18 @@ class IndexTTS2:
         num_beams = generation_kwargs.pop("num_beams", 3)
         repetition_penalty = generation_kwargs.pop("repetition_penalty", 10.0)
         max_mel_tokens = generation_kwargs.pop("max_mel_tokens", 1500)
-        sampling_rate = 22050
+        mel_budget_slack = generation_kwargs.pop("mel_budget_slack", None)
+        max_silent_tokens = generation_kwargs.pop("max_silent_tokens", None)
+        stopping_criteria = StoppingCriteriaList([SilenceStoppingCriteria(52, max_silent_tokens)]) \
+            if max_silent_tokens else None
+        cfm_kwargs = self._pop_cfm_kwargs(generation_kwargs)
 
-        wavs = []
-        gpt_gen_time = 0
-        gpt_forward_time = 0
-        s2mel_time = 0
-        bigvgan_time = 0
         has_warned = False
         for seg_idx, sent in enumerate(segments):
+            if should_stop is not None and should_stop():
+                if verbose:
+                    print(f">> synthesis stopped before segment {seg_idx + 1}/{segments_count}")
+                return
             self._set_gr_progress(0.2 + 0.7 * seg_idx / segments_count,
                                   f"speech synthesis {seg_idx + 1}/{segments_count}...")
 
@@ -488,49 +1194,69 @@ class IndexTTS2:
                 # debug tokenizer
                 text_token_syms = self.tokenizer.convert_ids_to_tokens(text_tokens[0].tolist())
                 print("text_token_syms is same as segment tokens", text_token_syms == sent)
+            max_generate_length = self._mel_token_budget(sent, spk_conds, max_mel_tokens, mel_budget_slack)
+
+            if stream_chunks is not None:
+                chunks = self._infer_segment_chunks(text_tokens, spk_conds, emovec, timings=timings,
+                                                    should_stop=should_stop, verbose=verbose, do_sample=do_sample,
+                                                    top_p=top_p, top_k=top_k, temperature=temperature,
+                                                    repetition_penalty=repetition_penalty,
+                                                    max_mel_tokens=max_generate_length,
+                                                    max_silent_tokens=max_silent_tokens or 0, cfm_kwargs=cfm_kwargs,
+                                                    prefix_key=prefix_key, **stream_chunks, **generation_kwargs)
+                for wav, truncated in chunks:
+                    if not has_warned and truncated:
+                        self._warn_truncated(max_generate_length, max_mel_tokens, max_silent_tokens,
+                                             max_text_tokens_per_segment, text_tokens.shape[1])
+                        has_warned = True
+                    yield seg_idx, wav, truncated
+                continue
 
             m_start_time = time.perf_counter()
             with torch.no_grad():
-                with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
-                    emovec = self.gpt.merge_emovec(
-                        spk_cond_emb,
-                        emo_cond_emb,
-                        torch.tensor([spk_cond_emb.shape[-1]], device=text_tokens.device),
-                        torch.tensor([emo_cond_emb.shape[-1]], device=text_tokens.device),
-                        alpha=emo_alpha
-                    )
-
-                    if emo_vector is not None:
-                        emovec = emovec_mat + (1 - torch.sum(weight_vector)) * emovec
-                        # emovec = emovec_mat
-
-                    codes, speech_conditioning_latent = self.gpt.inference_speech(
-                        spk_cond_emb,
-                        text_tokens,
-                        emo_cond_emb,
-                        cond_lengths=torch.tensor([spk_cond_emb.shape[-1]], device=text_tokens.device),
-                        emo_cond_lengths=torch.tensor([emo_cond_emb.shape[-1]], device=text_tokens.device),
-                        emo_vec=emovec,
-                        do_sample=True,
-                        top_p=top_p,
-                        top_k=top_k,
-                        temperature=temperature,
-                        num_return_sequences=autoregressive_batch_size,
-                        length_penalty=length_penalty,
-                        num_beams=num_beams,
-                        repetition_penalty=repetition_penalty,
-                        max_generate_length=max_mel_tokens,
-                        **generation_kwargs
-                    )
-
-                gpt_gen_time += time.perf_counter() - m_start_time
-                if not has_warned and (codes[:, -1] != self.stop_mel_token).any():
-                    warnings.warn(
-                        f"WARN: generation stopped due to exceeding `max_mel_tokens` ({max_mel_tokens}). "
-                        f"Input text tokens: {text_tokens.shape[1]}. "
-                        f"Consider reducing `max_text_tokens_per_segment`({max_text_tokens_per_segment}) or increasing `max_mel_tokens`.",
-                        category=RuntimeWarning
-                    )
+                if self._use_decode_scheduler(num_beams, length_penalty, generation_kwargs):
+                    # decoded in a shared batch with the segments of the other running requests
+                    codes = self.decode_scheduler.generate(text_tokens, spk_cond_latent, emovec, do_sample=do_sample,
+                                                           top_p=top_p, top_k=top_k, temperature=temperature,
+                                                           repetition_penalty=repetition_penalty,
+                                                           max_generate_length=max_generate_length,
+                                                           max_silent_tokens=max_silent_tokens or 0,
+                                                           return_latent=self.fused_gpt_latent,
+                                                           prefix_key=prefix_key)
+                    codes, latent = codes if self.fused_gpt_latent else (codes, None)
+                    speech_conditioning_latent = spk_cond_latent
+                else:
+                    with self._decode_lock, torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                        outputs = self.gpt.inference_speech(
+                            None,
+                            text_tokens,
+                            speech_conditioning_latent=spk_cond_latent,
+                            emo_vec=emovec,
+                            do_sample=do_sample,
+                            top_p=top_p,
+                            top_k=top_k,
+                            temperature=temperature,
+                            num_return_sequences=autoregressive_batch_size,
+                            length_penalty=length_penalty,
+                            num_beams=num_beams,
+                            repetition_penalty=repetition_penalty,
+                            max_generate_length=max_generate_length,
+                            stopping_criteria=stopping_criteria,
+                            return_latent=self.fused_gpt_latent,
+                            drafter=self.speculative_drafter if num_beams == 1 else None,
+                            fused_sampler=self.fused_sampler,
+                            prefix_key=prefix_key,
+                            tree_beam_search=self.tree_beam_search and not generation_kwargs,
+                            **generation_kwargs
+                        )
+                    codes, speech_conditioning_latent = outputs[:2]
+                    latent = outputs[2] if self.fused_gpt_latent else None
+
+                timings["gpt_gen_time"] += time.perf_counter() - m_start_time
+                truncated = bool((codes[:, -1] != self.stop_mel_token).any())
+                if not has_warned and truncated:
+                    self._warn_truncated(max_generate_length, max_mel_tokens, max_silent_tokens,
+                                         max_text_tokens_per_segment, text_tokens.shape[1])
                     has_warned = True
 
                 code_lens = torch.tensor([codes.shape[-1]], device=codes.device, dtype=codes.dtype)
@@ -556,28 +1282,27 @@ class IndexTTS2:
                     print(f"fix codes shape: {codes.shape}, codes type: {codes.dtype}")
                     print(f"code len: {code_lens}")
 
-                m_start_time = time.perf_counter()
-                use_speed = torch.zeros(spk_cond_emb.size(0)).to(spk_cond_emb.device).long()
-                with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
-                    latent = self.gpt(
-                        speech_conditioning_latent,
-                        text_tokens,
-                        torch.tensor([text_tokens.shape[-1]], device=text_tokens.device),
-                        codes,
-                        torch.tensor([codes.shape[-1]], device=text_tokens.device),
-                        emo_cond_emb,
-                        cond_mel_lengths=torch.tensor([spk_cond_emb.shape[-1]], device=text_tokens.device),
-                        emo_cond_mel_lengths=torch.tensor([emo_cond_emb.shape[-1]], device=text_tokens.device),
-                        emo_vec=emovec,
-                        use_speed=use_speed,
-                    )
-                    gpt_forward_time += time.perf_counter() - m_start_time
+                if latent is not None:
+                    # from the decoding pass, see `fused_gpt_latent`
+                    latent = latent[:, :codes.shape[-1]]
+                else:
+                    m_start_time = time.perf_counter()
+                    use_speed = torch.zeros(spk_cond_latent.size(0)).to(spk_cond_latent.device).long()
+                    with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                        latent = self.gpt(
+                            speech_conditioning_latent,
+                            text_tokens,
+                            torch.tensor([text_tokens.shape[-1]], device=text_tokens.device),
+                            codes,
+                            torch.tensor([codes.shape[-1]], device=text_tokens.device),
+                            emo_vec=emovec,
+                            use_speed=use_speed,
+                        )
+                        timings["gpt_forward_time"] += time.perf_counter() - m_start_time
 
                 dtype = None
-                with torch.amp.autocast(text_tokens.device.type, enabled=dtype is not None, dtype=dtype):
+                with self._synth_lock, torch.amp.autocast(text_tokens.device.type, enabled=dtype is not None, dtype=dtype):
                     m_start_time = time.perf_counter()
-                    diffusion_steps = 25
-                    inference_cfg_rate = 0.7
                     latent = self.s2mel.models['gpt_layer'](latent)
                     S_infer = self.semantic_codec.quantizer.vq2emb(codes.unsqueeze(1))
                     S_infer = S_infer.transpose(1, 2)
@@ -592,53 +1317,182 @@ class IndexTTS2:
                     vc_target = self.s2mel.models['cfm'].inference(cat_condition,
                                                                    torch.LongTensor([cat_condition.size(1)]).to(
                                                                        cond.device),
-                                                                   ref_mel, style, None, diffusion_steps,
-                                                                   inference_cfg_rate=inference_cfg_rate)
+                                                                   ref_mel, style, None, **cfm_kwargs)
                     vc_target = vc_target[:, :, ref_mel.size(-1):]
-                    s2mel_time += time.perf_counter() - m_start_time
+                    timings["s2mel_time"] += time.perf_counter() - m_start_time
 
                     m_start_time = time.perf_counter()
-                    wav = self.bigvgan(vc_target.float()).squeeze().unsqueeze(0)
+                    wav = self.vocoder(vc_target.float()).squeeze().unsqueeze(0)
                     print(wav.shape)
-                    bigvgan_time += time.perf_counter() - m_start_time
+                    timings["bigvgan_time"] += time.perf_counter() - m_start_time
                     wav = wav.squeeze(1)
 
                 wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
                 if verbose:
                     print(f"wav shape: {wav.shape}", "min:", wav.min(), "max:", wav.max())
                 # wavs.append(wav[:, :-512])
-                wavs.append(wav.cpu())  # to cpu before saving
-        end_time = time.perf_counter()
+                yield seg_idx, wav.cpu(), truncated  # to cpu before saving
 
-        self._set_gr_progress(0.9, "saving audio...")
-        wavs = self.insert_interval_silence(wavs, sampling_rate=sampling_rate, interval_silence=interval_silence)
-        wav = torch.cat(wavs, dim=1)
-        wav_length = wav.shape[-1] / sampling_rate
-        print(f">> gpt_gen_time: {gpt_gen_time:.2f} seconds")
-        print(f">> gpt_forward_time: {gpt_forward_time:.2f} seconds")
-        print(f">> s2mel_time: {s2mel_time:.2f} seconds")
-        print(f">> bigvgan_time: {bigvgan_time:.2f} seconds")
-        print(f">> Total inference time: {end_time - start_time:.2f} seconds")
-        print(f">> Generated audio length: {wav_length:.2f} seconds")
-        print(f">> RTF: {(end_time - start_time) / wav_length:.4f}")
+    def _infer_segment_chunks(self, text_tokens, spk_conds, emovec, first_chunk_codes=40, chunk_codes=80,
+                              overlap_codes=8, timings=None, should_stop=None, verbose=False, max_mel_tokens=1500,
+                              silent_token=52, max_consecutive=30, max_silent_tokens=0, cfm_kwargs=None,
+                              do_sample=True, prefix_key=None, **generation_kwargs):
+        """
+        Low-latency synthesis of one text segment, yielding audio while the GPT is still generating.
+
+        The GPT samples mel codes in a background thread and hands them over through a `MelCodeStreamer`.
+        Once `first_chunk_codes` (then every `chunk_codes`) new codes are available, the latent, `vq2emb`,
+        `length_regulator`, CFM and BigVGAN steps of `infer()` run on a window of codes that starts
+        `overlap_codes` before the new ones. The audio of the overlapping codes is held back from the previous
+        chunk and crossfaded with the start of the next one. The GPT latents are computed incrementally
+        (`UnifiedVoice.extend_latent()`): each chunk only runs the GPT on the codes added since the previous one.
+        Long silences are shrunk online like `remove_long_silence()`: once more than `max_consecutive` silent
+        tokens have been generated, runs of `silent_token` are cut to 10 tokens. The generation stops after
+        `max_silent_tokens` consecutive silent tokens (0 disables it).
+        `cfm_kwargs` are the s2mel sampling options, see `_pop_cfm_kwargs()`, `prefix_key` the conditioning key of
+        `emovec` in the GPT prefix cache, see `_prefix_key()`.
+        Yields: (wav, truncated) chunks, wav is (1, samples) on cpu, scaled to the int16 range; `truncated` is True on
+        the last chunk of a segment that stopped without the stop token.
+        """
+        spk_cond_latent = spk_conds["spk_cond_latent"]
+        style = spk_conds["style"]
+        prompt_condition = spk_conds["prompt_condition"]
+        ref_mel = spk_conds["ref_mel"]
+        hop_length = self.cfg.s2mel['preprocess_params']['spect_params']['hop_length']
+        if cfm_kwargs is None:
+            cfm_kwargs = self._pop_cfm_kwargs(generation_kwargs)
+
+        def code_frame(i):
+            # mel frame where code `i` starts, same ratio as `target_lengths` in `infer()`
+            return int(i * 1.72)
+
+        streamer = MelCodeStreamer()
+        stop_event = threading.Event()
+        stopping_criteria = [EventStoppingCriteria(stop_event)]
+        if max_silent_tokens:
+            stopping_criteria.append(SilenceStoppingCriteria(silent_token, max_silent_tokens))
+
+        def generate():
+            m_start_time = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    with self._decode_lock, torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                        self.gpt.inference_speech(
+                            None,
+                            text_tokens,
+                            speech_conditioning_latent=spk_cond_latent,
+                            emo_vec=emovec,
+                            do_sample=do_sample,
+                            num_return_sequences=1,
+                            num_beams=1,  # streamers don't support beam search
+                            max_generate_length=max_mel_tokens,
+                            streamer=streamer,
+                            stopping_criteria=StoppingCriteriaList(stopping_criteria),
+                            drafter=self.speculative_drafter,
+                            fused_sampler=self.fused_sampler,
+                            prefix_key=prefix_key,
+                            **generation_kwargs
+                        )
+            except Exception as e:
+                streamer.error(e)
+            finally:
+                timings["gpt_gen_time"] += time.perf_counter() - m_start_time
 
-        # save audio
-        wav = wav.cpu()  # to cpu
-        if output_path:
-            # 直接保存音频到指定路径中
-            if os.path.isfile(output_path):
-                os.remove(output_path)
-                print(">> remove old wav file:", output_path)
-            if os.path.dirname(output_path) != "":
-                os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            torchaudio.save(output_path, wav.type(torch.int16), sampling_rate)
-            print(">> wav file saved to:", output_path)
-            return output_path
-        else:
-            # 返回以符合Gradio的格式要求
-            wav_data = wav.type(torch.int16)
-            wav_data = wav_data.numpy().T
-            return (sampling_rate, wav_data)
+        latent_cache = None  # keys/values of the GPT forward on the codes whose latents are computed
+        latents = None  # latents of the codes computed so far, (1, n, dim)
+
+        @torch.no_grad()
+        def synthesize(codes, start, end):
+            nonlocal latent_cache, latents
+            m_start_time = time.perf_counter()
+            with torch.amp.autocast(text_tokens.device.type, enabled=self.dtype is not None, dtype=self.dtype):
+                # latents are causal: only run the GPT on the codes added since the previous chunk
+                if latent_cache is None:
+                    latent_cache = self.gpt.get_latent_prefix(spk_cond_latent, text_tokens, emovec)
+                done = 0 if latents is None else latents.shape[1]
+                mel_inputs = ([self.gpt.start_mel_token] + codes)[done:end]
+                new_latents = self.gpt.extend_latent(
+                    latent_cache, torch.tensor([mel_inputs], dtype=torch.long, device=self.device), done)
+                latents = new_latents if latents is None else torch.cat([latents, new_latents], dim=1)
+            latent = latents[:, start:end]
+            codes = torch.tensor([codes[:end]], dtype=torch.long, device=self.device)
+            timings["gpt_forward_time"] += time.perf_counter() - m_start_time
+
+            with self._synth_lock:
+                m_start_time = time.perf_counter()
+                latent = self.s2mel.models['gpt_layer'](latent)
+                S_infer = self.semantic_codec.quantizer.vq2emb(codes[:, start:end].unsqueeze(1))
+                S_infer = S_infer.transpose(1, 2)
+                S_infer = S_infer + latent
+                target_lengths = torch.LongTensor([code_frame(end) - code_frame(start)]).to(self.device)
+                cond = self.s2mel.models['length_regulator'](S_infer,
+                                                             ylens=target_lengths,
+                                                             n_quantizers=3,
+                                                             f0=None)[0]
+                cat_condition = torch.cat([prompt_condition, cond], dim=1)
+                x_lens = torch.LongTensor([cat_condition.size(1)]).to(cond.device)
+                vc_target = self.s2mel.models['cfm'].inference(cat_condition, x_lens, ref_mel, style, None,
+                                                               **cfm_kwargs)
+                vc_target = vc_target[:, :, ref_mel.size(-1):]
+                timings["s2mel_time"] += time.perf_counter() - m_start_time
+
+                m_start_time = time.perf_counter()
+                wav = self.vocoder(vc_target.float()).squeeze(1)
+                timings["bigvgan_time"] += time.perf_counter() - m_start_time
+            wav = torch.clamp(32767 * wav, -32767.0, 32767.0)
+            return wav.cpu()
+
+        codes = []
+        synthesized = 0  # codes[:synthesized] are already vocoded
+        tail = None  # audio of the last `overlap_codes` vocoded codes, not yielded yet
+        silent_total = silent_run = 0
+        truncated = True  # until the stop token
+
+        def next_chunk(final):
+            nonlocal synthesized, tail
+            end = len(codes)
+            start = max(0, synthesized - overlap_codes)
+            wav = synthesize(codes, start, end)
+            if tail is not None:
+                fade_len = min(tail.shape[-1], wav.shape[-1])
+                fade_in = torch.linspace(0.0, 1.0, fade_len)
+                wav[:, :fade_len] = tail[:, :fade_len] * (1.0 - fade_in) + wav[:, :fade_len] * fade_in
+                tail = None
+            if not final:
+                keep = (code_frame(end) - code_frame(max(0, end - overlap_codes))) * hop_length
+                if keep > 0:
+                    wav, tail = wav[:, :wav.shape[-1] - keep], wav[:, wav.shape[-1] - keep:]
+            if verbose:
+                print(f">> vocoded codes [{start}, {end}), {wav.shape[-1]} samples")
+            synthesized = end
+            return wav
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        try:
+            for code in streamer:
+                if should_stop is not None and should_stop():
+                    return
+                if code == self.stop_mel_token:
+                    truncated = False
+                    break
+                if code == silent_token:
+                    silent_total += 1
+                    silent_run += 1
+                    if silent_total > max_consecutive and silent_run > 10:
+                        continue
+                else:
+                    silent_run = 0
+                codes.append(code)
+                if len(codes) >= (first_chunk_codes if synthesized == 0 else synthesized + chunk_codes):
+                    yield next_chunk(final=False), False
+            if len(codes) > synthesized:
+                yield next_chunk(final=True), truncated
+            elif tail is not None:
+                yield tail, truncated
+        finally:
+            stop_event.set()
+            thread.join()
 
 
 def find_most_similar_cosine(query_vector, matrix):
@@ -0,0 +1,81 @@
+import math
+
+import torch
+import torch.nn as nn
+
+
+def receptive_field(h, act_radius=7):
+    """
+    Upper bound of the one-sided receptive field of a BigVGAN of hyperparameters `h`, in mel frames: an output
+    sample only depends on the mel frames within this distance of its own frame.
+    `act_radius` is the radius of the anti-aliased activations (2x upsampling and low-pass filters of 12 taps) in
+    samples of their input.
+    """
+    radius = 3  # conv_pre, in frames
+    for u in h["upsample_rates"]:
+        # the transposed conv (kernel 2u, stride u) mixes 2 neighbouring inputs, then the AMP blocks run at its rate
+        radius = (radius + 1) * u
+        radius += max(sum(2 * act_radius + (k - 1) // 2 * (d + 1) for d in dilations)
+                      for k, dilations in zip(h["resblock_kernel_sizes"], h["resblock_dilation_sizes"]))
+    radius += act_radius + 3  # activation_post, conv_post
+    return math.ceil(radius / math.prod(h["upsample_rates"]))
+
+
+class TiledBigVGAN(nn.Module):
+    """
+    Vocodes long mels by windows of `chunk_frames` frames, so that the activations of the upsampling stack scale with
+    the window instead of the whole mel.
+    Each window is vocoded with `context_frames` frames of the neighbouring mel on both sides (by default the
+    receptive field of the vocoder, so the kept audio does not see the window edges) and the windows are linearly
+    cross-faded over `2 * fade_frames` frames at their boundaries. Mels of at most `chunk_frames` frames, and all of
+    them with `chunk_frames=None`, are vocoded at once.
+    """
+
+    def __init__(self, vocoder, chunk_frames=512, context_frames=None, fade_frames=4):
+        super().__init__()
+        if chunk_frames is not None and 4 * fade_frames > chunk_frames:
+            raise ValueError(f"chunk_frames {chunk_frames} is too short for fade_frames {fade_frames}")
+        self.vocoder = vocoder
+        self.chunk_frames = chunk_frames
+        self.context_frames = receptive_field(vocoder.h) if context_frames is None else context_frames
+        self.fade_frames = fade_frames
+        self.hop_length = math.prod(vocoder.h["upsample_rates"])
+
+    def windows(self, num_frames):
+        """
+        Frame boundaries of the windows of a mel of `num_frames` frames: at most `chunk_frames` frames each, of equal
+        sizes so that the last one is not shorter than the fades.
+        """
+        num_windows = math.ceil(num_frames / self.chunk_frames) if self.chunk_frames else 1
+        return [round(i * num_frames / num_windows) for i in range(num_windows + 1)]
+
+    def forward(self, mel):
+        """
+            mel: (batch_size, num_mels, T)
+        Returns: (batch_size, 1, T * hop_length), as `BigVGAN.forward()`
+        """
+        num_frames = mel.size(-1)
+        bounds = self.windows(num_frames)
+        if len(bounds) == 2:
+            return self.vocoder(mel)
+        hop, fade = self.hop_length, self.fade_frames
+        ramp = (torch.arange(2 * fade * hop, device=mel.device, dtype=mel.dtype) + 0.5) / (2 * fade * hop)
+        wav = None
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            # frames of the audio kept from this window, overlapping its neighbours over the fades
+            keep_start, keep_end = max(start - fade, 0), min(end + fade, num_frames)
+            in_start = max(keep_start - self.context_frames, 0)
+            in_end = min(keep_end + self.context_frames, num_frames)
+            audio = self.vocoder(mel[..., in_start:in_end])
+            audio = audio[..., (keep_start - in_start) * hop:(keep_end - in_start) * hop]
+            if wav is None:
+                wav = audio.new_zeros(*audio.shape[:-1], num_frames * hop)
+            if keep_start > 0:
+                audio[..., :ramp.numel()] *= ramp
+            if keep_end < num_frames:
+                audio[..., -ramp.numel():] *= ramp.flip(0)
+            wav[..., keep_start * hop:keep_end * hop] += audio
+        return wav
+
+    def remove_weight_norm(self):
+        self.vocoder.remove_weight_norm()
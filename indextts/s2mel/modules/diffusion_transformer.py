@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+import torch.nn.functional as F
 import math
 
 from indextts.s2mel.modules.gpt_fast.model import ModelArgs, Transformer
@@ -181,9 +182,49 @@ class DiT(torch.nn.Module):
             self.style_in = nn.Linear(args.style_encoder.dim, args.DiT.hidden_dim)
 
     def setup_caches(self, max_batch_size, max_seq_length):
-        self.transformer.setup_caches(max_batch_size, max_seq_length, use_kv_cache=False)
-        
-    def forward(self, x, prompt_x, x_lens, t, style, cond, mask_content=False):
+        self.transformer.setup_caches(max_batch_size, max_seq_length, use_kv_cache=False, is_causal=self.is_causal)
+
+    def merge_static_cond(self, prompt_x, style, cond):
+        """
+        Timestep-independent part of `cond_x_merge_linear` in `forward()`: the projection of `prompt_x`, of
+        `cond_projection(cond)` and of `style`, plus the bias. During sampling only the noisy `x` changes between
+        steps, so this can be computed once and passed to `forward(..., static_cond=...)`.
+            prompt_x: (batch_size, 80, T)
+            style: (batch_size, 192)
+            cond: (batch_size, T, 512)
+        Returns: (batch_size, T, hidden_dim)
+        """
+        weight = self.cond_x_merge_linear.weight
+        c = self.in_channels
+        cond = self.cond_projection(cond)
+        static_cond = F.linear(prompt_x.transpose(1, 2), weight[:, c:2 * c])
+        static_cond = static_cond + F.linear(cond, weight[:, 2 * c:2 * c + cond.size(-1)], self.cond_x_merge_linear.bias)
+        if self.transformer_style_condition and not self.style_as_token:
+            static_cond = static_cond + F.linear(style, weight[:, 2 * c + cond.size(-1):]).unsqueeze(1)
+        return static_cond
+
+    def timestep_embeddings(self, t):
+        """
+        Embeddings of the timesteps `t` (N,) for the transformer (`t_embedder`) and the wavenet head (`t_embedder2`,
+        None without it). They only depend on `t`, so a sampler with a fixed schedule can compute them once per
+        timestep and pass them to `forward(..., t_emb=...)`.
+        Returns: ((N, hidden_dim), (N, wavenet hidden_dim) or None)
+        """
+        t2 = self.t_embedder2(t) if self.final_layer_type == 'wavenet' else None
+        return self.t_embedder(t), t2
+
+    def attention_mask(self, x_mask):
+        """
+        Key padding mask of the transformer for `x_mask` (batch_size, 1, T): (batch_size, 1, 1, T), broadcast over
+        the heads and queries by SDPA instead of a dense (batch_size, 1, T, T) mask. None when nothing is padded,
+        so that SDPA can use its flash attention kernel, and for a causal DiT (the causal mask of `setup_caches()`).
+        """
+        if self.is_causal or bool(x_mask.all()):
+            return None
+        return x_mask.unsqueeze(1)
+
+    def forward(self, x, prompt_x, x_lens, t, style, cond, mask_content=False, static_cond=None, t_emb=None,
+                reflect_padding=False):
         """
             x (torch.Tensor): random noise
             prompt_x (torch.Tensor): reference mel + zero mel
@@ -196,6 +237,13 @@ class DiT(torch.nn.Module):
                 shape: (batch_size, 192)
             cond (torch.Tensor): semantic info of reference audio and altered audio
                 shape: (batch_size, mel_timesteps(795+1069), 512)
+            static_cond (torch.Tensor): precomputed `merge_static_cond(prompt_x, style, cond)`, then `prompt_x`
+                and `cond` are not projected again (inference only)
+                shape: (batch_size, mel_timesteps, 512)
+            t_emb (tuple): precomputed `timestep_embeddings(t)`, rows may be broadcast over the batch (inference
+                only)
+            reflect_padding (bool): the wavenet sees the padding of each item of a padded batch as its
+                reflection, so that the item matches its inference alone (inference only, see `WN.forward()`)
         
         """
         class_dropout = False
@@ -203,27 +251,25 @@ class DiT(torch.nn.Module):
             class_dropout = True
         if not self.training and mask_content:
             class_dropout = True
-        # cond_in_module = self.cond_embedder if self.content_type == 'discrete' else self.cond_projection
-        cond_in_module = self.cond_projection
 
         B, _, T = x.size()
 
 
-        t1 = self.t_embedder(t)  # (N, D) # t1 [2, 512]
-        cond = cond_in_module(cond) # cond [2,1863,512]->[2,1863,512]
-
+        if t_emb is None:
+            t_emb = self.timestep_embeddings(t)
+        t1, t2 = t_emb
+        t1 = t1.expand(B, -1)  # (N, D) # t1 [2, 512]
         x = x.transpose(1, 2) # [2,1863,80]
-        prompt_x = prompt_x.transpose(1, 2) # [2,1863,80]
 
-        x_in = torch.cat([x, prompt_x, cond], dim=-1) # 80+80+512=672 [2, 1863, 672]
-        
-        if self.transformer_style_condition and not self.style_as_token: # True and True
-            x_in = torch.cat([x_in, style[:, None, :].repeat(1, T, 1)], dim=-1) #[2, 1863, 864]
-            
-        if class_dropout: #False
-            x_in[..., self.in_channels:] = x_in[..., self.in_channels:] * 0 # 80维后全置为0
-            
-        x_in = self.cond_x_merge_linear(x_in)  # (N, T, D) [2, 1863, 512]
+        # cond_x_merge_linear of [x, prompt_x, cond, style], the style is projected once and added as a bias
+        # instead of being repeated over the T frames
+        if class_dropout: # everything but x is zeroed
+            x_in = F.linear(x, self.cond_x_merge_linear.weight[:, :self.in_channels], self.cond_x_merge_linear.bias)
+        else:
+            if static_cond is None:
+                static_cond = self.merge_static_cond(prompt_x, style, cond)
+            # only the noisy x changes between sampling steps
+            x_in = F.linear(x, self.cond_x_merge_linear.weight[:, :self.in_channels]) + static_cond  # (N, T, D)
         
         if self.style_as_token: # False
             style = self.style_in(style)
@@ -235,8 +281,7 @@ class DiT(torch.nn.Module):
             
         x_mask = sequence_mask(x_lens + self.style_as_token + self.time_as_token).to(x.device).unsqueeze(1) #torch.Size([1, 1, 1863])True
         input_pos = self.input_pos[:x_in.size(1)]  # (T,) range（0，1863）
-        x_mask_expanded = x_mask[:, None, :].repeat(1, 1, x_in.size(1), 1) if not self.is_causal else None # torch.Size([1, 1, 1863, 1863]
-        x_res = self.transformer(x_in, t1.unsqueeze(1), input_pos, x_mask_expanded) # [2, 1863, 512]
+        x_res = self.transformer(x_in, t1.unsqueeze(1), input_pos, self.attention_mask(x_mask)) # [2, 1863, 512]
         x_res = x_res[:, 1:] if self.time_as_token else x_res
         x_res = x_res[:, 1:] if self.style_as_token else x_res
         
@@ -245,9 +290,10 @@ class DiT(torch.nn.Module):
         if self.final_layer_type == 'wavenet':
             x = self.conv1(x_res)
             x = x.transpose(1, 2)
-            t2 = self.t_embedder2(t)
-            x = self.wavenet(x, x_mask, g=t2.unsqueeze(2)).transpose(1, 2) + self.res_projection(
-                x_res)  # long residual connection
+            t2 = t2.expand(B, -1)
+            # mask the padded frames of a batch, the first wavenet conv would mix them into the valid ones
+            x = self.wavenet(x * x_mask, x_mask, g=t2.unsqueeze(2), reflect_padding=reflect_padding).transpose(1, 2)
+            x = x + self.res_projection(x_res)  # long residual connection
             x = self.final_layer(x, t1).transpose(1, 2)
             x = self.conv2(x)
         else:
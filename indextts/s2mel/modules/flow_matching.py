@@ -1,12 +1,72 @@
 from abc import ABC
+import math
 
 import torch
-import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 
 from indextts.s2mel.modules.diffusion_transformer import DiT
 from indextts.s2mel.modules.commons import sequence_mask
 
-from tqdm import tqdm
+
+def sway_sampling(t_span, coef=-1.0):
+    """
+    Sway sampling of the flow matching timesteps (F5-TTS): `t + coef * (cos(pi / 2 * t) - 1 + t)`.
+    A negative `coef` puts more of the steps near t = 0, where the flow changes the most.
+    """
+    return t_span + coef * (torch.cos(torch.pi / 2 * t_span) - 1 + t_span)
+
+
+# the steps update `x` in place, `velocity()` returns a new tensor that they may overwrite
+
+
+def euler_step(velocity, x, t, dt, state):
+    return x.add_(velocity(x, t).mul_(dt))
+
+
+def midpoint_step(velocity, x, t, dt, state):
+    # 2 estimator calls per step
+    v = velocity(x, t)
+    return x.add_(velocity(x + 0.5 * dt * v, t + 0.5 * dt).mul_(dt))
+
+
+def heun_step(velocity, x, t, dt, state):
+    # RK2 with the trapezoidal rule, 2 estimator calls per step
+    v = velocity(x, t)
+    v_next = velocity(x + dt * v, t + dt)
+    return x.add_(v.add_(v_next).mul_(0.5 * dt))
+
+
+def multistep_step(velocity, x, t, dt, state):
+    """
+    Second order multistep solver in the style of DPM-Solver++(2M): the velocity of the previous step is reused
+    to extrapolate over the current one (variable step Adams-Bashforth), so it costs 1 estimator call per step.
+    The first step is an Euler step.
+    """
+    v = velocity(x, t)
+    v_prev, dt_prev = state.get("v"), state.get("dt")
+    if v_prev is None:
+        x.add_(dt * v)
+    else:
+        r = dt / dt_prev
+        x.add_(dt * ((1 + 0.5 * r) * v - 0.5 * r * v_prev))
+    state["v"], state["dt"] = v, dt
+    return x
+
+
+ODE_SOLVERS = {
+    "euler": euler_step,
+    "midpoint": midpoint_step,
+    "heun": heun_step,
+    "multistep": multistep_step,
+}
+
+# multipliers of `inference_cfg_rate` as a function of the step's start time t in [0, 1]
+CFG_SCHEDULES = {
+    "constant": lambda t: 1.0,
+    "linear": lambda t: 1.0 - t,
+    "cosine": lambda t: math.cos(math.pi / 2 * t),
+}
+
 
 class BASECFM(torch.nn.Module, ABC):
     def __init__(
@@ -28,7 +88,9 @@ class BASECFM(torch.nn.Module, ABC):
             self.zero_prompt_speech_token = False
 
     @torch.inference_mode()
-    def inference(self, mu, x_lens, prompt, style, f0, n_timesteps, temperature=1.0, inference_cfg_rate=0.5):
+    def inference(self, mu, x_lens, prompt, style, f0, n_timesteps, temperature=1.0, inference_cfg_rate=0.5,
+                  max_prompt_len=None, cache_cond=True, solver="euler", sway_coef=None, cfg_steps=None,
+                  cfg_schedule="constant", prompt_lens=None, progress=None, return_trajectory=False):
         """Forward diffusion
 
         Args:
@@ -43,20 +105,113 @@ class BASECFM(torch.nn.Module, ABC):
             f0: None
             n_timesteps (int): number of diffusion steps
             temperature (float, optional): temperature for scaling noise. Defaults to 1.0.
+            max_prompt_len (int, optional): only keep the last `max_prompt_len` frames of an over-long prompt
+                (and the matching frames of `mu`) as context, so the cost stops growing with the prompt length.
+                The output keeps its shape, the dropped prompt frames are returned as zeros like the rest of
+                the prompt region.
+            cache_cond (bool): project the timestep-independent DiT inputs once instead of at every step.
+            solver (str | callable): ODE solver, one of `ODE_SOLVERS` or a step function with the same signature.
+            sway_coef (float, optional): sway sampling of the timesteps, see `sway_sampling()`.
+            cfg_steps (int, optional): only apply classifier-free guidance on the first `cfg_steps` steps.
+            cfg_schedule (str | callable): decay of `inference_cfg_rate` over the steps, one of `CFG_SCHEDULES`
+                or a function of t. The unconditional branch is skipped on the steps where the rate is 0.
+            prompt_lens (torch.Tensor, optional): prompt frames of each item, `mu` and `prompt` then hold items with
+                their own prompt: `prompt[i, :, :prompt_lens[i]]` and `mu[i, :prompt_lens[i]]` are the prompt of item
+                i, `mu[i, prompt_lens[i]:x_lens[i]]` its target, the rest is padding. By default every item has the
+                whole `prompt`.
+                shape: (batch_size,)
+            progress (callable, optional): called as `progress(step, n_steps)` after every step.
+            return_trajectory (bool): debug, also return the sample after every step.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, 80, mel_timesteps)
+            trajectory: with `return_trajectory`, the list of the `n_timesteps + 1` samples from the noise to
+                `sample`
         """
         B, T = mu.size(0), mu.size(1)
-        z = torch.randn([B, self.in_channels, T], device=mu.device) * temperature
+        if prompt_lens is None:
+            prompt_lens = torch.full((B,), prompt.size(-1), device=mu.device)
+        x_lens = x_lens.expand(B)
+        trim_lens = None
+        if max_prompt_len is not None and int(prompt_lens.max()) > max_prompt_len:
+            trim_lens = (prompt_lens - max_prompt_len).clamp(min=0)
+            mu, x_lens, prompt, prompt_lens = self._trim_prompts(mu, x_lens, prompt, prompt_lens, trim_lens)
+        z = torch.randn([B, self.in_channels, mu.size(1)], device=mu.device) * temperature
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device)
-        # t_span = t_span + (-1) * (torch.cos(torch.pi / 2 * t_span) - 1 + t_span)
-        return self.solve_euler(z, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate)
+        if sway_coef is not None:
+            t_span = sway_sampling(t_span, sway_coef)
+        sample = self.solve_ode(z, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate, solver=solver,
+                                cache_cond=cache_cond, cfg_steps=cfg_steps, cfg_schedule=cfg_schedule,
+                                prompt_lens=prompt_lens, progress=progress, return_trajectory=return_trajectory)
+        trajectory = None
+        if return_trajectory:
+            sample, trajectory = sample
+        if trim_lens is not None:
+            # back to the frames of the input, the dropped prompt frames are zeros
+            def untrim(trimmed):
+                padded = trimmed.new_zeros(B, trimmed.size(1), T)
+                for i, (trim_len, x_len) in enumerate(zip(trim_lens.tolist(), x_lens.tolist())):
+                    padded[i, :, trim_len:trim_len + x_len] = trimmed[i, :, :x_len]
+                return padded
+
+            sample = untrim(sample)
+            trajectory = [untrim(x) for x in trajectory] if trajectory is not None else None
+        return (sample, trajectory) if return_trajectory else sample
 
-    def solve_euler(self, x, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate=0.5):
+    @staticmethod
+    def _trim_prompts(mu, x_lens, prompt, prompt_lens, trim_lens):
+        # drop the first `trim_lens[i]` frames of item i, the items stay left-aligned
+        x_lens = x_lens - trim_lens
+        prompt_lens = prompt_lens - trim_lens
+        if prompt.size(0) == 1 and trim_lens.min() == trim_lens.max():
+            # a prompt shared by every item
+            trim_len = int(trim_lens[0])
+            return mu[:, trim_len:], x_lens, prompt[..., trim_len:], prompt_lens
+        trimmed_mu = mu.new_zeros(mu.size(0), int(x_lens.max()), mu.size(2))
+        trimmed_prompt = prompt.new_zeros(mu.size(0), prompt.size(1), int(prompt_lens.max()))
+        for i, (trim_len, x_len, prompt_len) in enumerate(zip(trim_lens.tolist(), x_lens.tolist(),
+                                                              prompt_lens.tolist())):
+            trimmed_mu[i, :x_len] = mu[i, trim_len:trim_len + x_len]
+            trimmed_prompt[i, :, :prompt_len] = prompt[i % prompt.size(0), :, trim_len:trim_len + prompt_len]
+        return trimmed_mu, x_lens, trimmed_prompt, prompt_lens
+
+    def inference_batch(self, mus, prompts, style, n_timesteps, **kwargs):
         """
-        Fixed euler solver for ODEs.
+        `inference()` of items with their own prompt and target lengths, sampled together in one loop.
+        Args:
+            mus (list[torch.Tensor]): semantic info of the reference audio followed by the altered audio of each item
+                shape: (prompt_frames + target_frames, 512)
+            prompts (list[torch.Tensor]): reference mel of each item
+                shape: (80, prompt_frames)
+            style (torch.Tensor): reference global style of each item
+                shape: (batch_size, 192)
+            **kwargs: other arguments of `inference()`, except `return_trajectory`
+        Returns:
+            list of the generated target mels, without the prompts
+                shape: (80, target_frames)
+        """
+        device = mus[0].device
+        x_lens = torch.tensor([mu.size(0) for mu in mus], device=device)
+        prompt_lens = torch.tensor([prompt.size(-1) for prompt in prompts], device=device)
+        mu = pad_sequence(mus, batch_first=True)
+        prompt = pad_sequence([prompt.transpose(0, 1) for prompt in prompts], batch_first=True).transpose(1, 2)
+        sample = self.inference(mu, x_lens, prompt, style, None, n_timesteps, prompt_lens=prompt_lens, **kwargs)
+        return [sample[i, :, prompt_len:x_len]
+                for i, (prompt_len, x_len) in enumerate(zip(prompt_lens.tolist(), x_lens.tolist()))]
+
+    def solve_euler(self, x, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate=0.5, cache_cond=True):
+        """
+        Fixed euler solver for ODEs, see `solve_ode()`.
+        """
+        return self.solve_ode(x, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate, solver="euler",
+                              cache_cond=cache_cond)
+
+    def solve_ode(self, x, x_lens, prompt, mu, style, f0, t_span, inference_cfg_rate=0.5, solver="euler",
+                  cache_cond=True, cfg_steps=None, cfg_schedule="constant", prompt_lens=None, progress=None,
+                  return_trajectory=False):
+        """
+        Fixed step ODE solver, `x` is updated in place.
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
@@ -69,50 +224,100 @@ class BASECFM(torch.nn.Module, ABC):
                 shape: (batch_size, 80, 795)
             style (torch.Tensor): reference global style
                 shape: (batch_size, 192)
+            solver (str | callable): one of `ODE_SOLVERS`, or a step function
+                `step(velocity, x, t, dt, state) -> x + integral of velocity over [t, t + dt]`
+            cache_cond (bool): compute the projections of `prompt`, `mu` and `style` in the DiT input layer once,
+                see `DiT.merge_static_cond()`
+            cfg_steps (int, optional): only apply classifier-free guidance on the first `cfg_steps` steps
+            cfg_schedule (str | callable): one of `CFG_SCHEDULES`, or a function of the step's start time that
+                scales `inference_cfg_rate`
+            prompt_lens (torch.Tensor, optional): prompt frames of each item, see `inference()`
+                shape: (batch_size,)
+            progress (callable, optional): called as `progress(step, n_steps)` after every step
+            return_trajectory (bool): debug, return `(x, trajectory)` with a copy of `x` before the first and after
+                every step
         """
-        t, _, _ = t_span[0], t_span[-1], t_span[1] - t_span[0]
+        step_fn = ODE_SOLVERS[solver] if isinstance(solver, str) else solver
+        cfg_scale = CFG_SCHEDULES[cfg_schedule] if isinstance(cfg_schedule, str) else cfg_schedule
+        n_steps = len(t_span) - 1
+        t_list = t_span.tolist()
+        cfg_rates = [inference_cfg_rate * cfg_scale(t_list[i]) if cfg_steps is None or i < cfg_steps else 0.0
+                     for i in range(n_steps)]
 
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
         # apply prompt
+        B = x.size(0)
         prompt_len = prompt.size(-1)
+        if prompt_lens is None:
+            prompt_lens = torch.full((B,), prompt_len, device=x.device)
+        prompt_mask = sequence_mask(prompt_lens, x.size(-1)).unsqueeze(1)  # (B, 1, T)
         prompt_x = torch.zeros_like(x)
         prompt_x[..., :prompt_len] = prompt[..., :prompt_len]
-        x[..., :prompt_len] = 0
+        prompt_x.masked_fill_(~prompt_mask, 0)
+        x.masked_fill_(prompt_mask, 0)
         if self.zero_prompt_speech_token:
-            mu[..., :prompt_len] = 0
-        for step in tqdm(range(1, len(t_span))):
-            dt = t_span[step] - t_span[step - 1]
-            if inference_cfg_rate > 0:
-                # Stack original and CFG (null) inputs for batched processing
-                stacked_prompt_x = torch.cat([prompt_x, torch.zeros_like(prompt_x)], dim=0)
-                stacked_style = torch.cat([style, torch.zeros_like(style)], dim=0)
-                stacked_mu = torch.cat([mu, torch.zeros_like(mu)], dim=0)
+            mu = mu.masked_fill(prompt_mask.transpose(1, 2), 0)
+        if any(rate > 0 for rate in cfg_rates):
+            # Stack original and CFG (null) inputs for batched processing
+            stacked_prompt_x = torch.cat([prompt_x, torch.zeros_like(prompt_x)], dim=0)
+            stacked_style = torch.cat([style, torch.zeros_like(style)], dim=0)
+            stacked_mu = torch.cat([mu, torch.zeros_like(mu)], dim=0)
+            stacked_x_lens = torch.cat([x_lens, x_lens], dim=0) if x_lens.size(0) > 1 else x_lens
+            stacked_static_cond = self.estimator.merge_static_cond(
+                stacked_prompt_x, stacked_style, stacked_mu) if cache_cond else None
+            # the conditional half, for the steps without guidance
+            static_cond = stacked_static_cond[:B] if cache_cond else None
+        else:
+            static_cond = self.estimator.merge_static_cond(prompt_x, style, mu) if cache_cond else None
+        cfg_rate = inference_cfg_rate
+
+        # timestep embeddings of the schedule, computed once for the whole batch; the solvers that evaluate the
+        # velocity between the steps add their timesteps on first use
+        t1s, t2s = self.estimator.timestep_embeddings(t_span[:-1])
+        t_embs = {t: (t1s[i:i + 1], t2s[i:i + 1] if t2s is not None else None) for i, t in enumerate(t_list[:-1])}
+
+        def timestep_embedding(t):
+            key = t.item()
+            if key not in t_embs:
+                t_embs[key] = self.estimator.timestep_embeddings(t.reshape(1))
+            return t_embs[key]
+
+        def velocity(x, t):
+            t_emb = timestep_embedding(t)
+            if cfg_rate > 0:
                 stacked_x = torch.cat([x, x], dim=0)
-                stacked_t = torch.cat([t.unsqueeze(0), t.unsqueeze(0)], dim=0)
+                stacked_t = t.expand(stacked_x.size(0))
 
                 # Perform a single forward pass for both original and CFG inputs
                 stacked_dphi_dt = self.estimator(
-                    stacked_x, stacked_prompt_x, x_lens, stacked_t, stacked_style, stacked_mu,
+                    stacked_x, stacked_prompt_x, stacked_x_lens, stacked_t, stacked_style, stacked_mu,
+                    static_cond=stacked_static_cond, t_emb=t_emb, reflect_padding=True,
                 )
 
                 # Split the output back into the original and CFG components
                 dphi_dt, cfg_dphi_dt = stacked_dphi_dt.chunk(2, dim=0)
 
                 # Apply CFG formula
-                dphi_dt = (1.0 + inference_cfg_rate) * dphi_dt - inference_cfg_rate * cfg_dphi_dt
+                dphi_dt = (1.0 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt
             else:
-                dphi_dt = self.estimator(x, prompt_x, x_lens, t.unsqueeze(0), style, mu)
+                dphi_dt = self.estimator(x, prompt_x, x_lens, t.expand(x.size(0)), style, mu, static_cond=static_cond,
+                                         t_emb=t_emb, reflect_padding=True)
+            # the prompt region stays 0
+            return dphi_dt.masked_fill_(prompt_mask, 0)
+
+        state = {}
+        trajectory = [x.clone()] if return_trajectory else None
+        for step in range(1, len(t_span)):
+            cfg_rate = cfg_rates[step - 1]
+            t = t_span[step - 1]
+            dt = t_span[step] - t
+            x = step_fn(velocity, x, t, dt, state)
+            if trajectory is not None:
+                trajectory.append(x.clone())
+            if progress is not None:
+                progress(step, n_steps)
 
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-            x[:, :, :prompt_len] = 0
+        return (x, trajectory) if return_trajectory else x
 
-        return sol[-1]
     def forward(self, x1, x_lens, prompt_lens, mu, style):
         """Computes diffusion loss
 
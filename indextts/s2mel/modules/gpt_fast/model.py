@@ -131,7 +131,7 @@ class Transformer(nn.Module):
         self.max_batch_size = -1
         self.max_seq_length = -1
 
-    def setup_caches(self, max_batch_size, max_seq_length, use_kv_cache=True):
+    def setup_caches(self, max_batch_size, max_seq_length, use_kv_cache=True, is_causal=True):
         if self.max_seq_length >= max_seq_length and self.max_batch_size >= max_batch_size:
             return
         head_dim = self.config.dim // self.config.n_head
@@ -147,7 +147,9 @@ class Transformer(nn.Module):
 
         self.freqs_cis = precompute_freqs_cis(self.config.block_size, self.config.head_dim,
                                               self.config.rope_base, dtype).to(device)
-        self.causal_mask = torch.tril(torch.ones(self.max_seq_length, self.max_seq_length, dtype=torch.bool)).to(device)
+        # a non-causal model only gets key padding masks, no need for max_seq_length ** 2 booleans
+        self.causal_mask = torch.tril(torch.ones(self.max_seq_length, self.max_seq_length, dtype=torch.bool,
+                                                 device=device)) if is_causal else None
         self.use_kv_cache = use_kv_cache
         self.uvit_skip_connection = self.config.uvit_skip_connection
         if self.uvit_skip_connection:
@@ -167,7 +169,8 @@ class Transformer(nn.Module):
                 cross_attention_mask: Optional[Tensor] = None,
                 ) -> Tensor:
         assert self.freqs_cis is not None, "Caches must be initialized first"
-        if mask is None: # in case of non-causal model
+        # without a mask, a causal model takes its causal mask and a non-causal one attends to everything
+        if mask is None and self.causal_mask is not None:
             if not self.training and self.use_kv_cache:
                 mask = self.causal_mask[None, None, input_pos]
             else:
@@ -135,15 +135,23 @@ class WN(torch.nn.Module):
             res_skip_layer = conv1d_type(hidden_channels, res_skip_channels, 1, norm='weight_norm', causal=causal)
             self.res_skip_layers.append(res_skip_layer)
 
-    def forward(self, x, x_mask, g=None, **kwargs):
+    def forward(self, x, x_mask, g=None, reflect_padding=False, **kwargs):
         output = torch.zeros_like(x)
         n_channels_tensor = torch.IntTensor([self.hidden_channels])
 
         if g is not None:
             g = self.cond_layer(g)
 
+        # with `reflect_padding` (batched inference), the convolutions see the frames past the end of an item of a
+        # padded batch as its reflection, like the reflect padding of the item alone; training keeps the zeros
+        reflect = None
+        if reflect_padding and not bool(x_mask.all()):
+            lengths = x_mask.sum(dim=-1, keepdim=True).long()
+            t = torch.arange(x.size(-1), device=x.device)
+            reflect = torch.where(t < lengths, t, (2 * (lengths - 1) - t).clamp(min=0)).expand(-1, x.size(1), -1)
+
         for i in range(self.n_layers):
-            x_in = self.in_layers[i](x)
+            x_in = self.in_layers[i](x.gather(-1, reflect) if reflect is not None else x)
             if g is not None:
                 cond_offset = i * 2 * self.hidden_channels
                 g_l = g[:, cond_offset:cond_offset + 2 * self.hidden_channels, :]
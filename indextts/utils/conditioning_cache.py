@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+import torch
+
+
+def tensors_nbytes(entry: Dict[str, torch.Tensor]) -> int:
+    return sum(t.numel() * t.element_size() for t in entry.values() if isinstance(t, torch.Tensor))
+
+
+class ConditioningCache:
+    """
+    LRU cache of the reference prompt conditioning of `IndexTTS2`, keyed per prompt.
+
+    Each entry is a dict of tensors (e.g. the conformer-perceiver latent, emovec, style, prompt_condition
+    and ref_mel of a speaker prompt). The least recently used entries are evicted once the tensors held
+    exceed `max_bytes`, so alternating between voices doesn't recompute them every time.
+    It can be shared by concurrent requests.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Hashable, Dict[str, torch.Tensor]]" = OrderedDict()
+        self._nbytes: Dict[Hashable, int] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key) -> Optional[Dict[str, torch.Tensor]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry: Dict[str, torch.Tensor]):
+        """
+        Insert `entry`, evicting the least recently used entries to stay within `max_bytes`.
+        An entry larger than the whole budget is not cached.
+        """
+        with self._lock:
+            self.pop(key)
+            nbytes = tensors_nbytes(entry)
+            if nbytes > self.max_bytes:
+                return
+            while self._entries and self.total_bytes + nbytes > self.max_bytes:
+                self.pop(next(iter(self._entries)))
+            self._entries[key] = entry
+            self._nbytes[key] = nbytes
+            self.total_bytes += nbytes
+
+    def pop(self, key) -> Optional[Dict[str, torch.Tensor]]:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= self._nbytes.pop(key)
+            return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes.clear()
+            self.total_bytes = 0
@@ -84,8 +84,15 @@ class JsonHParams:
         return self.__dict__.__repr__()
 
 
-def build_semantic_model(path_='./models/tts/maskgct/ckpt/wav2vec2bert_stats.pt'):
+def build_semantic_model(path_='./models/tts/maskgct/ckpt/wav2vec2bert_stats.pt', output_layer=None):
+    """
+    Args:
+        output_layer (int): only keep the encoder layers needed for `hidden_states[output_layer]`, which is
+            then computed by `get_semantic_features()` without running the remaining layers.
+    """
     semantic_model = Wav2Vec2BertModel.from_pretrained("facebook/w2v-bert-2.0")
+    if output_layer is not None:
+        semantic_model.encoder.layers = semantic_model.encoder.layers[:output_layer]
     semantic_model.eval()
     stat_mean_var = torch.load(path_)
     semantic_mean = stat_mean_var["mean"]
@@ -93,6 +100,16 @@ def build_semantic_model(path_='./models/tts/maskgct/ckpt/wav2vec2bert_stats.pt'
     return semantic_model, semantic_mean, semantic_std
 
 
+def get_semantic_features(semantic_model, input_features, attention_mask=None):
+    """
+    Output of the last encoder layer of a w2v-bert model, i.e. `hidden_states[len(encoder.layers)]` of
+    `semantic_model(..., output_hidden_states=True)`, without keeping the other hidden states nor running the
+    adapter layers after the encoder.
+    """
+    hidden_states, _ = semantic_model.feature_projection(input_features)
+    return semantic_model.encoder(hidden_states, attention_mask=attention_mask).last_hidden_state
+
+
 def build_semantic_codec(cfg):
     semantic_codec = RepCodec(cfg=cfg)
     semantic_codec.eval()
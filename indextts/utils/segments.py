@@ -0,0 +1,97 @@
+from typing import Dict, List, Optional, Sequence
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+
+def bucket_segments(segments, bucket_max_size=4, lengths: Optional[Sequence[int]] = None) -> List[List[Dict]]:
+    """
+    Segment data bucketing.
+    if ``bucket_max_size=1``, return all segments in one bucket.
+    ``lengths``: length of each segment to bucket by (e.g. its mel token budget), the token count by default.
+    """
+    outputs: List[Dict] = []
+    for idx, sent in enumerate(segments):
+        outputs.append({"idx": idx, "sent": sent, "len": len(sent) if lengths is None else lengths[idx]})
+
+    if len(outputs) > bucket_max_size:
+        # split segments into buckets by segment length
+        buckets: List[List[Dict]] = []
+        factor = 1.5
+        last_bucket = None
+        last_bucket_sent_len_median = 0
+
+        # budgets capped at the same maximum tie, the token count breaks the ties
+        for sent in sorted(outputs, key=lambda x: (x["len"], len(x["sent"]))):
+            current_sent_len = sent["len"]
+            if len(sent["sent"]) == 0:
+                print(">> skip empty segment")
+                continue
+            if last_bucket is None \
+                    or current_sent_len >= int(last_bucket_sent_len_median * factor) \
+                    or len(last_bucket) >= bucket_max_size:
+                # new bucket
+                buckets.append([sent])
+                last_bucket = buckets[-1]
+                last_bucket_sent_len_median = current_sent_len
+            else:
+                # current bucket can hold more segments
+                last_bucket.append(sent)  # sorted
+                mid = len(last_bucket) // 2
+                last_bucket_sent_len_median = last_bucket[mid]["len"]
+        last_bucket = None
+        # merge all buckets with size 1
+        out_buckets: List[List[Dict]] = []
+        only_ones: List[Dict] = []
+        for b in buckets:
+            if len(b) == 1:
+                only_ones.append(b[0])
+            else:
+                out_buckets.append(b)
+        if len(only_ones) > 0:
+            # merge into previous buckets if possible
+            for i in range(len(out_buckets)):
+                b = out_buckets[i]
+                if len(b) < bucket_max_size:
+                    b.append(only_ones.pop(0))
+                    if len(only_ones) == 0:
+                        break
+            # combined all remaining sized 1 buckets
+            if len(only_ones) > 0:
+                out_buckets.extend(
+                    [only_ones[i:i + bucket_max_size] for i in range(0, len(only_ones), bucket_max_size)])
+        return out_buckets
+    return [outputs]
+
+
+def pad_tokens_cat(tokens: List[torch.Tensor], stop_text_token, start_text_token, model_version=None) -> torch.Tensor:
+    """
+    Pad the text tokens ([1, N] each) of a batch to the longest one and concatenate them.
+    """
+    if model_version and model_version >= 1.5:
+        # 1.5版本以上，直接使用stop_text_token 右侧填充，填充到最大长度
+        # [1, N] -> [N,]
+        tokens = [t.squeeze(0) for t in tokens]
+        return pad_sequence(tokens, batch_first=True, padding_value=stop_text_token, padding_side="right")
+    max_len = max(t.size(1) for t in tokens)
+    outputs = []
+    for tensor in tokens:
+        pad_len = max_len - tensor.size(1)
+        if pad_len > 0:
+            n = min(8, pad_len)
+            tensor = torch.nn.functional.pad(tensor, (0, n), value=stop_text_token)
+            tensor = torch.nn.functional.pad(tensor, (0, pad_len - n), value=start_text_token)
+        tensor = tensor[:, :max_len]
+        outputs.append(tensor)
+    tokens = torch.cat(outputs, dim=0)
+    return tokens
+
+
+def torch_empty_cache(device):
+    try:
+        if "cuda" in str(device):
+            torch.cuda.empty_cache()
+        elif "mps" in str(device):
+            torch.mps.empty_cache()
+    except Exception as e:
+        pass
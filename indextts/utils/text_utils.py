@@ -1,3 +1,4 @@
+import math
 import re
 
 from textstat import textstat
@@ -28,14 +29,49 @@ def get_text_syllable_num(text):
     return syllable_num
 
 
-def get_text_tts_dur(text):
+def get_text_max_syllable_num(text):
+    """
+    Generous count of the syllables of `text`, for token budgets that must not cut speech short.
+    `get_text_syllable_num()` undercounts what is read out letter by letter or digit by digit ("GPU" is 1 syllable
+    for textstat) and skips other scripts, here:
+        - a digit counts 2 syllables ("seven", "二十"),
+        - a word in capitals is spelled, 1 syllable per letter (3 for "W"),
+        - a character of another script (kana, hangul...) counts 1 syllable.
+    """
+    syllable_num = 0
+    for token in re.findall(r'[\u4e00-\u9fff]|[0-9]|[a-zA-Z]+|[^\W\d_]', text):
+        if token.isdigit():
+            syllable_num += 2
+        elif token.isascii() and token.isalpha():
+            syllable_num += sum(3 if c in "wW" else 1 for c in token) if token.isupper() \
+                else max(1, textstat.syllable_count(token))
+        else:
+            syllable_num += 1
+    return syllable_num
+
+
+def get_text_tts_dur(text, syllable_num=None):
     min_speed = 3  # 2.18 #
     max_speed = 5.50
 
     ratio = 0.8517 if contains_chinese(text) else 1.0
 
-    syllable_num = get_text_syllable_num(text)
+    if syllable_num is None:
+        syllable_num = get_text_syllable_num(text)
     max_dur = syllable_num * ratio / max_speed
     min_dur = syllable_num * ratio / min_speed
 
-    return max_dur, min_dur
\ No newline at end of file
+    return max_dur, min_dur
+
+
+def get_mel_token_budget(text, code_rate=50.0, speech_ratio=1.0, slack=1.5, min_tokens=50):
+    """
+    Upper bound of the number of mel codes of `text`: its longest duration from `get_text_tts_dur()` (slowest
+    speaking rate, on the generous syllable count of `get_text_max_syllable_num()`), stretched by the pauses of the
+    speaker (`speech_ratio`: fraction of non-silent codes in the reference audio) and by `slack`, at `code_rate`
+    codes per second, the fixed frame rate of the semantic codec (not a speaking rate of the speaker).
+    """
+    syllable_num = max(get_text_syllable_num(text), get_text_max_syllable_num(text))
+    longest_dur = max(get_text_tts_dur(text, syllable_num))
+    # 停顿再多也按一半语音估计，避免异常参考音频给出过大的预算
+    return max(min_tokens, math.ceil(longest_dur / max(speech_ratio, 0.5) * code_rate * slack))
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+PROFILE_FORMAT_VERSION = 1
+
+# conditioning tensors of a speaker prompt, as cached by `IndexTTS2._get_spk_conditions()`
+PROFILE_TENSORS = ("spk_cond_latent", "emovec", "style", "prompt_condition", "ref_mel")
+# pause statistics of the prompt, absent from the profiles saved before them
+PROFILE_OPTIONAL_TENSORS = ("speech_ratio",)
+
+
+def audio_sha256(audio_path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Content hash of a reference audio file.
+    """
+    h = hashlib.sha256()
+    with open(audio_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class VoiceProfile:
+    """
+    Precomputed conditioning of a reference voice, so the w2v-bert, semantic codec, CAMPPlus and mel
+    front-ends don't need to run again for a known voice.
+
+    A profile is stored as a safetensors file holding the tensors in `PROFILE_TENSORS`, with the content
+    hash of the source audio and the model version in its metadata. It can be passed to
+    `IndexTTS2.infer()` in place of a reference audio path, both as the speaker and the emotion prompt.
+    """
+
+    def __init__(self, conditions: Dict[str, torch.Tensor], audio_hash: str, model_version: Optional[str] = None,
+                 source: Optional[str] = None):
+        missing = [name for name in PROFILE_TENSORS if name not in conditions]
+        if missing:
+            raise ValueError(f"voice profile is missing the conditioning tensors: {missing}")
+        self.conditions = {name: conditions[name] for name in PROFILE_TENSORS + PROFILE_OPTIONAL_TENSORS
+                           if name in conditions}
+        self.audio_hash = audio_hash
+        self.model_version = None if model_version is None else str(model_version)
+        self.source = source
+
+    @property
+    def key(self):
+        # identifies the voice independently of where the audio or the profile file is stored
+        return self.audio_hash, self.model_version
+
+    def to(self, device=None, dtype=None):
+        """
+        Move the conditioning tensors to `device`, casting floating point tensors to `dtype` if given.
+        """
+        for name, tensor in self.conditions.items():
+            self.conditions[name] = tensor.to(device=device, dtype=dtype if tensor.is_floating_point() else None)
+        return self
+
+    def save(self, path: str):
+        metadata = {
+            "format_version": str(PROFILE_FORMAT_VERSION),
+            "audio_sha256": self.audio_hash,
+            "model_version": json.dumps(self.model_version),
+            "source": os.path.basename(self.source) if self.source else "",
+        }
+        tensors = {name: tensor.detach().cpu().contiguous() for name, tensor in self.conditions.items()}
+        save_file(tensors, path, metadata=metadata)
+
+    @classmethod
+    def load(cls, path: str, device="cpu"):
+        conditions = load_file(path, device=str(device))
+        with safe_open(path, framework="pt") as f:
+            metadata = f.metadata() or {}
+        format_version = int(metadata.get("format_version", -1))
+        if format_version != PROFILE_FORMAT_VERSION:
+            raise ValueError(f"unsupported voice profile format {format_version} in {path}, "
+                             f"expected {PROFILE_FORMAT_VERSION}")
+        return cls(conditions, metadata["audio_sha256"], json.loads(metadata["model_version"]),
+                   source=metadata.get("source") or None)
+
+    def __repr__(self):
+        return (f"VoiceProfile(audio_sha256={self.audio_hash[:12]}..., model_version={self.model_version}, "
+                f"source={self.source})")
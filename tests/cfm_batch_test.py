@@ -0,0 +1,67 @@
+import torch
+from omegaconf import OmegaConf
+
+from indextts.s2mel.modules.flow_matching import CFM
+
+if __name__ == "__main__":
+    """
+    Test that `CFM.inference_batch()` on items with their own prompt and target lengths gives the mel of each
+    item sampled alone by `CFM.inference()`, on a randomly initialized CFM (the s2mel config of the model) and
+    without sampling noise (temperature 0).
+    ```
+    python tests/cfm_batch_test.py
+    python tests/cfm_batch_test.py checkpoints/config.yaml
+    ```
+    """
+    import sys
+    import transformers
+    transformers.set_seed(42)
+    cfg = OmegaConf.load(sys.argv[1] if len(sys.argv) > 1 else "checkpoints/config.yaml").s2mel
+    cfm = CFM(cfg).eval()
+    cfm.estimator.setup_caches(max_batch_size=1, max_seq_length=8192)
+    # (prompt frames, target frames) of each item
+    items = [(60, 100), (30, 120), (80, 50), (45, 45)]
+    mus = [torch.randn(prompt_len + target_len, cfg.DiT.content_dim) for prompt_len, target_len in items]
+    prompts = [torch.randn(cfg.DiT.in_channels, prompt_len) for prompt_len, _ in items]
+    style = torch.randn(len(items), cfg.style_encoder.dim)
+
+    cases = [
+        ("cfg", {}),
+        ("cfg + trimmed prompts", {"max_prompt_len": 50}),
+        ("no cfg", {"inference_cfg_rate": 0.0}),
+        ("heun, cfg on 2 steps", {"solver": "heun", "cfg_steps": 2}),
+    ]
+    failed = []
+    for name, kwargs in cases:
+        kwargs = {"inference_cfg_rate": 0.7, "temperature": 0.0, **kwargs}
+        batch = cfm.inference_batch(mus, prompts, style, 5, **kwargs)
+        diffs = []
+        for i, (mu, prompt) in enumerate(zip(mus, prompts)):
+            single = cfm.inference(mu[None], torch.tensor([mu.size(0)]), prompt[None], style[i:i + 1], None, 5,
+                                   **kwargs)[0, :, prompt.size(-1):]
+            diffs.append((single - batch[i]).abs().max().item() if single.shape == batch[i].shape else float("inf"))
+        print(f"{name}: max abs diff to the single items {', '.join(f'{diff:.1e}' for diff in diffs)}")
+        if max(diffs) > 1e-4:
+            failed.append(name)
+
+    # the batches of `infer_fast()`: a shared prompt, targets of different lengths
+    prompt_len = 60
+    mu = torch.randn(3, prompt_len + 100, cfg.DiT.content_dim)
+    x_lens = torch.tensor([prompt_len + 100, prompt_len + 70, prompt_len + 40])
+    for i, x_len in enumerate(x_lens.tolist()):
+        mu[i, x_len:] = 0
+    prompt = torch.randn(1, cfg.DiT.in_channels, prompt_len)
+    batch = cfm.inference(mu, x_lens, prompt, style[:1].expand(3, -1), None, 5, inference_cfg_rate=0.7,
+                          temperature=0.0)
+    diffs = []
+    for i, x_len in enumerate(x_lens.tolist()):
+        single = cfm.inference(mu[i:i + 1, :x_len], x_lens[i:i + 1], prompt, style[:1], None, 5,
+                               inference_cfg_rate=0.7, temperature=0.0)
+        diffs.append((single[0] - batch[i, :, :x_len]).abs().max().item())
+    print(f"shared prompt: max abs diff to the single items {', '.join(f'{diff:.1e}' for diff in diffs)}")
+    if max(diffs) > 1e-4:
+        failed.append("shared prompt")
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All batched CFM results match the single items.")
@@ -0,0 +1,59 @@
+import torch
+
+from small_models import small_gpt
+
+if __name__ == "__main__":
+    """
+    Test that the captured decode steps of `post_init_gpt2_config(compiled_decode_buckets=...)` (CUDA graphs on
+    CUDA, `torch.compile` elsewhere) give the codes and latents of the eager decoding on a small randomly
+    initialized GPT, for batches that fit a bucket and for larger ones, which fall back to the eager step.
+    ```
+    python tests/compiled_decode_test.py
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    gpt = small_gpt().to(device)
+    gpt.post_init_gpt2_config(kv_cache=True)
+    speech_latent = torch.randn(1, 32, 64, device=device)
+    emo_vec = torch.randn(1, 64, device=device)
+    texts = [torch.randint(3, 90, shape, dtype=torch.int32, device=device) for shape in [(1, 9), (2, 11), (5, 7)]]
+    texts[1][1, -3:] = gpt.stop_text_token  # a padded row
+
+    def run(text_tokens, **kwargs):
+        with torch.no_grad():
+            return gpt.inference_speech(None, text_tokens, speech_conditioning_latent=speech_latent, emo_vec=emo_vec,
+                                        repetition_penalty=1.3, max_generate_length=40, do_sample=False, **kwargs)
+
+    cases = [{}, {"return_latent": True}, {"num_beams": 3}, {"num_beams": 3, "return_latent": True}]
+    expected = [[run(text_tokens, **kwargs) for kwargs in cases] for text_tokens in texts]
+
+    gpt.post_init_gpt2_config(kv_cache=True, compiled_decode_buckets=(1, 4))
+    # replays of the step of each bucket
+    replays = {}
+    for step in gpt.inference_model.decode_graphs.steps.values():
+        def counted(*args, _step=step, _replay=step.replay):
+            replays[_step.batch_size] = replays.get(_step.batch_size, 0) + 1
+            return _replay(*args)
+        step.replay = counted
+
+    failed = []
+    for text_tokens, expected_results in zip(texts, expected):
+        for kwargs, expected_result in zip(cases, expected_results):
+            replays.clear()
+            result = run(text_tokens, **kwargs)
+            rows = text_tokens.shape[0] * kwargs.get("num_beams", 1)
+            bucket = next((b for b in (1, 4) if b >= rows), None)
+            name = f"batch {text_tokens.shape[0]}, {kwargs}"
+            same = torch.equal(expected_result[0], result[0])
+            diff = (expected_result[2] - result[2]).abs().max().item() if kwargs.get("return_latent") else 0.0
+            print(f"{name}: {rows} rows, replays {replays}, same codes: {same}, max abs diff of the latents {diff:.2e}")
+            if not same or diff > 1e-4:
+                failed.append(name)
+            if list(replays) != ([bucket] if bucket is not None else []):
+                failed.append(f"{name} (bucket)")
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All compiled decode results match the eager decoding.")
@@ -0,0 +1,61 @@
+import torch
+
+from indextts.gpt.decode_scheduler import DecodeScheduler
+
+from small_models import small_gpt
+
+if __name__ == "__main__":
+    """
+    Test that the continuous batching of `DecodeScheduler` gives the greedy codes of `inference_speech()` for
+    concurrent segments of different lengths, on a small randomly initialized GPT.
+    ```
+    python tests/decode_scheduler_test.py
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    gpt = small_gpt()
+    gpt.post_init_gpt2_config(kv_cache=True, prefix_cache_size=4)
+    with torch.no_grad():
+        # so that some segments stop before their length limit
+        gpt.mel_head.bias[gpt.stop_mel_token] += 0.7
+
+    # more segments than rows, so that segments join the batch while others are decoding
+    requests = []
+    for i in range(6):
+        text_tokens = torch.randint(3, 90, (1, 5 + 3 * i), dtype=torch.int32)
+        requests.append((text_tokens, torch.randn(1, 32, 64), torch.randn(1, 64), 20 + 15 * i))
+    expected = []
+    with torch.no_grad():
+        for text_tokens, speech_latent, emo_vec, max_length in requests:
+            expected.append(gpt.inference_speech(None, text_tokens, speech_conditioning_latent=speech_latent,
+                                                 emo_vec=emo_vec, do_sample=False, num_beams=1,
+                                                 repetition_penalty=1.3, max_generate_length=max_length)[0])
+
+    failed = []
+    scheduler = DecodeScheduler(gpt, max_batch_size=3)
+    for name, prefix_keys in [("greedy", [None] * 6), ("greedy + prefix cache", list(range(6)))]:
+        futures = [scheduler.submit(text_tokens, speech_latent, emo_vec, max_generate_length=max_length,
+                                    do_sample=False, repetition_penalty=1.3, prefix_key=prefix_key)
+                   for (text_tokens, speech_latent, emo_vec, max_length), prefix_key in zip(requests, prefix_keys)]
+        actual = [future.result(timeout=120) for future in futures]
+        same = [torch.equal(e, a) for e, a in zip(expected, actual)]
+        print(f"{name}: lengths {[a.shape[-1] for a in actual]}, same as inference_speech: {same}")
+        if not all(same):
+            failed.append(name)
+
+    # sampled segments only have to respect their limits
+    futures = [scheduler.submit(text_tokens, speech_latent, emo_vec, max_generate_length=max_length)
+               for text_tokens, speech_latent, emo_vec, max_length in requests]
+    lengths = [future.result(timeout=120).shape[-1] for future in futures]
+    print(f"sampled: lengths {lengths}")
+    if any(length > request[-1] for length, request in zip(lengths, requests)):
+        failed.append("sampled lengths")
+    print(scheduler.stats)
+    if scheduler.stats["requests"] != 3 * len(requests) or scheduler.num_active or scheduler.num_pending:
+        failed.append("stats")
+    scheduler.close()
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All scheduled segments match inference_speech.")
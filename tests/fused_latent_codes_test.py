@@ -0,0 +1,77 @@
+import torch
+
+from small_models import small_gpt
+
+
+def decode(gpt, text_tokens, speech_latent, emo_vec, seed, **kwargs):
+    torch.manual_seed(seed)
+    with torch.no_grad():
+        outputs = gpt.inference_speech(None, text_tokens, speech_conditioning_latent=speech_latent, emo_vec=emo_vec,
+                                       max_generate_length=80, **kwargs)
+    codes = outputs[0][0]
+    stop = (codes == gpt.stop_mel_token).nonzero(as_tuple=False)
+    n = stop[0].item() if len(stop) > 0 else codes.shape[0]
+    if kwargs.get("return_latent"):
+        return codes[:n], outputs[2][0, :n]
+    return codes[:n]
+
+
+def forward_latent(gpt, text_tokens, speech_latent, emo_vec, codes):
+    """
+    The latent of the second GPT pass (the default mode of `IndexTTS2`) on the decoded codes.
+    """
+    with torch.no_grad():
+        return gpt(speech_latent, text_tokens, torch.tensor([text_tokens.shape[1]]), codes[None],
+                   torch.tensor([codes.shape[0]]), emo_vec=emo_vec, use_speed=torch.zeros(1, dtype=torch.long))[0]
+
+
+if __name__ == "__main__":
+    """
+    Test the `fused_gpt_latent` mode, `inference_speech(return_latent=True)`, on a small randomly initialized GPT:
+    its latents must be those of the second GPT pass on the same codes, its first code that of the default decoding,
+    and it must leave the default decoding unchanged. It feeds every code one mel position earlier, as the second
+    pass does, so its later codes differ from the default decoding: their agreement rate is only reported.
+    ```
+    python tests/fused_latent_codes_test.py
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    gpt = small_gpt()
+    gpt.post_init_gpt2_config(kv_cache=True)
+    speech_latent = torch.randn(1, 32, 64)
+    emo_vec = torch.randn(1, 64)
+    cases = [
+        ("greedy", {"do_sample": False, "num_beams": 1, "repetition_penalty": 1.3}),
+        ("sample", {"do_sample": True, "top_p": 0.8, "top_k": 30, "temperature": 0.8, "num_beams": 1,
+                    "repetition_penalty": 1.3}),
+        ("beam", {"do_sample": False, "num_beams": 3, "repetition_penalty": 1.3}),
+    ]
+    failed = []
+    for name, kwargs in cases:
+        agreed = total = 0
+        max_diff = 0.0
+        for seed in range(8):
+            text_tokens = torch.randint(3, 90, (1, 5 + 2 * seed), dtype=torch.int32)
+            default = decode(gpt, text_tokens, speech_latent, emo_vec, seed, **kwargs)
+            fused, latent = decode(gpt, text_tokens, speech_latent, emo_vec, seed, return_latent=True, **kwargs)
+            if len(fused) > 0:
+                diff = (latent - forward_latent(gpt, text_tokens, speech_latent, emo_vec, fused)).abs().max().item()
+                max_diff = max(max_diff, diff)
+            # the fused mode leaves no state behind: the default decoding is unchanged after it
+            again = decode(gpt, text_tokens, speech_latent, emo_vec, seed, **kwargs)
+            if not torch.equal(default, again):
+                failed.append(f"{name} (default decoding changed after the fused one, seed {seed})")
+            if len(default) > 0 and len(fused) > 0 and default[0] != fused[0]:
+                failed.append(f"{name} (first code, seed {seed})")
+            n = min(len(default), len(fused))
+            agreed += (default[:n] == fused[:n]).sum().item()
+            total += max(len(default), len(fused))
+        print(f"{name}: max abs diff of the latents to the second pass {max_diff:.2e}, "
+              f"{agreed}/{total} codes agree with the default decoding ({agreed / max(total, 1):.1%})")
+        if max_diff > 1e-4:
+            failed.append(f"{name} (latents)")
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All fused latents match the second pass.")
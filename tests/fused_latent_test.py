@@ -0,0 +1,66 @@
+import torch
+from indextts.infer_v2 import IndexTTS2
+
+
+def code_lengths(codes, stop_mel_token):
+    lengths = []
+    for code in codes:
+        stop = (code == stop_mel_token).nonzero(as_tuple=False)
+        lengths.append(stop[0].item() if len(stop) > 0 else code.shape[0])
+    return torch.tensor(lengths, device=codes.device)
+
+
+if __name__ == "__main__":
+    """
+    Test the GPT latents of `inference_speech(return_latent=True)` against the second GPT pass on the codes.
+    ```
+    python tests/fused_latent_test.py checkpoints
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    import sys
+    sys.path.append("..")
+    if len(sys.argv) > 1:
+        model_dir = sys.argv[1]
+    else:
+        model_dir = "checkpoints"
+    audio_prompt = "tests/sample_prompt.wav"
+    tts = IndexTTS2(cfg_path=f"{model_dir}/config.yaml", model_dir=model_dir, use_fp16=False, use_cuda_kernel=False)
+    spk_conds = tts._get_spk_conditions(audio_prompt)
+    emovec = tts._get_emovec(spk_conds, tts._get_emo_conditions(audio_prompt), 1.0)
+    spk_cond_latent = spk_conds["spk_cond_latent"]
+    texts = ["大家好，我现在正在测试单次解码得到的潜变量。", "The latents of the decoding pass should match the second pass."]
+    text_tokens = [torch.tensor(tts.tokenizer.convert_tokens_to_ids(tts.tokenizer.tokenize(text)), dtype=torch.int32,
+                                device=tts.device).unsqueeze(0) for text in texts]
+    cases = [
+        ("greedy", [text_tokens[0]], {"do_sample": False, "num_beams": 1}),
+        ("sample", [text_tokens[0]], {"do_sample": True, "top_p": 0.8, "top_k": 30, "temperature": 0.8,
+                                      "num_beams": 1}),
+        ("beam", [text_tokens[1]], {"do_sample": False, "num_beams": 3}),
+        ("beam sample", [text_tokens[1]], {"do_sample": True, "top_p": 0.8, "top_k": 30, "temperature": 0.8,
+                                           "num_beams": 3}),
+        ("batch", text_tokens, {"do_sample": True, "top_p": 0.8, "top_k": 30, "temperature": 0.8, "num_beams": 1}),
+    ]
+    failed = []
+    for name, items, kwargs in cases:
+        tokens = tts.pad_tokens_cat(items) if len(items) > 1 else items[0]
+        text_lens = torch.tensor([t.shape[-1] for t in items], device=tts.device)
+        with torch.no_grad():
+            codes, _, latent = tts.gpt.inference_speech(None, tokens, speech_conditioning_latent=spk_cond_latent,
+                                                        emo_vec=emovec, repetition_penalty=10.0,
+                                                        max_generate_length=500, return_latent=True, **kwargs)
+            batch_size = tokens.shape[0]
+            code_lens = code_lengths(codes, tts.stop_mel_token)
+            reference = tts.gpt(spk_cond_latent.expand(batch_size, -1, -1), tokens, text_lens,
+                                codes[:, :code_lens.max()], code_lens, emo_vec=emovec.expand(batch_size, -1),
+                                use_speed=torch.zeros(batch_size, dtype=torch.long, device=tts.device),
+                                mask_padding=True)
+        diff = max((latent[i, :n] - reference[i, :n]).abs().max().item() for i, n in enumerate(code_lens.tolist()))
+        print(f"{name}: codes {code_lens.tolist()}, latent {tuple(latent.shape)}, max abs diff {diff:.2e}")
+        if diff > 1e-3:
+            failed.append(name)
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All latents match the second GPT pass.")
@@ -0,0 +1,86 @@
+import torch
+from transformers import (LogitsProcessorList, MinLengthLogitsProcessor, RepetitionPenaltyLogitsProcessor,
+                          TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper)
+
+from indextts.gpt.fused_sampler import FusedSampler
+
+from small_models import small_gpt
+
+
+def hf_processors(penalty, temperature, top_k, top_p):
+    processors = [RepetitionPenaltyLogitsProcessor(penalty), TemperatureLogitsWarper(temperature)]
+    if top_k:
+        processors.append(TopKLogitsWarper(top_k))
+    if top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p))
+    return LogitsProcessorList(processors)
+
+
+if __name__ == "__main__":
+    """
+    Test the `FusedSampler` against the `generate()` logits processors it replaces: the sampling distributions,
+    the greedy codes of `inference_speech(fused_sampler=True)` on a small randomly initialized GPT, and the
+    fallback to the processors when `generate()` adds another one.
+    ```
+    python tests/fused_sampler_test.py
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    vocab_size = 8194
+    failed = []
+    for penalty, temperature, top_k, top_p in [(10.0, 0.8, 30, 0.8), (1.3, 1.2, 0, 0.9), (2.0, 0.7, 50, 1.0)]:
+        input_ids = torch.randint(0, vocab_size, (3, 200))
+        logits = torch.randn(3, vocab_size) * 3
+        processors = hf_processors(penalty, temperature, top_k, top_p)
+        expected = processors(input_ids, logits.clone()).softmax(dim=-1)
+        sampler = FusedSampler()
+        if not sampler.configure(processors, do_sample=True):
+            failed.append(f"configure({penalty}, {temperature}, {top_k}, {top_p})")
+            continue
+        sampler.reset(input_ids, vocab_size)
+        probs, indices = sampler.candidates(logits.clone())
+        actual = torch.zeros_like(expected).scatter(1, indices, probs / probs.sum(dim=-1, keepdim=True))
+        diff = (actual - expected).abs().max().item()
+        print(f"penalty {penalty}, temperature {temperature}, top_k {top_k}, top_p {top_p}: "
+              f"max abs diff of the probabilities {diff:.2e}")
+        if diff > 1e-5:
+            failed.append(f"distribution ({penalty}, {temperature}, {top_k}, {top_p})")
+    other = LogitsProcessorList([MinLengthLogitsProcessor(10, eos_token_id=8193)]) + hf_processors(10.0, 0.8, 30, 0.8)
+    if FusedSampler().configure(other, do_sample=True):
+        failed.append("configure accepted a MinLengthLogitsProcessor")
+
+    gpt = small_gpt()
+    gpt.post_init_gpt2_config(kv_cache=True)
+    speech_latent = torch.randn(1, 32, 64)
+    emo_vec = torch.randn(1, 64)
+    text_tokens = torch.randint(3, 90, (2, 11), dtype=torch.int32)
+
+    def run(seed=0, **kwargs):
+        torch.manual_seed(seed)
+        with torch.no_grad():
+            return gpt.inference_speech(None, text_tokens, speech_conditioning_latent=speech_latent, emo_vec=emo_vec,
+                                        repetition_penalty=1.3, max_generate_length=60, **kwargs)[0]
+
+    cases = [
+        ("greedy", {"do_sample": False}),
+        ("greedy + return_latent", {"do_sample": False, "return_latent": True}),
+        # `min_new_tokens` adds a processor: the sampler must step aside, so the sampled codes are the same
+        ("sample + min_new_tokens", {"do_sample": True, "top_k": 30, "top_p": 0.8, "temperature": 0.8,
+                                     "min_new_tokens": 20}),
+    ]
+    buffers = None
+    for name, kwargs in cases:
+        expected = run(**kwargs)
+        actual = run(fused_sampler=True, **kwargs)
+        same = expected.shape == actual.shape and torch.equal(expected, actual)
+        print(f"{name}: codes {tuple(actual.shape)}, same as the processors: {same}")
+        if not same:
+            failed.append(name)
+        if buffers is not None and gpt.inference_model.fused_sampler._buffers is not buffers:
+            failed.append(f"{name} (buffers reallocated)")
+        buffers = gpt.inference_model.fused_sampler._buffers
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All fused sampler results match the logits processors.")
@@ -0,0 +1,122 @@
+import torch
+
+from indextts.gpt.decode_scheduler import DecodeScheduler
+from indextts.gpt.paged_kv_cache import KVPagePool, KVPoolExhausted
+
+from small_models import small_gpt
+
+
+def pool_errors():
+    """
+    Reference counting and copy-on-write of the pages of a small pool.
+    """
+    errors = []
+    pool = KVPagePool(num_layers=1, num_heads=2, head_dim=4, num_pages=4, page_size=4)
+    seq = pool.new_sequence()
+    pool.reserve(seq, 6)
+    keys, values = torch.randn(2, 6, 4), torch.randn(2, 6, 4)
+    pool.write(seq, 0, keys, values)
+    pool.seq_lens[seq] = 6
+    seq_pages = list(pool.block_tables[seq])
+
+    # the full page is shared, the partial one is copied
+    fork = pool.fork(seq)
+    fork_pages = pool.block_tables[fork]
+    if fork_pages[0] != seq_pages[0] or fork_pages[1] == seq_pages[1] or pool.page_refs[seq_pages[0]] != 2:
+        errors.append(f"fork pages {fork_pages} of {seq_pages}")
+    slots = pool.slot_mapping([seq, fork], [0, 0], 6)
+    if not torch.equal(pool.key_pages[0][slots[0]], pool.key_pages[0][slots[1]]):
+        errors.append("fork keys")
+
+    # the new tokens of the fork go to its own page
+    pool.reserve(fork, 8)
+    pool.write(fork, 0, torch.randn(2, 2, 4), torch.randn(2, 2, 4), start=6)
+    pool.seq_lens[fork] = 8
+    seq_keys = pool.key_pages[0][pool.slot_mapping([seq], [0], 6)[0]]
+    if not torch.equal(seq_keys, keys.transpose(0, 1)):
+        errors.append("copy-on-write")
+
+    try:
+        pool.reserve(pool.new_sequence(), 12)
+        errors.append("no KVPoolExhausted")
+    except KVPoolExhausted:
+        pass
+    pool.free(seq)
+    # the shared page stays with the fork
+    if pool.page_refs[seq_pages[0]] != 1 or pool.stats()["pages_in_use"] != 2:
+        errors.append(f"free of a forked sequence: {pool.stats()}")
+    pool.free(fork)
+    if pool.stats()["pages_in_use"] != 0:
+        errors.append(f"free: {pool.stats()}")
+    return errors
+
+
+if __name__ == "__main__":
+    """
+    Test the `KVPagePool`: its page reference counting and copy-on-write, and that decoding with the KV cache in
+    the pool gives the codes of the dense cache, with `inference_speech()` (greedy, beam search, sampling) and
+    with a `DecodeScheduler` whose pool is too small for all its segments, so that it preempts them.
+    ```
+    python tests/paged_kv_cache_test.py
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    failed = pool_errors()
+    print(f"page pool: {failed or 'ok'}")
+
+    gpt = small_gpt()
+    with torch.no_grad():
+        # so that the segments stop at different lengths
+        gpt.mel_head.bias[gpt.stop_mel_token] += 0.7
+    requests = []
+    for i in range(8):
+        text_tokens = torch.randint(3, 90, (1, 5 + 3 * i), dtype=torch.int32)
+        requests.append((text_tokens, torch.randn(1, 32, 64), torch.randn(1, 64), 20 + 12 * i))
+    text_tokens, speech_latent, emo_vec, _ = requests[3]
+
+    def run(seed=0, **kwargs):
+        torch.manual_seed(seed)
+        with torch.no_grad():
+            return gpt.inference_speech(None, text_tokens, speech_conditioning_latent=speech_latent, emo_vec=emo_vec,
+                                        repetition_penalty=1.3, max_generate_length=60, **kwargs)[0]
+
+    cases = [
+        ("greedy", {"do_sample": False, "num_beams": 1}),
+        ("beam search", {"do_sample": False, "num_beams": 3}),
+        ("sample", {"do_sample": True, "top_k": 30, "top_p": 0.8, "temperature": 0.8}),
+    ]
+    gpt.post_init_gpt2_config(kv_cache=True)
+    expected = {name: run(**kwargs) for name, kwargs in cases}
+    with torch.no_grad():
+        expected_segments = [gpt.inference_speech(None, tokens, speech_conditioning_latent=latent, emo_vec=emo,
+                                                  max_generate_length=max_length, do_sample=False, num_beams=1,
+                                                  repetition_penalty=1.3)[0]
+                             for tokens, latent, emo, max_length in requests]
+
+    pool = KVPagePool(2, 4, 16, num_pages=64, page_size=8)
+    gpt.post_init_gpt2_config(kv_cache=True, kv_pool=pool)
+    for name, kwargs in cases:
+        same = torch.equal(expected[name], run(**kwargs))
+        print(f"inference_speech {name}: same as the dense cache: {same}")
+        if not same:
+            failed.append(f"inference_speech {name}")
+
+    for num_pages in [400, 40]:
+        pool = KVPagePool(2, 4, 16, num_pages=num_pages, page_size=8)
+        scheduler = DecodeScheduler(gpt, max_batch_size=4, kv_pool=pool)
+        futures = [scheduler.submit(*request[:3], max_generate_length=request[3], do_sample=False,
+                                    repetition_penalty=1.3) for request in requests]
+        same = [torch.equal(e, future.result(timeout=120)) for e, future in zip(expected_segments, futures)]
+        scheduler.close()
+        print(f"scheduler, {num_pages} pages: preempted {scheduler.stats['preempted']}, same as the dense cache: {same}")
+        if not all(same):
+            failed.append(f"scheduler {num_pages} pages")
+        if num_pages == 40 and not scheduler.stats["preempted"]:
+            failed.append("no preemption")
+        if pool.stats()["pages_in_use"]:
+            failed.append(f"scheduler {num_pages} pages: pages left in use")
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All paged KV cache results match the dense cache.")
@@ -0,0 +1,101 @@
+import os
+import tempfile
+
+import torch
+import torch.nn.functional as F
+from transformers.pytorch_utils import Conv1D
+
+from indextts.gpt.quantize import (WeightOnlyInt4Linear, WeightOnlyInt8Linear, group_quantize,
+                                   load_quantized_checkpoint, quantize_gpt, quantize_per_channel,
+                                   save_quantized_checkpoint)
+
+from small_models import small_gpt
+
+
+def relative_error(expected, actual):
+    return ((expected - actual).norm() / expected.norm()).item()
+
+
+if __name__ == "__main__":
+    """
+    Test the weight-only int8/int4 quantization of the GPT: the round trip of the weights, the quantized layers
+    against a dense matmul of their dequantized weights (the kernels of the decode steps and the dense path of the
+    prefill), and the save/load of a quantized checkpoint into a new `UnifiedVoice`, which decodes the same codes.
+    ```
+    python tests/quantize_test.py
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    failed = []
+
+    weight = torch.randn(96, 128)
+    weight_int8, scales = quantize_per_channel(weight)
+    error = (weight_int8.float() * scales[:, None] - weight).abs()
+    print(f"int8 round trip: max error {error.max().item():.2e} (half a step: {scales.max().item() / 2:.2e})")
+    if (error > scales[:, None] / 2 + 1e-6).any():
+        failed.append("int8 round trip")
+    for groupsize in [32, 128]:
+        weight_int4, scales_and_zeros = group_quantize(weight, groupsize)
+        scale, zero = scales_and_zeros.transpose(0, 1).unsqueeze(-1).unbind(dim=-2)
+        dequantized = ((weight_int4.reshape(96, -1, groupsize) - 8) * scale + zero).reshape(96, 128)
+        error = (dequantized - weight).abs().reshape(96, -1, groupsize)
+        print(f"int4 round trip, groupsize {groupsize}: max error {error.max().item():.2e}")
+        if (error > scale / 2 + 1e-6).any():
+            failed.append(f"int4 round trip (groupsize {groupsize})")
+
+    # `Conv1D` keeps its weight as (in, out), `nn.Linear` as (out, in)
+    for layer in [torch.nn.Linear(128, 96), Conv1D(96, 128)]:
+        quantized_layers = {"int8": WeightOnlyInt8Linear.from_float(layer),
+                            "int4": WeightOnlyInt4Linear.from_float(layer, 32),
+                            "int4 packed": WeightOnlyInt4Linear.from_float(layer, 32, packed=True)}
+        for name, quantized in quantized_layers.items():
+            if name == "int8":
+                dequantized = quantized.weight.float() * quantized.scales[:, None]
+            else:
+                dequantized = quantized_layers["int4"].dequantize(torch.float32)
+            # 1 row runs the CPU kernels, 32 rows the dense path, both in float32
+            for rows in [1, 32]:
+                x = torch.randn(rows, 128)
+                error = relative_error(F.linear(x, dequantized, quantized.bias), quantized(x))
+                print(f"{type(layer).__name__} {name} ({quantized.packed if name != 'int8' else False}), "
+                      f"{rows} rows: relative error to the dequantized matmul {error:.2e}")
+                if error > 1e-5:
+                    failed.append(f"{type(layer).__name__} {name}, {rows} rows")
+
+    speech_latent = torch.randn(1, 32, 64)
+    emo_vec = torch.randn(1, 64)
+    text_tokens = torch.randint(3, 90, (1, 9), dtype=torch.int32)
+
+    def run(gpt):
+        gpt.post_init_gpt2_config(kv_cache=True)
+        with torch.no_grad():
+            return gpt.inference_speech(None, text_tokens, speech_conditioning_latent=speech_latent, emo_vec=emo_vec,
+                                        max_generate_length=30, do_sample=False, num_beams=1)[0]
+
+    reference = small_gpt(0)
+    for mode in ["int8", "int4"]:
+        gpt = small_gpt(0)
+        quantize_gpt(gpt, mode, groupsize=32)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # saved before `post_init_gpt2_config()`, as `IndexTTS2` does
+            path = os.path.join(tmp_dir, f"gpt_{mode}.pth")
+            save_quantized_checkpoint(gpt, path)
+            # other initial weights, all of them are loaded
+            loaded = small_gpt(1)
+            config = load_quantized_checkpoint(loaded, path)
+        expected = run(gpt)
+        same = torch.equal(expected, run(loaded))
+        with torch.no_grad():
+            x = torch.randn(4, 64)
+            error = relative_error(reference.mel_head(x), gpt.mel_head(x))
+        print(f"{mode} checkpoint: {len(config['packed'])} packed layers, same codes after loading: {same}, "
+              f"relative error of the mel logits {error:.2e}")
+        if not same or config != gpt.quantization:
+            failed.append(f"{mode} checkpoint")
+        if error > (0.05 if mode == "int8" else 0.3):
+            failed.append(f"{mode} mel logits")
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All quantized results match.")
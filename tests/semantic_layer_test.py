@@ -0,0 +1,46 @@
+import copy
+
+import torch
+from transformers import Wav2Vec2BertConfig, Wav2Vec2BertModel
+
+from indextts.utils.maskgct_utils import get_semantic_features
+
+if __name__ == "__main__":
+    """
+    Test that the w2v-bert model truncated at the semantic layer gives the same features as `hidden_states[17]`
+    of the full model.
+    ```
+    python tests/semantic_layer_test.py            # small randomly initialized model
+    python tests/semantic_layer_test.py pretrained # facebook/w2v-bert-2.0
+    ```
+    """
+    import sys
+    import transformers
+    transformers.set_seed(42)
+    output_layer = 17
+    if len(sys.argv) > 1 and sys.argv[1] == "pretrained":
+        full_model = Wav2Vec2BertModel.from_pretrained("facebook/w2v-bert-2.0")
+    else:
+        config = Wav2Vec2BertConfig(hidden_size=64, num_hidden_layers=24, num_attention_heads=4,
+                                    intermediate_size=128, output_hidden_size=64, conv_depthwise_kernel_size=7)
+        full_model = Wav2Vec2BertModel(config)
+    full_model.eval()
+
+    truncated_model = copy.deepcopy(full_model)
+    truncated_model.encoder.layers = truncated_model.encoder.layers[:output_layer]
+
+    # a padded batch of 2, as returned by `SeamlessM4TFeatureExtractor`
+    input_features = torch.randn(2, 120, full_model.config.feature_projection_input_dim)
+    attention_mask = torch.ones(2, 120, dtype=torch.long)
+    attention_mask[1, 90:] = 0
+
+    with torch.no_grad():
+        expected = full_model(input_features=input_features, attention_mask=attention_mask,
+                              output_hidden_states=True).hidden_states[output_layer]
+        actual = get_semantic_features(truncated_model, input_features, attention_mask)
+    max_diff = (expected - actual).abs().max().item()
+    print(f"layers: {len(full_model.encoder.layers)} -> {len(truncated_model.encoder.layers)}, "
+          f"shape: {tuple(actual.shape)}, max abs diff: {max_diff:.3e}")
+    assert actual.shape == expected.shape
+    assert torch.allclose(expected, actual, atol=1e-5), max_diff
+    print("semantic features match.")
@@ -0,0 +1,20 @@
+import torch
+
+from indextts.gpt.model_v2 import UnifiedVoice
+
+
+def small_gpt(seed=None, **overrides):
+    """
+    A small randomly initialized `UnifiedVoice` (2 layers of width 64, conformer/perceiver conditioning) for the
+    tests, in eval mode and before `post_init_gpt2_config()`. `seed` seeds its initial weights, else they come from
+    the current random state; `overrides` replace the `UnifiedVoice` arguments.
+    """
+    condition_module = {"output_size": 64, "linear_units": 128, "attention_heads": 4, "num_blocks": 1,
+                        "input_layer": "conv2d2", "perceiver_mult": 2}
+    kwargs = dict(layers=2, model_dim=64, heads=4, max_text_tokens=60, max_mel_tokens=120, number_text_tokens=100,
+                  number_mel_codes=8194, condition_type="conformer_perceiver", condition_module=condition_module,
+                  emo_condition_module=condition_module)
+    kwargs.update(overrides)
+    if seed is not None:
+        torch.manual_seed(seed)
+    return UnifiedVoice(**kwargs).eval()
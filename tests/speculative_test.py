@@ -0,0 +1,66 @@
+import collections
+
+import torch
+
+from indextts.gpt.speculative import EarlyExitDrafter, NGramDrafter, format_stats
+
+from small_models import small_gpt
+
+if __name__ == "__main__":
+    """
+    Test the speculative decoding of the mel codes on a small randomly initialized GPT: greedy decoding with each
+    drafter gives the codes of `generate()`, and with sampling the accepted drafts and the residual samples of the
+    rejected ones follow the distribution of `generate()`.
+    ```
+    python tests/speculative_test.py
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    gpt = small_gpt()
+    gpt.post_init_gpt2_config(kv_cache=True)
+    with torch.no_grad():
+        # a frequent silent code, so that the n-gram drafter finds repeats to draft from
+        gpt.mel_head.bias[52] += 2.0
+    speech_latent = torch.randn(1, 32, 64)
+    emo_vec = torch.randn(1, 64)
+    texts = [torch.randint(3, 90, (1, n), dtype=torch.int32) for n in (7, 13, 20)]
+
+    def run(text_tokens, **kwargs):
+        with torch.no_grad():
+            return gpt.inference_speech(None, text_tokens, speech_conditioning_latent=speech_latent, emo_vec=emo_vec,
+                                        repetition_penalty=1.3, **kwargs)[0]
+
+    failed = []
+    for return_latent in [False, True]:
+        expected = [run(text_tokens, do_sample=False, max_generate_length=80, return_latent=return_latent)
+                    for text_tokens in texts]
+        for drafter in [NGramDrafter(2, 4), NGramDrafter(1, 6), EarlyExitDrafter(1, 3), EarlyExitDrafter(2, 5)]:
+            actual = [run(text_tokens, do_sample=False, max_generate_length=80, return_latent=return_latent,
+                          drafter=drafter) for text_tokens in texts]
+            same = [torch.equal(e, a) for e, a in zip(expected, actual)]
+            name = f"greedy {type(drafter).__name__}({drafter.num_draft_tokens} drafts), return_latent {return_latent}"
+            print(f"{name}: same as generate(): {same}, {format_stats(drafter.stats)}")
+            if not all(same):
+                failed.append(name)
+
+    # the second code is drafted by a single layer, whose distribution differs from the GPT: a part of the drafts
+    # are rejected and replaced by residual samples. The (first, second) code pairs must follow generate().
+    sampling = {"do_sample": True, "top_k": 4, "top_p": 0.95, "temperature": 1.5, "max_generate_length": 3}
+    num_samples = 2000
+    drafter = EarlyExitDrafter(1, 2)
+    expected = collections.Counter(tuple(run(texts[0], **sampling)[0, :2].tolist()) for _ in range(num_samples))
+    actual = collections.Counter(tuple(run(texts[0], drafter=drafter, **sampling)[0, :2].tolist())
+                                 for _ in range(num_samples))
+    distance = sum(abs(expected[pair] - actual[pair]) for pair in expected.keys() | actual.keys()) / 2 / num_samples
+    print(f"sampling: total variation distance of the code pairs {distance:.3f}, {format_stats(drafter.stats)}")
+    # about 0.04 for this sample size; sampling the rejected drafts from the GPT distribution instead of the
+    # residual gives about 0.24
+    if distance > 0.1:
+        failed.append("sampling distribution")
+    if not 0 < drafter.stats["accepted"] < drafter.stats["drafted"]:
+        failed.append("sampling without rejected drafts")
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All speculative decoding results match generate().")
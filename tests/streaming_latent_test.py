@@ -0,0 +1,42 @@
+import torch
+
+from small_models import small_gpt
+
+if __name__ == "__main__":
+    """
+    Test the GPT latents computed chunk by chunk with `get_latent_prefix()` / `extend_latent()`, as the streaming
+    synthesis of `IndexTTS2._infer_segment_chunks()` does, against `UnifiedVoice.forward()` on the codes so far,
+    on a small randomly initialized GPT.
+    ```
+    python tests/streaming_latent_test.py
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    gpt = small_gpt(max_mel_tokens=250)
+    speech_latent = torch.randn(1, 32, 64)
+    emo_vec = torch.randn(1, 64)
+    text_tokens = torch.randint(3, 90, (1, 17), dtype=torch.int32)
+    codes = torch.randint(0, 8192, (200,)).tolist()
+    # windows of `_infer_segment_chunks()`: 40 codes, then 80 more each time, with 8 codes of overlap
+    windows = [(0, 40), (32, 120), (112, 200)]
+    failed = []
+    with torch.no_grad():
+        past_key_values = gpt.get_latent_prefix(speech_latent, text_tokens, emo_vec)
+        mel_inputs = [gpt.start_mel_token] + codes
+        latents = torch.zeros(1, 0, 64)
+        for start, end in windows:
+            done = latents.shape[1]
+            latents = torch.cat([latents, gpt.extend_latent(past_key_values, torch.tensor([mel_inputs[done:end]]),
+                                                            done)], dim=1)
+            reference = gpt(speech_latent, text_tokens, torch.tensor([text_tokens.shape[1]]),
+                            torch.tensor([codes[:end]]), torch.tensor([end]), emo_vec=emo_vec,
+                            use_speed=torch.zeros(1, dtype=torch.long))[:, start:end]
+            diff = (latents[:, start:end] - reference).abs().max().item()
+            print(f"codes [{start}, {end}): max abs diff {diff:.2e}")
+            if diff > 1e-4:
+                failed.append((start, end))
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All chunk latents match the full forward.")
@@ -0,0 +1,50 @@
+import json
+
+import torch
+
+from indextts.s2mel.modules.bigvgan.bigvgan import BigVGAN
+from indextts.s2mel.modules.bigvgan.env import AttrDict
+from indextts.s2mel.modules.bigvgan.tiled import TiledBigVGAN, receptive_field
+
+if __name__ == "__main__":
+    """
+    Test that `TiledBigVGAN` vocodes long mels by windows into the audio of the whole mel, on a randomly initialized
+    BigVGAN of the model's upsampling stack with fewer channels.
+    ```
+    python tests/tiled_vocoder_test.py
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    with open("indextts/s2mel/modules/bigvgan/config.json") as f:
+        h = json.load(f)
+    # same receptive field, fewer channels
+    h["upsample_initial_channel"] = 64
+    vocoder = BigVGAN(AttrDict(h)).eval()
+    vocoder.remove_weight_norm()
+    print(f"receptive field: {receptive_field(h)} frames")
+
+    failed = []
+    with torch.no_grad():
+        for num_frames in [300, 301]:
+            mel = torch.randn(2, h["num_mels"], num_frames) * 2 - 5
+            full = vocoder(mel)
+            scale = full.abs().max().item()
+            # the error shrinks as the windows see more context, and vanishes with the receptive field
+            errors = []
+            for context_frames in [0, 8, None]:
+                tiled = TiledBigVGAN(vocoder, chunk_frames=64, context_frames=context_frames)
+                errors.append((tiled.context_frames, (tiled(mel) - full).abs().max().item() / scale))
+            print(f"{num_frames} frames, windows {TiledBigVGAN(vocoder, 64).windows(num_frames)}: relative error "
+                  f"{', '.join(f'{error:.1e} ({context} context frames)' for context, error in errors)}")
+            errors = [error for _, error in errors]
+            if not errors[-1] < 1e-5 or errors != sorted(errors, reverse=True):
+                failed.append(f"{num_frames} frames")
+            # a single window is the vocoder itself
+            if not TiledBigVGAN(vocoder, chunk_frames=None)(mel).equal(full) \
+                    or not TiledBigVGAN(vocoder, chunk_frames=512)(mel).equal(full):
+                failed.append(f"{num_frames} frames, single window")
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All tiled vocoder results match the whole mel.")
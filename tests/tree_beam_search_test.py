@@ -0,0 +1,84 @@
+import torch
+from transformers import StoppingCriteriaList
+
+from indextts.gpt.beam_search import BeamSearchDecoder
+from indextts.gpt.code_streamer import SilenceStoppingCriteria
+
+from small_models import small_gpt
+
+if __name__ == "__main__":
+    """
+    Test that the tree beam search of `inference_speech(tree_beam_search=True, prune_beams=False)` returns the
+    codes of `generate(num_beams=...)` on a small randomly initialized GPT, and that pruning only saves steps.
+    ```
+    python tests/tree_beam_search_test.py
+    ```
+    """
+    import transformers
+    transformers.set_seed(42)
+    gpt = small_gpt()
+    gpt.post_init_gpt2_config(kv_cache=True)
+    with torch.no_grad():
+        # so that hypotheses finish at different lengths
+        gpt.mel_head.bias[gpt.stop_mel_token] += 0.5
+    speech_latent = torch.randn(1, 32, 64)
+    emo_vec = torch.randn(1, 64)
+    text_tokens = torch.randint(3, 90, (1, 9), dtype=torch.int32)
+
+    def run(**kwargs):
+        with torch.no_grad():
+            return gpt.inference_speech(None, text_tokens, speech_conditioning_latent=speech_latent, emo_vec=emo_vec,
+                                        do_sample=False, **kwargs)
+
+    cases = [
+        ("3 beams", {"num_beams": 3, "repetition_penalty": 1.3, "max_generate_length": 60}),
+        # longer than the initial capacity of the KV buffers, which grow
+        ("4 beams, 110 codes", {"num_beams": 4, "repetition_penalty": 2.0, "max_generate_length": 110}),
+        ("5 beams, length_penalty 0", {"num_beams": 5, "length_penalty": 0.0, "max_generate_length": 60}),
+        ("4 beams, 2 sequences", {"num_beams": 4, "num_return_sequences": 2, "max_generate_length": 60}),
+        ("3 beams + return_latent", {"num_beams": 3, "repetition_penalty": 1.3, "max_generate_length": 60,
+                                     "return_latent": True}),
+    ]
+    failed = []
+    for name, kwargs in cases:
+        expected = run(**kwargs)
+        actual = run(tree_beam_search=True, prune_beams=False, **kwargs)
+        same = torch.equal(expected[0], actual[0])
+        diff = (expected[2] - actual[2]).abs().max().item() if kwargs.get("return_latent") and same else 0.0
+        print(f"{name}: codes {tuple(actual[0].shape)}, same as generate(): {same}, "
+              f"max abs diff of the latents {diff:.2e}")
+        if not same or diff > 1e-4:
+            failed.append(name)
+
+    with torch.no_grad():
+        gpt.mel_head.bias[gpt.stop_mel_token] -= 0.5
+        gpt.mel_head.bias[52] += 3.0
+    # every beam is stopped by its silence
+    expected = run(num_beams=3, max_generate_length=80, stopping_criteria=StoppingCriteriaList(
+        [SilenceStoppingCriteria(52, 10)]))[0]
+    actual = run(num_beams=3, max_generate_length=80, stopping_criteria=StoppingCriteriaList(
+        [SilenceStoppingCriteria(52, 10)]), tree_beam_search=True, prune_beams=False)[0]
+    same = torch.equal(expected, actual)
+    print(f"3 beams + silence stopping: codes {tuple(actual.shape)}, same as generate(): {same}")
+    if not same:
+        failed.append("silence stopping")
+    with torch.no_grad():
+        gpt.mel_head.bias[52] -= 3.0
+        gpt.mel_head.bias[gpt.stop_mel_token] += 0.5
+
+    conds_latent = gpt.get_conds_latent(speech_latent, emo_vec)
+    for seed in range(4):
+        torch.manual_seed(seed)
+        text_tokens = torch.randint(3, 90, (1, 5 + seed), dtype=torch.int32)
+        steps = {}
+        for prune in [False, True]:
+            decoder = BeamSearchDecoder(gpt, num_beams=5, length_penalty=0.0, prune=prune)
+            decoder.generate(conds_latent, text_tokens, 100)
+            steps[prune] = decoder.stats["steps"]
+        print(f"text {seed}: steps {steps[False]} without pruning, {steps[True]} with")
+        if steps[True] > steps[False]:
+            failed.append(f"pruning of text {seed}")
+    if failed:
+        print("mismatch:", failed)
+    else:
+        print("All tree beam search results match generate().")
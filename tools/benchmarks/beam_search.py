@@ -0,0 +1,126 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+from omegaconf import OmegaConf
+
+from indextts.gpt.beam_search import BeamSearchDecoder
+from indextts.gpt.model_v2 import UnifiedVoice
+from indextts.utils.checkpoint import load_checkpoint
+
+
+def sampling_kwargs(args):
+    if args.greedy:
+        return dict(do_sample=False, repetition_penalty=args.repetition_penalty)
+    # the defaults of `IndexTTS2.infer()`
+    return dict(do_sample=True, top_p=0.8, top_k=30, temperature=0.8, repetition_penalty=args.repetition_penalty)
+
+
+@torch.no_grad()
+def run_hf(gpt, text_tokens, spk_cond_latent, emovec, num_beams, args, dtype):
+    # `generate()` may go on after the returned hypothesis ends, count its forward passes
+    calls = []
+    hook = gpt.inference_model.register_forward_hook(lambda *_: calls.append(1))
+    try:
+        with torch.amp.autocast(text_tokens.device.type, enabled=dtype is not None, dtype=dtype):
+            codes, _ = gpt.inference_speech(None, text_tokens, speech_conditioning_latent=spk_cond_latent,
+                                            emo_vec=emovec, num_beams=num_beams, max_generate_length=args.tokens,
+                                            **({"length_penalty": 0.0} if num_beams > 1 else {}),
+                                            **sampling_kwargs(args))
+    finally:
+        hook.remove()
+    return codes, {"steps": len(calls)}
+
+
+@torch.no_grad()
+def run_tree(gpt, text_tokens, spk_cond_latent, emovec, num_beams, args, dtype, prune):
+    decoder = BeamSearchDecoder(gpt, num_beams=num_beams, length_penalty=0.0, prune=prune, **sampling_kwargs(args))
+    with torch.amp.autocast(text_tokens.device.type, enabled=dtype is not None, dtype=dtype):
+        codes, _ = decoder.generate(gpt.get_conds_latent(spk_cond_latent, emovec), text_tokens, args.tokens)
+    return codes, decoder.stats
+
+
+def measure(device, fn):
+    cuda = device.startswith("cuda")
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start_time = time.perf_counter()
+    result = fn()
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start_time
+    peak = (torch.cuda.max_memory_allocated() - base) / 1024 / 1024 if cuda else None
+    return elapsed, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and memory of the GPT beam search: generate() vs. "
+                                                 "BeamSearchDecoder (shared prompt KV, tree attention, pruning)")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory")
+    parser.add_argument("--fp16", action="store_true", default=False, help="Use FP16 for inference if available")
+    parser.add_argument("-d", "--device", type=str, nargs="+",
+                        default=["cpu"] + (["cuda:0"] if torch.cuda.is_available() else []),
+                        help="Devices to benchmark")
+    parser.add_argument("--beams", type=int, nargs="+", default=[1, 3, 5], help="Numbers of beams")
+    parser.add_argument("--tokens", type=int, default=400, help="Maximum generated codes per run")
+    parser.add_argument("--text_tokens", type=int, default=60, help="Length of the text prompt")
+    parser.add_argument("--repetition_penalty", type=float, default=10.0)
+    parser.add_argument("--greedy", action="store_true", default=False, help="Greedy beams instead of sampling")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per configuration")
+    args = parser.parse_args()
+
+    cfg = OmegaConf.load(os.path.join(args.model_dir, "config.yaml"))
+    print(f"{'device':<8} {'beams':>5} {'mode':<12} {'time (s)':>9} {'codes':>6} {'steps':>6} {'ms/step':>8} "
+          f"{'speedup':>8} {'KV (MB)':>8} {'peak (MB)':>9}")
+    for device in args.device:
+        fp16 = args.fp16 and device.startswith("cuda")
+        dtype = torch.float16 if fp16 else None
+        gpt = UnifiedVoice(**cfg.gpt)
+        load_checkpoint(gpt, os.path.join(args.model_dir, cfg.gpt_checkpoint))
+        gpt = gpt.to(device).eval()
+        if fp16:
+            gpt.half()
+        gpt.post_init_gpt2_config(kv_cache=True, half=fp16)
+        kv_dtype = torch.float16 if fp16 else torch.float32
+        token_bytes = 2 * cfg.gpt.layers * cfg.gpt.model_dim * torch.empty((), dtype=kv_dtype).element_size()
+        torch.manual_seed(0)
+        text_tokens = torch.randint(100, 1000, (1, args.text_tokens), dtype=torch.int32, device=device)
+        spk_cond_latent = torch.randn(1, 32, cfg.gpt.model_dim, device=device, dtype=gpt.mel_head.weight.dtype)
+        emovec = torch.zeros(1, cfg.gpt.model_dim, device=device, dtype=gpt.mel_head.weight.dtype)
+        prompt_len = gpt.cond_num + 2 + args.text_tokens + 2 + 1
+        for num_beams in args.beams:
+            modes = {"generate": lambda: run_hf(gpt, text_tokens, spk_cond_latent, emovec, num_beams, args, dtype)}
+            if num_beams > 1:
+                modes["tree"] = lambda: run_tree(gpt, text_tokens, spk_cond_latent, emovec, num_beams, args, dtype,
+                                                 prune=False)
+                modes["tree+prune"] = lambda: run_tree(gpt, text_tokens, spk_cond_latent, emovec, num_beams, args,
+                                                       dtype, prune=True)
+            baseline = None
+            for name, fn in modes.items():
+                fn()  # warm up
+                runs = []
+                for repeat in range(args.repeats):
+                    torch.manual_seed(repeat)
+                    runs.append(measure(device, fn))
+                elapsed, peak, (codes, stats) = min(runs, key=lambda run: run[0])
+                steps = stats["steps"]
+                # the cache of `generate()` holds every beam with its own copy of the prompt
+                kv_bytes = stats.get("cache_bytes", num_beams * (prompt_len + steps) * token_bytes)
+                baseline = baseline or elapsed
+                peak = f"{peak:>9.1f}" if peak is not None else f"{'-':>9}"
+                print(f"{device:<8} {num_beams:>5} {name:<12} {elapsed:>9.2f} {codes.shape[-1]:>6} {steps:>6} "
+                      f"{elapsed / max(steps, 1) * 1000:>8.2f} {baseline / elapsed:>7.2f}x "
+                      f"{kv_bytes / 1024 / 1024:>8.1f} {peak}")
+        del gpt
+        if device.startswith("cuda"):
+            torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+from omegaconf import OmegaConf
+
+from indextts.s2mel.modules.flow_matching import CFM
+
+MODES = {
+    # every intermediate sample kept alive until the end, as the solver did before the in-place loop
+    "trajectory": {"return_trajectory": True},
+    "in-place": {},
+}
+
+
+def run(cfm, inputs, args, mode_kwargs):
+    mu, x_lens, prompt, style = inputs
+    cuda = args.device.startswith("cuda")
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    torch.manual_seed(0)
+    start_time = time.perf_counter()
+    with torch.amp.autocast(mu.device.type, enabled=args.fp16 and cuda, dtype=torch.float16):
+        result = cfm.inference(mu, x_lens, prompt, style, None, args.steps, inference_cfg_rate=0.7, solver=args.solver,
+                               **mode_kwargs)
+    if cuda:
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start_time
+    peak = (torch.cuda.max_memory_allocated() - base) / 1024 / 1024 if cuda else None
+    sample, trajectory = result if isinstance(result, tuple) else (result, [])
+    retained = sum(x.numel() * x.element_size() for x in trajectory) / 1024 / 1024
+    del result, trajectory
+    return elapsed, peak, retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory of the s2mel CFM sampling loop: in-place steps vs. "
+                                                 "keeping every intermediate sample")
+    parser.add_argument("--config", type=str, default="checkpoints/config.yaml", help="Model config")
+    parser.add_argument("-d", "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu",
+                        help="Device to run on")
+    parser.add_argument("--fp16", action="store_true", default=False, help="Use FP16 autocast on CUDA")
+    parser.add_argument("--batch_size", type=int, default=8, help="Items per sampling loop")
+    parser.add_argument("--frames", type=int, default=2000, help="Mel frames per item, prompt included")
+    parser.add_argument("--prompt_frames", type=int, default=300, help="Prompt frames per item")
+    parser.add_argument("--steps", type=int, default=25, help="Sampling steps")
+    parser.add_argument("--solver", type=str, default="euler", help="ODE solver")
+    args = parser.parse_args()
+
+    cfg = OmegaConf.load(args.config)
+    cfm = CFM(cfg.s2mel).to(args.device).eval()
+    cfm.estimator.setup_caches(max_batch_size=1, max_seq_length=8192)
+    torch.manual_seed(0)
+    inputs = (torch.randn(args.batch_size, args.frames, cfg.s2mel.DiT.content_dim, device=args.device),
+              torch.full((args.batch_size,), args.frames, device=args.device),
+              torch.randn(args.batch_size, cfg.s2mel.DiT.in_channels, args.prompt_frames, device=args.device),
+              torch.randn(args.batch_size, cfg.s2mel.style_encoder.dim, device=args.device))
+
+    print(f"batch {args.batch_size}, {args.frames} frames, {args.steps} {args.solver} steps on {args.device}")
+    print(f"{'mode':<11} {'time (s)':>9} {'retained (MB)':>13} {'peak (MB)':>9}")
+    results = {}
+    for name, mode_kwargs in MODES.items():
+        run(cfm, inputs, args, mode_kwargs)  # warm up
+        elapsed, peak, retained = run(cfm, inputs, args, mode_kwargs)
+        results[name] = peak
+        peak = f"{peak:>9.1f}" if peak is not None else f"{'-':>9}"
+        print(f"{name:<11} {elapsed:>9.2f} {retained:>13.1f} {peak}")
+    if results["in-place"] is not None:
+        saved = results["trajectory"] - results["in-place"]
+        print(f"peak memory reduction: {saved:.1f} MB ({saved / results['trajectory']:.1%})")
+
+
+if __name__ == "__main__":
+    main()
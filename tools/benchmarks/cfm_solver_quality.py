@@ -0,0 +1,104 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+
+from indextts.infer_v2 import IndexTTS2
+
+
+@torch.no_grad()
+def prepare_s2mel_inputs(tts, voice, text):
+    """
+    Run the GPT once and return the CFM inputs of `infer()` for the first text segment.
+    """
+    spk_conds = tts._get_spk_conditions(voice)
+    emovec = tts._get_emovec(spk_conds, tts._get_emo_conditions(voice), 1.0)
+    text_tokens = tts.tokenizer.convert_tokens_to_ids(tts.tokenizer.tokenize(text))
+    text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=tts.device).unsqueeze(0)
+    spk_cond_latent = spk_conds["spk_cond_latent"]
+    with torch.amp.autocast(text_tokens.device.type, enabled=tts.dtype is not None, dtype=tts.dtype):
+        codes, _ = tts.gpt.inference_speech(None, text_tokens, speech_conditioning_latent=spk_cond_latent,
+                                            emo_vec=emovec, do_sample=True, top_p=0.8, top_k=30, temperature=0.8,
+                                            num_beams=3, repetition_penalty=10.0, max_generate_length=1500)
+        codes, code_lens = tts.remove_long_silence(codes)
+        latent = tts.gpt(spk_cond_latent, text_tokens, torch.tensor([text_tokens.shape[-1]], device=tts.device),
+                         codes, code_lens, emo_vec=emovec,
+                         use_speed=torch.zeros(1, dtype=torch.long, device=tts.device))
+    latent = tts.s2mel.models['gpt_layer'](latent)
+    S_infer = tts.semantic_codec.quantizer.vq2emb(codes.unsqueeze(1)).transpose(1, 2) + latent
+    target_lengths = (code_lens * 1.72).long()
+    cond = tts.s2mel.models['length_regulator'](S_infer, ylens=target_lengths, n_quantizers=3, f0=None)[0]
+    cat_condition = torch.cat([spk_conds["prompt_condition"], cond], dim=1)
+    return cat_condition, spk_conds["ref_mel"], spk_conds["style"]
+
+
+def run_cfm(tts, inputs, seed, **cfm_kwargs):
+    cat_condition, ref_mel, style = inputs
+    torch.manual_seed(seed)
+    if "cuda" in str(tts.device):
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    mel = tts.s2mel.models['cfm'].inference(cat_condition, torch.LongTensor([cat_condition.size(1)]).to(tts.device),
+                                            ref_mel, style, None, **cfm_kwargs)
+    if "cuda" in str(tts.device):
+        torch.cuda.synchronize()
+    return mel[:, :, ref_mel.size(-1):], time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="s2mel CFM quality vs. steps, against 25-step Euler")
+    parser.add_argument("-v", "--voice", type=str, default="tests/sample_prompt.wav", help="Reference audio")
+    parser.add_argument("-t", "--text", type=str, default="大家好，这是一段用来比较不同采样步数下音质的测试文本。",
+                        help="Text to synthesize")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory")
+    parser.add_argument("--fp16", action="store_true", default=False, help="Use FP16 for inference if available")
+    parser.add_argument("-d", "--device", type=str, default=None, help="Device to run the model on")
+    parser.add_argument("--steps", type=int, nargs="+", default=[4, 6, 8, 10, 16], help="Step counts to compare")
+    parser.add_argument("--solvers", type=str, nargs="+", default=["euler", "midpoint", "heun", "multistep"],
+                        help="ODE solvers to compare")
+    parser.add_argument("--sway_coef", type=float, nargs="*", default=[-1.0],
+                        help="Sway sampling coefficients to compare, in addition to the uniform schedule")
+    parser.add_argument("--inference_cfg_rate", type=float, default=0.7, help="CFG rate")
+    parser.add_argument("--seeds", type=int, default=3, help="Noise seeds to average over")
+    args = parser.parse_args()
+
+    tts = IndexTTS2(cfg_path=os.path.join(args.model_dir, "config.yaml"), model_dir=args.model_dir,
+                    use_fp16=args.fp16, device=args.device)
+    inputs = prepare_s2mel_inputs(tts, args.voice, args.text)
+    print(f">> target frames: {inputs[0].size(1) - inputs[1].size(-1)}")
+
+    references = []
+    ref_time = 0.0
+    for seed in range(args.seeds):
+        mel, elapsed = run_cfm(tts, inputs, seed, n_timesteps=25, inference_cfg_rate=args.inference_cfg_rate)
+        references.append(mel)
+        ref_time += elapsed
+    ref_time /= args.seeds
+
+    print(f"{'solver':<10} {'sway':>6} {'steps':>6} {'NFE':>5} {'mel L1':>8} {'time (s)':>9} {'speedup':>8}")
+    print(f"{'euler':<10} {'-':>6} {25:>6} {25:>5} {0.0:>8.4f} {ref_time:>9.3f} {1.0:>8.2f}")
+    nfe_per_step = {"euler": 1, "midpoint": 2, "heun": 2, "multistep": 1}
+    for solver in args.solvers:
+        for sway_coef in [None] + list(args.sway_coef):
+            for steps in args.steps:
+                l1 = 0.0
+                total_time = 0.0
+                for seed, reference in enumerate(references):
+                    mel, elapsed = run_cfm(tts, inputs, seed, n_timesteps=steps,
+                                           inference_cfg_rate=args.inference_cfg_rate, solver=solver,
+                                           sway_coef=sway_coef)
+                    l1 += (mel - reference).abs().mean().item()
+                    total_time += elapsed
+                l1 /= args.seeds
+                total_time /= args.seeds
+                sway = "-" if sway_coef is None else f"{sway_coef:g}"
+                print(f"{solver:<10} {sway:>6} {steps:>6} {steps * nfe_per_step[solver]:>5} {l1:>8.4f} "
+                      f"{total_time:>9.3f} {ref_time / total_time:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+
+from indextts.gpt.decode_scheduler import DecodeScheduler
+from indextts.gpt.paged_kv_cache import KVPagePool
+from indextts.infer_v2 import IndexTTS2
+
+TEXTS = [
+    "大家好，我现在正在测试并发请求下的解码吞吐量。",
+    "The quick brown fox jumps over the lazy dog, and then it runs away into the forest.",
+    "今天天气不错，我们一起去公园散步吧。",
+    "Continuous batching keeps the GPU busy while many clients are waiting for their audio.",
+    "这是一段稍微长一点的测试文本，用来模拟不同长度的句子同时解码的情况。",
+]
+
+
+@torch.no_grad()
+def serial_generate(tts, lock, text_tokens, spk_cond_latent, emovec, args):
+    # the current path: one `generate()` at a time on the shared model
+    with lock:
+        with torch.amp.autocast(text_tokens.device.type, enabled=tts.dtype is not None, dtype=tts.dtype):
+            codes, _ = tts.gpt.inference_speech(None, text_tokens, speech_conditioning_latent=spk_cond_latent,
+                                                emo_vec=emovec, do_sample=True, top_p=0.8, top_k=30,
+                                                temperature=0.8, num_beams=1, repetition_penalty=10.0,
+                                                max_generate_length=args.max_mel_tokens)
+    return codes
+
+
+def run_clients(generate, requests, clients, requests_per_client):
+    """
+    Run `clients` threads, each generating `requests_per_client` segments one after the other.
+    Returns the wall time, the generated codes and the latency of every request.
+    """
+    codes = 0
+    latencies = []
+    lock = threading.Lock()
+
+    def client(index):
+        nonlocal codes
+        for i in range(requests_per_client):
+            text_tokens, spk_cond_latent, emovec = requests[(index + i) % len(requests)]
+            start_time = time.perf_counter()
+            out = generate(text_tokens, spk_cond_latent, emovec)
+            with lock:
+                latencies.append(time.perf_counter() - start_time)
+                codes += out.shape[-1]
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start_time, codes, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GPT decoding throughput of concurrent clients: serial vs. "
+                                                 "continuous batching")
+    parser.add_argument("-v", "--voice", type=str, default="tests/sample_prompt.wav", help="Reference audio")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory")
+    parser.add_argument("--fp16", action="store_true", default=False, help="Use FP16 for inference if available")
+    parser.add_argument("-d", "--device", type=str, default=None, help="Device to run the model on")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 8, 16], help="Numbers of simulated clients")
+    parser.add_argument("--requests_per_client", type=int, default=4, help="Segments generated by each client")
+    parser.add_argument("--max_batch_size", type=int, default=16, help="Maximum decode batch of the scheduler")
+    parser.add_argument("--max_mel_tokens", type=int, default=1500, help="Maximum generated codes per segment")
+    parser.add_argument("--kv_pool_mb", type=int, default=0,
+                        help="Also benchmark the scheduler with a paged KV pool of this size (MB)")
+    args = parser.parse_args()
+
+    tts = IndexTTS2(cfg_path=os.path.join(args.model_dir, "config.yaml"), model_dir=args.model_dir,
+                    use_fp16=args.fp16, device=args.device)
+    kv_pool = None
+    if args.kv_pool_mb > 0:
+        cfg = tts.cfg.gpt
+        kv_pool = KVPagePool.from_memory(args.kv_pool_mb, cfg.layers, cfg.heads, cfg.model_dim // cfg.heads,
+                                         device=tts.device, dtype=torch.float16 if tts.use_fp16 else torch.float32)
+    spk_conds = tts._get_spk_conditions(args.voice)
+    emovec = tts._get_emovec(spk_conds, tts._get_emo_conditions(args.voice), 1.0)
+    requests = []
+    for text in TEXTS:
+        text_tokens = tts.tokenizer.convert_tokens_to_ids(tts.tokenizer.tokenize(text))
+        text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=tts.device).unsqueeze(0)
+        requests.append((text_tokens, spk_conds["spk_cond_latent"], emovec))
+
+    if kv_pool is not None:
+        worst_case = kv_pool.admission_capacity(tts.gpt.cond_num + 2 + max(r[0].shape[1] for r in requests) + 3
+                                                + args.max_mel_tokens)
+        print(f">> KV pool: {kv_pool.num_pages} pages of {kv_pool.page_size} tokens "
+              f"({kv_pool.stats()['memory_mb']:.0f} MB), {worst_case} sequences with a worst-case reservation")
+
+    serial_lock = threading.Lock()
+    schedulers = {"continuous": DecodeScheduler(tts.gpt, max_batch_size=args.max_batch_size, dtype=tts.dtype)}
+    if kv_pool is not None:
+        schedulers["paged"] = DecodeScheduler(tts.gpt, max_batch_size=args.max_batch_size, dtype=tts.dtype,
+                                              kv_pool=kv_pool)
+    modes = {"serial": lambda *inputs: serial_generate(tts, serial_lock, *inputs, args)}
+    for name, scheduler in schedulers.items():
+        modes[name] = lambda *inputs, scheduler=scheduler: scheduler.generate(
+            *inputs, max_generate_length=args.max_mel_tokens)
+    # warm up both paths
+    for generate in modes.values():
+        generate(*requests[0])
+
+    print(f"{'mode':<12} {'clients':>7} {'time (s)':>9} {'codes':>7} {'codes/s':>9} {'mean lat (s)':>12} "
+          f"{'max lat (s)':>11} {'mean batch':>10}")
+    for clients in args.clients:
+        for name, generate in modes.items():
+            stats = schedulers[name].stats if name in schedulers else None
+            stats_before = dict(stats) if stats else None
+            torch.manual_seed(0)
+            elapsed, codes, latencies = run_clients(generate, requests, clients, args.requests_per_client)
+            steps = stats["steps"] - stats_before["steps"] if stats else 0
+            batch = (stats["tokens"] - stats_before["tokens"]) / steps if steps else 1.0
+            print(f"{name:<12} {clients:>7} {elapsed:>9.2f} {codes:>7} {codes / elapsed:>9.1f} "
+                  f"{sum(latencies) / len(latencies):>12.2f} {max(latencies):>11.2f} {batch:>10.2f}")
+    for scheduler in schedulers.values():
+        scheduler.close()
+    if kv_pool is not None:
+        stats = schedulers["paged"].stats
+        print(f">> paged scheduler: peak {stats.get('peak_kv_pages', 0)} pages in use, "
+              f"{stats['preempted']} preemptions, "
+              f"{stats.get('gather_workspace_bytes', 0) / 1024 / 1024:.1f} MB of keys/values gathered per layer")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+from omegaconf import OmegaConf
+
+from indextts.gpt.model_v2 import UnifiedVoice
+from indextts.utils.checkpoint import load_checkpoint
+
+MODES = {
+    "eager": {},
+    "eager static": {"static_kv_cache": True},
+    "compiled": {"compiled_decode_buckets": (1,)},
+}
+
+
+@torch.no_grad()
+def generate(gpt, text_tokens, spk_cond_latent, emovec, num_tokens, dtype):
+    with torch.amp.autocast(text_tokens.device.type, enabled=dtype is not None, dtype=dtype):
+        codes, _ = gpt.inference_speech(None, text_tokens, speech_conditioning_latent=spk_cond_latent,
+                                        emo_vec=emovec, do_sample=False, num_beams=1,
+                                        max_generate_length=num_tokens, min_new_tokens=num_tokens)
+    return codes
+
+
+def timed(device, fn):
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-token latency of the GPT decoding at batch size 1: eager vs. "
+                                                 "captured decode step (CUDA graph / torch.compile)")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory")
+    parser.add_argument("--fp16", action="store_true", default=False, help="Use FP16 for inference if available")
+    parser.add_argument("-d", "--device", type=str, nargs="+",
+                        default=["cpu"] + (["cuda:0"] if torch.cuda.is_available() else []),
+                        help="Devices to benchmark")
+    parser.add_argument("--tokens", type=int, default=200, help="Generated codes per run")
+    parser.add_argument("--text_tokens", type=int, default=40, help="Length of the text prompt")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per mode")
+    args = parser.parse_args()
+
+    cfg = OmegaConf.load(os.path.join(args.model_dir, "config.yaml"))
+    print(f"{'device':<8} {'mode':<14} {'capture (s)':>11} {'ms/token':>9} {'speedup':>8}")
+    for device in args.device:
+        fp16 = args.fp16 and device.startswith("cuda")
+        dtype = torch.float16 if fp16 else None
+        gpt = UnifiedVoice(**cfg.gpt)
+        load_checkpoint(gpt, os.path.join(args.model_dir, cfg.gpt_checkpoint))
+        gpt = gpt.to(device).eval()
+        if fp16:
+            gpt.half()
+        torch.manual_seed(0)
+        text_tokens = torch.randint(100, 1000, (1, args.text_tokens), dtype=torch.int32, device=device)
+        spk_cond_latent = torch.randn(1, 32, cfg.gpt.model_dim, device=device, dtype=gpt.mel_head.weight.dtype)
+        emovec = torch.zeros(1, cfg.gpt.model_dim, device=device, dtype=gpt.mel_head.weight.dtype)
+        baseline = None
+        for name, kwargs in MODES.items():
+            capture_time = timed(device, lambda: gpt.post_init_gpt2_config(kv_cache=True, half=fp16, **kwargs))
+            # warm up, then time the decode steps without the prefill (a 1-token run)
+            generate(gpt, text_tokens, spk_cond_latent, emovec, args.tokens, dtype)
+            per_token = []
+            for _ in range(args.repeats):
+                prefill = timed(device, lambda: generate(gpt, text_tokens, spk_cond_latent, emovec, 1, dtype))
+                total = timed(device, lambda: generate(gpt, text_tokens, spk_cond_latent, emovec, args.tokens, dtype))
+                per_token.append((total - prefill) / (args.tokens - 1))
+            latency = min(per_token)
+            baseline = baseline or latency
+            print(f"{device:<8} {name:<14} {capture_time:>11.2f} {latency * 1000:>9.2f} {baseline / latency:>7.2f}x")
+        del gpt
+        if device.startswith("cuda"):
+            torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+from omegaconf import OmegaConf
+
+from indextts.s2mel.modules.commons import sequence_mask
+from indextts.s2mel.modules.diffusion_transformer import DiT
+
+
+def masks(dit, x_lens, length):
+    x_mask = sequence_mask(x_lens, length).unsqueeze(1)
+    return {
+        # the mask of `DiT.forward()` before the key padding masks
+        "dense": lambda: x_mask[:, None, :].repeat(1, 1, length, 1),
+        "key padding": lambda: dit.attention_mask(x_mask),
+    }
+
+
+@torch.no_grad()
+def measure(dit, device, x_in, c, make_mask):
+    cuda = device.startswith("cuda")
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start_time = time.perf_counter()
+    try:
+        input_pos = dit.input_pos[:x_in.size(1)]
+        dit.transformer(x_in, c, input_pos, make_mask())
+        if cuda:
+            torch.cuda.synchronize()
+    except torch.cuda.OutOfMemoryError:
+        torch.cuda.empty_cache()
+        return None, None
+    elapsed = time.perf_counter() - start_time
+    peak = (torch.cuda.max_memory_allocated() - base) / 1024 / 1024 if cuda else None
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory and latency of one s2mel DiT transformer pass: dense "
+                                                 "(T x T) attention mask vs. key padding mask")
+    parser.add_argument("--config", type=str, default="checkpoints/config.yaml", help="Model config")
+    parser.add_argument("-d", "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu",
+                        help="Device to run on")
+    parser.add_argument("--fp16", action="store_true", default=False, help="Run the DiT in FP16")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[2048, 4096, 8192], help="Frames per sequence")
+    parser.add_argument("--padding", type=int, default=0,
+                        help="Frames of padding of the second sequence (0: none, the CFG batch of inference)")
+    parser.add_argument("--batch_size", type=int, default=2, help="Sequences per pass (2 with CFG)")
+    args = parser.parse_args()
+
+    cfg = OmegaConf.load(args.config)
+    dtype = torch.float16 if args.fp16 and args.device.startswith("cuda") else torch.float32
+    dit = DiT(cfg.s2mel).to(args.device, dtype).eval()
+    dit.setup_caches(max_batch_size=1, max_seq_length=max(args.lengths))
+    causal_mask = dit.transformer.causal_mask
+    cache_mb = causal_mask.numel() * causal_mask.element_size() / 1024 / 1024 if causal_mask is not None else 0.0
+    print(f"causal mask of setup_caches(): {cache_mb:.1f} MB")
+    hidden_dim = cfg.s2mel.DiT.hidden_dim
+
+    print(f"{'frames':>6} {'mask':<12} {'mask (MB)':>9} {'time (s)':>9} {'peak (MB)':>9}")
+    for length in args.lengths:
+        torch.manual_seed(0)
+        x_in = torch.randn(args.batch_size, length, hidden_dim, device=args.device, dtype=dtype)
+        c = torch.randn(args.batch_size, 1, hidden_dim, device=args.device, dtype=dtype)
+        x_lens = torch.full((args.batch_size,), length, device=args.device)
+        x_lens[1:] -= args.padding
+        for name, make_mask in masks(dit, x_lens, length).items():
+            mask = make_mask()
+            mask_mb = mask.numel() * mask.element_size() / 1024 / 1024 if mask is not None else 0.0
+            del mask
+            measure(dit, args.device, x_in, c, make_mask)  # warm up
+            elapsed, peak = measure(dit, args.device, x_in, c, make_mask)
+            elapsed = f"{elapsed:>9.3f}" if elapsed is not None else f"{'OOM':>9}"
+            peak = f"{peak:>9.1f}" if peak is not None else f"{'-':>9}"
+            print(f"{length:>6} {name:<12} {mask_mb:>9.1f} {elapsed} {peak}")
+
+
+if __name__ == "__main__":
+    main()
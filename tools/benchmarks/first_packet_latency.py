@@ -0,0 +1,71 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+
+from indextts.infer_v2 import IndexTTS2
+
+
+def run_stream(tts, args, **stream_kwargs):
+    """
+    Consume one `infer_stream()` call and return its first-packet latency, total time and audio length.
+    """
+    start_time = time.perf_counter()
+    first_packet = None
+    audio_duration = 0.0
+    chunks = 0
+    for chunk in tts.infer_stream(args.voice, args.text, interval_silence=args.interval_silence, **stream_kwargs):
+        if first_packet is None:
+            first_packet = time.perf_counter() - start_time
+        audio_duration += chunk["audio_duration"]
+        chunks += 1
+    return first_packet, time.perf_counter() - start_time, audio_duration, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="First-packet latency of IndexTTS2 streaming")
+    parser.add_argument("-v", "--voice", type=str, default="tests/sample_prompt.wav", help="Reference audio")
+    parser.add_argument("-t", "--text", type=str,
+                        default="大家好，我现在正在测试流式合成的首包延迟。这句话会被分成好几个分句，每个分句都足够长。",
+                        help="Text to synthesize")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory")
+    parser.add_argument("--fp16", action="store_true", default=False, help="Use FP16 for inference if available")
+    parser.add_argument("-d", "--device", type=str, default=None, help="Device to run the model on")
+    parser.add_argument("--interval_silence", type=int, default=200, help="Silence between segments (ms)")
+    parser.add_argument("--first_chunk_codes", type=int, nargs="+", default=[20, 40, 80],
+                        help="First-chunk sizes (mel codes) to benchmark in sub-segment mode")
+    parser.add_argument("--chunk_codes", type=int, default=80, help="Chunk size (mel codes) after the first one")
+    parser.add_argument("--overlap_codes", type=int, default=8, help="Overlap (mel codes) between chunks")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per configuration")
+    args = parser.parse_args()
+
+    tts = IndexTTS2(cfg_path=os.path.join(args.model_dir, "config.yaml"), model_dir=args.model_dir,
+                    use_fp16=args.fp16, device=args.device)
+    configs = [("segment", dict(num_beams=1))]
+    for first_chunk_codes in args.first_chunk_codes:
+        configs.append((f"sub-segment first={first_chunk_codes}", dict(
+            sub_segment=True, first_chunk_codes=first_chunk_codes, chunk_codes=args.chunk_codes,
+            overlap_codes=args.overlap_codes)))
+
+    # warm up, this also fills the conditioning cache of the reference audio
+    run_stream(tts, args, **configs[0][1])
+
+    print(f"{'mode':<28} {'first packet (s)':>16} {'total (s)':>10} {'audio (s)':>10} {'RTF':>8} {'chunks':>7}")
+    for name, kwargs in configs:
+        results = []
+        for _ in range(args.repeat):
+            torch.manual_seed(0)
+            results.append(run_stream(tts, args, **kwargs))
+        first_packet = sum(r[0] for r in results) / len(results)
+        total = sum(r[1] for r in results) / len(results)
+        audio = sum(r[2] for r in results) / len(results)
+        print(f"{name:<28} {first_packet:>16.3f} {total:>10.3f} {audio:>10.2f} {total / audio:>8.4f} "
+              f"{results[-1][3]:>7d}")
+
+
+if __name__ == "__main__":
+    main()
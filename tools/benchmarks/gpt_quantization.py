@@ -0,0 +1,97 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+from omegaconf import OmegaConf
+
+from indextts.gpt.model_v2 import UnifiedVoice
+from indextts.gpt.quantize import quantize_gpt
+from indextts.utils.checkpoint import load_checkpoint
+
+
+@torch.no_grad()
+def generate(gpt, text_tokens, spk_cond_latent, emovec, num_tokens):
+    codes, _ = gpt.inference_speech(None, text_tokens, speech_conditioning_latent=spk_cond_latent, emo_vec=emovec,
+                                    do_sample=False, num_beams=1, max_generate_length=num_tokens,
+                                    min_new_tokens=num_tokens)
+    return codes
+
+
+@torch.no_grad()
+def mel_logits(gpt, text_tokens, spk_cond_latent, emovec, codes):
+    # teacher-forced logits of the same codes, comparable between the modes
+    conds = gpt.get_conds_latent(spk_cond_latent, emovec)
+    text_inputs, _ = gpt.build_aligned_inputs_and_targets(text_tokens, gpt.start_text_token, gpt.stop_text_token)
+    mel_inputs, _ = gpt.build_aligned_inputs_and_targets(codes, gpt.start_mel_token, gpt.stop_mel_token)
+    text_emb = gpt.text_embedding(text_inputs) + gpt.text_pos_embedding(text_inputs)
+    mel_emb = gpt.mel_embedding(mel_inputs) + gpt.mel_pos_embedding(mel_inputs)
+    _, logits = gpt.get_logits(conds, text_emb, gpt.text_head, mel_emb, gpt.mel_head)
+    return logits.float()
+
+
+def weight_bytes(module):
+    return sum(t.numel() * t.element_size() for t in module.state_dict().values())
+
+
+def timed(fn):
+    start_time = time.perf_counter()
+    fn()
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Weight memory, latency and logits error of the GPT with weight-only "
+                                                 "int8/int4 quantization")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory")
+    parser.add_argument("--modes", type=str, nargs="+", default=["float", "int8", "int4"], help="Quantization modes")
+    parser.add_argument("--groupsize", type=int, default=128, help="Group size of the int4 quantization")
+    parser.add_argument("--threads", type=int, default=None, help="Number of CPU threads")
+    parser.add_argument("--tokens", type=int, default=100, help="Generated codes per run")
+    parser.add_argument("--text_tokens", type=int, default=40, help="Length of the text prompt")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per mode")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    cfg = OmegaConf.load(os.path.join(args.model_dir, "config.yaml"))
+    torch.manual_seed(0)
+    text_tokens = torch.randint(100, 1000, (1, args.text_tokens), dtype=torch.int32)
+    spk_cond_latent = torch.randn(1, 32, cfg.gpt.model_dim)
+    emovec = torch.zeros(1, cfg.gpt.model_dim)
+    print(f"{'mode':<6} {'GPT-2 (MB)':>10} {'model (MB)':>10} {'prefill (s)':>11} {'ms/token':>9} {'speedup':>8} "
+          f"{'logits err':>10} {'top-1':>6}")
+    codes, reference, baseline = None, None, None
+    for mode in args.modes:
+        gpt = UnifiedVoice(**cfg.gpt)
+        load_checkpoint(gpt, os.path.join(args.model_dir, cfg.gpt_checkpoint))
+        gpt.eval()
+        if mode != "float":
+            quantize_gpt(gpt, mode, groupsize=args.groupsize)
+        gpt.post_init_gpt2_config(kv_cache=True)
+        generate(gpt, text_tokens, spk_cond_latent, emovec, args.tokens)  # warm up
+        prefill, per_token = [], []
+        for _ in range(args.repeats):
+            prefill.append(timed(lambda: generate(gpt, text_tokens, spk_cond_latent, emovec, 1)))
+            total = timed(lambda: generate(gpt, text_tokens, spk_cond_latent, emovec, args.tokens))
+            per_token.append((total - prefill[-1]) / (args.tokens - 1))
+        latency = min(per_token)
+        baseline = baseline or latency
+        if codes is None:
+            codes = generate(gpt, text_tokens, spk_cond_latent, emovec, args.tokens)
+        logits = mel_logits(gpt, text_tokens, spk_cond_latent, emovec, codes)
+        reference = reference if reference is not None else logits
+        error = ((logits - reference).norm() / reference.norm()).item()
+        top1 = (logits.argmax(dim=1) == reference.argmax(dim=1)).float().mean().item()
+        heads = weight_bytes(gpt.mel_head) + weight_bytes(gpt.text_head)
+        print(f"{mode:<6} {(weight_bytes(gpt.gpt.h) + heads) / 1024 / 1024:>10.1f} "
+              f"{weight_bytes(gpt) / 1024 / 1024:>10.1f} {min(prefill):>11.3f} {latency * 1000:>9.2f} "
+              f"{baseline / latency:>7.2f}x {error:>10.2e} {top1:>6.3f}")
+        del gpt
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+from transformers import (LogitsProcessorList, RepetitionPenaltyLogitsProcessor, TemperatureLogitsWarper,
+                          TopKLogitsWarper, TopPLogitsWarper)
+
+from indextts.gpt.fused_sampler import FusedSampler
+
+
+def hf_step(processors, input_ids, logits):
+    # the token selection of `GenerationMixin._sample()`
+    scores = processors(input_ids, logits)
+    return torch.multinomial(scores.softmax(dim=-1), num_samples=1).squeeze(1)
+
+
+def timed(step, steps, device):
+    for _ in range(3):
+        step(0)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for i in range(steps):
+        step(i)
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time per decoding step of the code selection: logits processors of "
+                                                 "generate() vs. FusedSampler")
+    parser.add_argument("-d", "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu",
+                        help="Device to run on")
+    parser.add_argument("--vocab", type=int, default=8194, help="Number of mel codes")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 4, 16], help="Decoded rows")
+    parser.add_argument("--history", type=int, nargs="+", default=[100, 500, 1500],
+                        help="Prompt + generated tokens per row")
+    parser.add_argument("--steps", type=int, default=200, help="Timed steps per configuration")
+    parser.add_argument("--repetition_penalty", type=float, default=10.0)
+    parser.add_argument("--temperature", type=float, default=0.8)
+    parser.add_argument("--top_k", type=int, default=30)
+    parser.add_argument("--top_p", type=float, default=0.8)
+    args = parser.parse_args()
+
+    processors = LogitsProcessorList([RepetitionPenaltyLogitsProcessor(args.repetition_penalty),
+                                      TemperatureLogitsWarper(args.temperature), TopKLogitsWarper(args.top_k),
+                                      TopPLogitsWarper(args.top_p)])
+    print(f"{'batch':>5} {'history':>7} {'processors (ms)':>15} {'fused (ms)':>10} {'speedup':>8} {'max |dp|':>9}")
+    for batch_size in args.batch_sizes:
+        for history in args.history:
+            torch.manual_seed(0)
+            input_ids = torch.randint(0, args.vocab, (batch_size, history), device=args.device)
+            logits = torch.randn(args.steps, batch_size, args.vocab, device=args.device) * 3
+            sampler = FusedSampler(do_sample=True, top_p=args.top_p, top_k=args.top_k, temperature=args.temperature,
+                                   repetition_penalty=args.repetition_penalty)
+            sampler.reset(input_ids, args.vocab)
+            # same distribution as the processors
+            reference = processors(input_ids, logits[0].clone()).softmax(dim=-1)
+            probs, indices = sampler.candidates(logits[0])
+            fused = torch.zeros_like(reference).scatter_(1, indices, probs / probs.sum(dim=-1, keepdim=True))
+            max_diff = (fused - reference).abs().max().item()
+
+            # `generate()` appends every sampled token to `input_ids`, the sampler adds it to its histogram
+            ids = [input_ids]
+
+            def processors_step(i):
+                tokens = hf_step(processors, ids[0], logits[i].clone())
+                ids[0] = torch.cat([ids[0], tokens[:, None]], dim=-1)
+
+            hf_time = timed(processors_step, args.steps, args.device)
+            fused_time = timed(lambda i: sampler(logits[i]), args.steps, args.device)
+            print(f"{batch_size:>5} {history:>7} {hf_time * 1000:>15.3f} {fused_time * 1000:>10.3f} "
+                  f"{hf_time / fused_time:>7.2f}x {max_diff:>9.1e}")
+
+
+if __name__ == "__main__":
+    main()
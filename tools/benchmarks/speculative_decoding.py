@@ -0,0 +1,87 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+
+from indextts.gpt.speculative import EarlyExitDrafter, NGramDrafter, new_stats
+from indextts.infer_v2 import IndexTTS2
+
+TEXTS = [
+    "大家好，我现在正在测试推测解码的接受率和速度。",
+    "The quick brown fox jumps over the lazy dog, and then it runs away into the forest.",
+    "今天天气不错，我们一起去公园散步吧。",
+    "嗯……让我想一想，这个问题其实没有那么简单。",
+]
+
+
+@torch.no_grad()
+def generate(tts, requests, drafter, args):
+    codes = 0
+    start_time = time.perf_counter()
+    for text_tokens, spk_cond_latent, emovec in requests:
+        with torch.amp.autocast(text_tokens.device.type, enabled=tts.dtype is not None, dtype=tts.dtype):
+            out, _ = tts.gpt.inference_speech(None, text_tokens, speech_conditioning_latent=spk_cond_latent,
+                                              emo_vec=emovec, do_sample=not args.greedy, top_p=0.8, top_k=30,
+                                              temperature=0.8, num_beams=1, repetition_penalty=10.0,
+                                              max_generate_length=args.max_mel_tokens, drafter=drafter)
+        codes += out.shape[-1]
+    if tts.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return time.perf_counter() - start_time, codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Acceptance rate and speed of the speculative decoding of the "
+                                                 "mel codes, against the default decoding")
+    parser.add_argument("-v", "--voice", type=str, default="tests/sample_prompt.wav", help="Reference audio")
+    parser.add_argument("--model_dir", type=str, default="checkpoints", help="Path to the model directory")
+    parser.add_argument("--fp16", action="store_true", default=False, help="Use FP16 for inference if available")
+    parser.add_argument("-d", "--device", type=str, default=None, help="Device to run the model on")
+    parser.add_argument("--greedy", action="store_true", default=False, help="Greedy decoding instead of sampling")
+    parser.add_argument("--num_draft_tokens", type=int, nargs="+", default=[2, 4, 6], help="Drafts per step")
+    parser.add_argument("--ngram", type=int, nargs="+", default=[2, 3], help="Lengths of the n-gram drafters")
+    parser.add_argument("--exit_layers", type=int, nargs="+", default=[4, 8],
+                        help="Numbers of GPT layers of the early-exit drafters")
+    parser.add_argument("--max_mel_tokens", type=int, default=1500, help="Maximum generated codes per segment")
+    args = parser.parse_args()
+
+    tts = IndexTTS2(cfg_path=os.path.join(args.model_dir, "config.yaml"), model_dir=args.model_dir,
+                    use_fp16=args.fp16, device=args.device)
+    spk_conds = tts._get_spk_conditions(args.voice)
+    emovec = tts._get_emovec(spk_conds, tts._get_emo_conditions(args.voice), 1.0)
+    requests = []
+    for text in TEXTS:
+        text_tokens = tts.tokenizer.convert_tokens_to_ids(tts.tokenizer.tokenize(text))
+        text_tokens = torch.tensor(text_tokens, dtype=torch.int32, device=tts.device).unsqueeze(0)
+        requests.append((text_tokens, spk_conds["spk_cond_latent"], emovec))
+
+    drafters = {"baseline": None}
+    for k in args.num_draft_tokens:
+        for n in args.ngram:
+            drafters[f"ngram n={n} k={k}"] = NGramDrafter(n, num_draft_tokens=k)
+        for layers in args.exit_layers:
+            drafters[f"exit {layers}/{tts.cfg.gpt.layers} k={k}"] = EarlyExitDrafter(layers, num_draft_tokens=k)
+    # warm up
+    generate(tts, requests[:1], None, args)
+
+    print(f"{'drafter':<20} {'time (s)':>9} {'codes':>7} {'codes/s':>9} {'speedup':>8} {'accepted':>9} "
+          f"{'codes/pass':>10}")
+    baseline = None
+    for name, drafter in drafters.items():
+        torch.manual_seed(0)
+        elapsed, codes = generate(tts, requests, drafter, args)
+        speed = codes / elapsed
+        baseline = baseline or speed
+        stats = drafter.stats if drafter is not None else new_stats()
+        acceptance = stats["accepted"] / stats["drafted"] if stats["drafted"] else 0.0
+        per_pass = stats["tokens"] / (stats["steps"] + stats["calls"]) if drafter is not None else 1.0
+        print(f"{name:<20} {elapsed:>9.2f} {codes:>7} {speed:>9.1f} {speed / baseline:>7.2f}x {acceptance:>8.1%} "
+              f"{per_pass:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+import torch
+
+from indextts.s2mel.modules.bigvgan.bigvgan import BigVGAN
+from indextts.s2mel.modules.bigvgan.env import AttrDict
+from indextts.s2mel.modules.bigvgan.tiled import TiledBigVGAN
+
+
+@torch.no_grad()
+def measure(vocoder, device, mel):
+    cuda = device.startswith("cuda")
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start_time = time.perf_counter()
+    try:
+        wav = vocoder(mel)
+        if cuda:
+            torch.cuda.synchronize()
+    except torch.cuda.OutOfMemoryError:
+        torch.cuda.empty_cache()
+        return None, None, None
+    elapsed = time.perf_counter() - start_time
+    peak = (torch.cuda.max_memory_allocated() - base) / 1024 / 1024 if cuda else None
+    return wav, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory, latency and output error of BigVGAN on whole mels vs. "
+                                                 "tiled by overlapping windows")
+    parser.add_argument("--vocoder", type=str, default=None,
+                        help="Pretrained BigVGAN (e.g. the vocoder.name of the model config), random weights if unset")
+    parser.add_argument("--config", type=str, default="indextts/s2mel/modules/bigvgan/config.json",
+                        help="BigVGAN config of the random weights")
+    parser.add_argument("-d", "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu",
+                        help="Device to run on")
+    parser.add_argument("--frames", type=int, nargs="+", default=[500, 1000, 2000, 4000],
+                        help="Mel frames per input (86 per second)")
+    parser.add_argument("--batch_size", type=int, default=1, help="Mels per call")
+    parser.add_argument("--chunk_frames", type=int, nargs="+", default=[256, 512], help="Window sizes of the tiling")
+    parser.add_argument("--context_frames", type=int, default=None,
+                        help="Context of each window, by default the receptive field of the vocoder")
+    args = parser.parse_args()
+
+    if args.vocoder:
+        vocoder = BigVGAN.from_pretrained(args.vocoder)
+    else:
+        with open(args.config) as f:
+            vocoder = BigVGAN(AttrDict(json.load(f)))
+    vocoder = vocoder.to(args.device).eval()
+    vocoder.remove_weight_norm()
+    modes = {"full": vocoder}
+    for chunk_frames in args.chunk_frames:
+        modes[f"tiled {chunk_frames}"] = TiledBigVGAN(vocoder, chunk_frames, context_frames=args.context_frames)
+    print(f"context of the windows: {TiledBigVGAN(vocoder, context_frames=args.context_frames).context_frames} frames")
+
+    print(f"{'frames':>6} {'mode':<10} {'time (s)':>9} {'peak (MB)':>9} {'max error':>10}")
+    for num_frames in args.frames:
+        torch.manual_seed(0)
+        mel = torch.randn(args.batch_size, vocoder.h.num_mels, num_frames, device=args.device) * 2 - 5
+        reference = None
+        for name, model in modes.items():
+            measure(model, args.device, mel[..., :min(num_frames, 100)])  # warm up
+            wav, elapsed, peak = measure(model, args.device, mel)
+            if wav is None:
+                print(f"{num_frames:>6} {name:<10} {'OOM':>9} {'-':>9} {'-':>10}")
+                continue
+            reference = reference if reference is not None else wav
+            error = (wav - reference).abs().max().item() if reference.shape == wav.shape else float("nan")
+            peak = f"{peak:>9.1f}" if peak is not None else f"{'-':>9}"
+            print(f"{num_frames:>6} {name:<10} {elapsed:>9.3f} {peak} {error:>10.2e}")
+            del wav
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,12 @@ parser.add_argument("--model_dir", type=str, default="./checkpoints", help="Mode
 parser.add_argument("--fp16", action="store_true", default=False, help="Use FP16 for inference if available")
 parser.add_argument("--deepspeed", action="store_true", default=False, help="Use DeepSpeed to accelerate if available")
 parser.add_argument("--cuda_kernel", action="store_true", default=False, help="Use CUDA kernel for inference if available")
+parser.add_argument("--decode_batch_size", type=int, default=0,
+                    help="Batch the GPT decoding of up to this many concurrent requests (0 to disable, needs num_beams=1)")
+parser.add_argument("--quantize", type=str, default=None, choices=["int8", "int4"],
+                    help="Weight-only quantization of the GPT, for CPU or low-memory serving")
+parser.add_argument("--vocoder_chunk_frames", type=int, default=None,
+                    help="Vocode the mels by overlapping windows of this many frames, bounds the BigVGAN memory")
 parser.add_argument("--gui_seg_tokens", type=int, default=120, help="GUI: Max tokens per generation segment")
 cmd_args = parser.parse_args()
 
@@ -58,7 +64,13 @@ tts = IndexTTS2(model_dir=cmd_args.model_dir,
                 use_fp16=cmd_args.fp16,
                 use_deepspeed=cmd_args.deepspeed,
                 use_cuda_kernel=cmd_args.cuda_kernel,
+                decode_batch_size=cmd_args.decode_batch_size,
+                quantize=cmd_args.quantize,
+                vocoder_chunk_frames=cmd_args.vocoder_chunk_frames,
                 )
+if cmd_args.decode_batch_size > 0:
+    print(f">> Batched decoding of up to {cmd_args.decode_batch_size} requests: num_beams defaults to 1, "
+          f"requests with num_beams > 1 are decoded one at a time.")
 # 支持的语言列表
 LANGUAGES = {
     "中文": "zh_CN",
@@ -256,7 +268,9 @@ with gr.Blocks(title="IndexTTS Demo") as demo:
                     with gr.Row():
                         top_p = gr.Slider(label="top_p", minimum=0.0, maximum=1.0, value=0.8, step=0.01)
                         top_k = gr.Slider(label="top_k", minimum=0, maximum=100, value=30, step=1)
-                        num_beams = gr.Slider(label="num_beams", value=3, minimum=1, maximum=10, step=1)
+                        # the batched decoding of `--decode_batch_size` only takes num_beams=1
+                        num_beams = gr.Slider(label="num_beams", value=1 if cmd_args.decode_batch_size > 0 else 3,
+                                              minimum=1, maximum=10, step=1)
                     with gr.Row():
                         repetition_penalty = gr.Number(label="repetition_penalty", precision=None, value=10.0, minimum=0.1, maximum=20.0, step=0.1)
                         length_penalty = gr.Number(label="length_penalty", precision=None, value=0.0, minimum=-2.0, maximum=2.0, step=0.1)
@@ -438,5 +452,7 @@ with gr.Blocks(title="IndexTTS Demo") as demo:
 
 
 if __name__ == "__main__":
-    demo.queue(20)
+    # with a decode scheduler, the requests must run concurrently to be batched; IndexTTS2 runs the other stages (and
+    # the GPT decoding that the scheduler doesn't take, e.g. beam search) one request at a time
+    demo.queue(20, default_concurrency_limit=max(1, cmd_args.decode_batch_size))
     demo.launch(server_name=cmd_args.host, server_port=cmd_args.port)